@@ -11,6 +11,13 @@ DROP TABLE IF EXISTS IngredientList_Ingredient;
 DROP TABLE IF EXISTS Recipe_Instruction;
 DROP TABLE IF EXISTS Recipe_Picture;
 DROP TABLE IF EXISTS Ingredient_IngredientCategory;
+DROP TABLE IF EXISTS Recipe_RecipeCategory;
+DROP TABLE IF EXISTS RecipeSimilar;
+DROP TABLE IF EXISTS RecipeSimilarShadow;
+DROP TABLE IF EXISTS RecipeSimilarOld;
+DROP TABLE IF EXISTS RecipeSimilarPending;
+DROP TABLE IF EXISTS ChangeOutbox;
+DROP TABLE IF EXISTS ChangeConsumer;
 
 DROP TABLE IF EXISTS IngredientList;
 DROP TABLE IF EXISTS Recipe;
@@ -22,6 +29,13 @@ DROP TABLE IF EXISTS Ingredient;
 DROP TABLE IF EXISTS IngredientCategory;
 DROP TABLE IF EXISTS Picture;
 
+-- KcalPerServing is derived from the ingredient lists, see
+-- kokbok.model.update_kcal_per_serving(); it is a double, which reads
+-- back exactly, so that the Recipe.find() page after one compares
+-- equal to it. Revision is bumped by every
+-- change, see kokbok.model.record_changes(). Recipe.find() orders by
+-- one of the times, Servings and KcalPerServing and filters on the
+-- others, so each ordering has an index holding all of them.
 CREATE TABLE Recipe (
        ID int PRIMARY KEY AUTO_INCREMENT,
        Title varchar(256) NOT NULL,
@@ -29,7 +43,17 @@ CREATE TABLE Recipe (
        CookingTimeCookMinutes int,
        Servings int,
        Description text,
-       Version int
+       Version int,
+       KcalPerServing double,
+       Revision int NOT NULL DEFAULT 0,
+       INDEX Recipe_Prep (CookingTimePrepMinutes, ID, CookingTimeCookMinutes,
+                          Servings, KcalPerServing),
+       INDEX Recipe_Cook (CookingTimeCookMinutes, ID, CookingTimePrepMinutes,
+                          Servings, KcalPerServing),
+       INDEX Recipe_Servings (Servings, ID, CookingTimePrepMinutes,
+                              CookingTimeCookMinutes, KcalPerServing),
+       INDEX Recipe_Kcal (KcalPerServing, ID, CookingTimePrepMinutes,
+                          CookingTimeCookMinutes, Servings)
 );
 
 CREATE TABLE Author (
@@ -42,7 +66,8 @@ CREATE TABLE Author_Recipe (
        RecipeID int,
        FOREIGN KEY (AuthorID) REFERENCES Author(ID) ON DELETE CASCADE,
        FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
-       PRIMARY KEY(AuthorID, RecipeID)
+       PRIMARY KEY(AuthorID, RecipeID),
+       INDEX AuthorRecipe_Recipe (RecipeID)
 );
 
 CREATE TABLE Comment (
@@ -56,28 +81,43 @@ CREATE TABLE Comment_Author (
        CommentID int,
        FOREIGN KEY (AuthorID) REFERENCES Author(ID) ON DELETE CASCADE,
        FOREIGN KEY (CommentID) REFERENCES Comment(ID) ON DELETE CASCADE,
-       PRIMARY KEY(AuthorID, CommentID)
+       PRIMARY KEY(AuthorID, CommentID),
+       INDEX CommentAuthor_Comment (CommentID)
 );
 
+-- Date is a copy of Comment.Date, so that a page of a recipe's
+-- comments can be read straight off the (RecipeID, Date, CommentID)
+-- index, without sorting all of them.
 CREATE TABLE Recipe_Comment (
        RecipeID int,
        CommentID int,
+       Date date NOT NULL,
        FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
        FOREIGN KEY (CommentID) REFERENCES Comment(ID) ON DELETE CASCADE,
-       PRIMARY KEY(RecipeID, CommentID)
+       PRIMARY KEY(RecipeID, CommentID),
+       INDEX RecipeComment_Page (RecipeID, Date, CommentID)
 );
 
 -- E.g. dinner, snack...
 CREATE TABLE RecipeCategory (
        ID int PRIMARY KEY auto_increment,
-       Name varchar(256)
+       Name varchar(256) UNIQUE NOT NULL
+);
+
+CREATE TABLE Recipe_RecipeCategory (
+       RecipeID int,
+       RecipeCategoryID int,
+       FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
+       FOREIGN KEY (RecipeCategoryID) REFERENCES RecipeCategory(ID) ON DELETE CASCADE,
+       PRIMARY KEY(RecipeID, RecipeCategoryID)
 );
 
 CREATE TABLE IngredientList (
        ID int PRIMARY KEY auto_increment,
        Title varchar(256),
        RecipeID int,
-       FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE
+       FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
+       INDEX IngredientList_Recipe (RecipeID)
 );
 
 CREATE TABLE Ingredient (
@@ -89,7 +129,8 @@ CREATE TABLE Ingredient (
        Protein int UNSIGNED,
        Carbohydrate int UNSIGNED,
        GramsPerMilliliter int UNSIGNED,
-       GramsPerUnit int UNSIGNED
+       GramsPerUnit int UNSIGNED,
+       Revision int NOT NULL DEFAULT 0
 );
 
 CREATE TABLE IngredientList_Ingredient (
@@ -105,7 +146,7 @@ CREATE TABLE IngredientList_Ingredient (
 
 CREATE TABLE IngredientCategory (
        ID int PRIMARY KEY AUTO_INCREMENT,
-       Name varchar(256)
+       Name varchar(256) UNIQUE NOT NULL
 );
 
 CREATE TABLE Ingredient_IngredientCategory (
@@ -127,7 +168,8 @@ CREATE TABLE Recipe_Instruction (
        Step int,
        FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
        FOREIGN KEY (InstructionID) REFERENCES Instruction(ID) ON DELETE CASCADE,
-       PRIMARY KEY(RecipeID, InstructionID)
+       PRIMARY KEY(RecipeID, InstructionID),
+       INDEX RecipeInstruction_Step (RecipeID, Step)
 );
 
 CREATE TABLE Picture (
@@ -140,7 +182,45 @@ CREATE TABLE Recipe_Picture (
        PictureID int,
        FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
        FOREIGN KEY (PictureID) REFERENCES Picture(ID) ON DELETE CASCADE,
-       PRIMARY KEY(RecipeID, PictureID)
+       PRIMARY KEY(RecipeID, PictureID),
+       INDEX RecipePicture_Picture (PictureID)
+);
+
+-- The most similar recipes to each recipe, see kokbok.similar
+CREATE TABLE RecipeSimilar (
+       RecipeID int,
+       Position int,
+       SimilarRecipeID int,
+       Score float,
+       FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
+       FOREIGN KEY (SimilarRecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE,
+       PRIMARY KEY(RecipeID, Position),
+       INDEX RecipeSimilar_Similar (SimilarRecipeID)
+);
+
+-- Recipes saved since their similar recipes were last updated; Version
+-- is bumped every time a recipe is queued again
+CREATE TABLE RecipeSimilarPending (
+       RecipeID int PRIMARY KEY,
+       Version int NOT NULL DEFAULT 1,
+       FOREIGN KEY (RecipeID) REFERENCES Recipe(ID) ON DELETE CASCADE
+);
+
+-- A change record for every write to a Recipe, IngredientList or
+-- Ingredient, appended in the same transaction (no foreign keys, the
+-- records outlive deleted objects), see kokbok.changes
+CREATE TABLE ChangeOutbox (
+       ID bigint PRIMARY KEY AUTO_INCREMENT,
+       Entity varchar(32) NOT NULL,
+       EntityID int NOT NULL,
+       Operation varchar(8) NOT NULL,
+       Created timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- How far each consumer of the change outbox has got
+CREATE TABLE ChangeConsumer (
+       Name varchar(256) PRIMARY KEY,
+       Position bigint NOT NULL
 );
 
 COMMIT;
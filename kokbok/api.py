@@ -0,0 +1,355 @@
+import collections
+import gzip
+import hashlib
+import json
+import re
+import threading
+import urllib.parse
+
+from kokbok.importer import dump_recipe
+from kokbok.model import (FIND_PAGE_SIZE, Ingredient, NotFoundException,
+                          Recipe, Session, read_snapshot, revision)
+
+
+# Serialized responses kept by the response cache
+DEFAULT_CACHE_ENTRIES = 10000
+
+# Smaller bodies aren't worth compressing
+GZIP_MIN_BYTES = 512
+
+# Most recipe IDs (or recipes) returned per page by /recipes
+MAX_PAGE_SIZE = 1000
+
+# Query parameters of /recipes passed on to Recipe.find() as integers
+INT_FILTERS = ['prep_min', 'prep_max', 'cook_min', 'cook_max',
+               'servings_min', 'servings_max']
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+def serialize(data):
+    return json.dumps(data, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def recipe_dict(recipe):
+    """
+    Return recipe as a dict for JSON, like importer.dump_recipe() but
+    with the IDs of the recipe and its ingredients.
+    """
+    data = dump_recipe(recipe)
+    data['id'] = recipe._id
+    data['pictures'] = [p.filename for p in recipe.pictures]
+
+    for (il_data, il) in zip(data['ingredients'], recipe.ingredient_lists):
+        for (i_data, i) in zip(il_data['ingredients'], il.ingredients):
+            i_data['id'] = i['ingredient']._id
+
+    return data
+
+
+def ingredient_dict(ingredient):
+    return {'id': ingredient._id,
+            'name': ingredient.name,
+            'price': ingredient.price,
+            'energy': ingredient.energy,
+            'fat': ingredient.fat,
+            'protein': ingredient.protein,
+            'carbohydrate': ingredient.carbohydrate,
+            'grams_per_ml': ingredient.gramspermilliliter,
+            'grams_per_unit': ingredient.gramsperunit,
+            'categories': ingredient.categories()}
+
+
+def entity_etag(entity, _id, revision):
+    return 'W/"%s-%d-%d"' % (entity.lower(), _id, revision)
+
+
+def etag_matches(header, etag):
+    """
+    Return whether the If-None-Match header matches etag, comparing
+    weakly.
+    """
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+
+    def opaque(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return opaque(etag) in [opaque(t) for t in header.split(",")]
+
+
+def accepts_gzip(header):
+    for coding in (header or "").split(","):
+        parts = [p.strip() for p in coding.split(";")]
+        if parts[0] == "gzip":
+            return not any(p.replace(" ", "") in ("q=0", "q=0.0", "q=0.00",
+                                                  "q=0.000")
+                           for p in parts[1:])
+    return False
+
+
+class ResponseCache():
+    """
+    A bounded, thread-safe LRU cache of response bodies by ETag, with
+    their gzipped versions made on demand.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag):
+        """
+        Return the [body, gzipped body or None] cached for etag, or
+        None.
+        """
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is not None:
+                self._entries.move_to_end(etag)
+            return entry
+
+    def put(self, etag, body):
+        entry = [body, None]
+        if self.max_entries <= 0:
+            return entry
+
+        with self._lock:
+            self._entries[etag] = entry
+            self._entries.move_to_end(etag)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Api():
+    """
+    A read-only WSGI application serving the catalogue as JSON:
+
+    GET /recipes/<id> -- a recipe
+
+    GET /ingredients/<id> -- an ingredient
+
+    GET /recipes -- a page of recipe IDs, filtered and ordered by the
+    query parameters of Recipe.find() (e.g. ?prep_max=15&order_by=prep,
+    and kcal_min/kcal_max for kcal_per_serving_between). Returns
+    {"ids": [...], "next": ...}, where next is the after= parameter for
+    the next page. With expand=1, {"recipes": [...], "next": ...}.
+
+    Recipes and ingredients have an ETag made from their revision, so a
+    request with a matching If-None-Match gets 304 Not Modified after
+    reading just the revision. Their serialized (and gzipped) bodies are
+    kept in a ResponseCache by ETag.
+    """
+
+    ROUTES = [(re.compile(r"^/recipes/(\d+)$"), 'recipe'),
+              (re.compile(r"^/ingredients/(\d+)$"), 'ingredient'),
+              (re.compile(r"^/recipes/?$"), 'recipes')]
+
+    def __init__(self, cache_entries=DEFAULT_CACHE_ENTRIES,
+                 gzip_min_bytes=GZIP_MIN_BYTES, max_age=0):
+        """
+        Keyword arguments
+
+        cache_entries -- the number of serialized responses to keep
+
+        gzip_min_bytes -- the smallest body to compress for clients that
+        accept gzip
+
+        max_age -- how many seconds clients may use a response without
+        revalidating it
+        """
+        self.cache = ResponseCache(cache_entries)
+        self.gzip_min_bytes = gzip_min_bytes
+        self.max_age = max_age
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            return self.respond(environ, start_response, "405 Method Not "
+                                "Allowed", serialize({'error': "read only"}),
+                                extra=[('Allow', 'GET, HEAD')])
+
+        try:
+            with Session():
+                (status, entry, etag) = self.dispatch(environ)
+        except HttpError as e:
+            return self.respond(environ, start_response, e.status,
+                                serialize({'error': e.message}))
+
+        return self.respond(environ, start_response, status, entry, etag)
+
+    def dispatch(self, environ):
+        """
+        Return (status, body or cache entry, ETag or None).
+        """
+        path = environ.get('PATH_INFO', '')
+        for (pattern, name) in self.ROUTES:
+            match = pattern.match(path)
+            if match:
+                return getattr(self, 'get_' + name)(environ, *match.groups())
+        raise HttpError("404 Not Found", "no such resource")
+
+    def cached(self, environ, entity, _id, load):
+        """
+        Return the response for the Recipe or Ingredient with _id, or
+        304 if the client has it. load() returns it as a dict.
+        """
+        etag = entity_etag(entity, _id, revision(entity, _id))
+        if etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            return ("304 Not Modified", None, etag)
+
+        entry = self.cache.get(etag)
+        if entry is None:
+            # The object may have changed since; read it and its
+            # revision in one snapshot, so the ETag is the body's
+            with read_snapshot():
+                etag = entity_etag(entity, _id, revision(entity, _id))
+                entry = self.cache.get(etag)
+                if entry is None:
+                    entry = self.cache.put(etag, serialize(load()))
+        return ("200 OK", entry, etag)
+
+    def get_recipe(self, environ, _id):
+        _id = int(_id)
+        try:
+            # Not through the recipe cache, which is invalidated only
+            # after commit; the response cache is keyed by revision
+            return self.cached(environ, "Recipe", _id,
+                               lambda: recipe_dict(Recipe.by_id_uncached(_id)))
+        except NotFoundException:
+            raise HttpError("404 Not Found", "no such recipe")
+
+    def get_ingredient(self, environ, _id):
+        _id = int(_id)
+        try:
+            return self.cached(environ, "Ingredient", _id,
+                               lambda: ingredient_dict(Ingredient.by_id(_id)))
+        except NotFoundException:
+            raise HttpError("404 Not Found", "no such ingredient")
+
+    def get_recipes(self, environ):
+        params = dict(urllib.parse.parse_qsl(environ.get('QUERY_STRING',
+                                                         '')))
+        try:
+            filters = find_filters(params)
+        except ValueError as e:
+            raise HttpError("400 Bad Request", str(e))
+
+        (ids, after) = Recipe.find(**filters)
+        data = {'next': None if after is None else format_after(after)}
+        if params.get('expand') in ('1', 'true'):
+            data['recipes'] = [recipe_dict(r) for r in
+                               Recipe.load_many_concurrently(ids)]
+        else:
+            data['ids'] = ids
+
+        # Lists aren't cached, but still save clients the transfer
+        body = serialize(data)
+        etag = 'W/"%s"' % hashlib.sha1(body).hexdigest()
+        if etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            return ("304 Not Modified", None, etag)
+        return ("200 OK", [body, None], etag)
+
+    def respond(self, environ, start_response, status, entry, etag=None,
+                extra=()):
+        headers = [('Cache-Control', 'max-age=%d' % self.max_age)]
+        if etag is not None:
+            headers.append(('ETag', etag))
+        headers.extend(extra)
+
+        if entry is None:
+            start_response(status, headers)
+            return []
+
+        if isinstance(entry, bytes):
+            entry = [entry, None]
+
+        body = entry[0]
+        headers.append(('Content-Type', 'application/json; charset=utf-8'))
+        if len(body) >= self.gzip_min_bytes:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING')):
+                if entry[1] is None:
+                    entry[1] = gzip.compress(body)
+                body = entry[1]
+                headers.append(('Content-Encoding', 'gzip'))
+
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [] if environ.get('REQUEST_METHOD') == 'HEAD' else [body]
+
+
+def find_filters(params):
+    """
+    Return the keyword arguments for Recipe.find() from the query
+    parameters params. Raises ValueError for bad values.
+    """
+    filters = {}
+    for name in INT_FILTERS:
+        if name in params:
+            filters[name] = int(params[name])
+
+    kcal = (params.get('kcal_min'), params.get('kcal_max'))
+    if kcal != (None, None):
+        filters['kcal_per_serving_between'] = tuple(
+            None if k is None else float(k) for k in kcal)
+
+    filters['order_by'] = params.get('order_by', 'id')
+    filters['limit'] = int(params.get('limit', FIND_PAGE_SIZE))
+    if not 0 < filters['limit'] <= MAX_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and %d" % MAX_PAGE_SIZE)
+
+    if 'after' in params:
+        filters['after'] = parse_after(params['after'])
+        if isinstance(filters['after'], tuple) != \
+                (filters['order_by'] != 'id'):
+            raise ValueError("after doesn't match order_by")
+
+    # Rejects unknown orders
+    Recipe.find_query(**filters)
+    return filters
+
+
+def format_after(after):
+    if isinstance(after, tuple):
+        return "%r,%d" % after
+    return str(after)
+
+
+def parse_after(value):
+    if "," in value:
+        (value, _id) = value.rsplit(",", 1)
+        return (float(value), int(_id))
+    return int(value)
+
+
+def serve(host='127.0.0.1', port=8000, cache_entries=DEFAULT_CACHE_ENTRIES,
+          max_age=0):
+    """
+    Serve an Api on host:port, a thread per request, until interrupted.
+    """
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIServer, make_server
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    app = Api(cache_entries=cache_entries, max_age=max_age)
+    server = make_server(host, port, app, server_class=ThreadingWSGIServer)
+    print("serving on http://%s:%d/" % (host, port))
+    server.serve_forever()
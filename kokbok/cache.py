@@ -0,0 +1,319 @@
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Recipe generations to keep before forgetting them all at once (which
+# only makes the loads in progress skip storing their recipes)
+MAX_GENERATIONS = 100000
+
+# Don't record a cache hit more often than this (in seconds) per entry,
+# to keep reads from turning into writes
+TOUCH_INTERVAL = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Entry (
+       RecipeID INTEGER PRIMARY KEY,
+       Generation INTEGER NOT NULL,
+       Data BLOB NOT NULL,
+       Size INTEGER NOT NULL,
+       LastUsed REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS Entry_LastUsed ON Entry (LastUsed);
+
+CREATE TABLE IF NOT EXISTS Generation (
+       RecipeID INTEGER PRIMARY KEY,
+       Generation INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Entry_Ingredient (
+       IngredientID INTEGER,
+       RecipeID INTEGER,
+       PRIMARY KEY (IngredientID, RecipeID)
+);
+
+CREATE INDEX IF NOT EXISTS Entry_Ingredient_Recipe
+ON Entry_Ingredient (RecipeID);
+
+CREATE TABLE IF NOT EXISTS Counter (
+       Name TEXT PRIMARY KEY,
+       Value INTEGER NOT NULL
+);
+"""
+
+
+class RecipeCache():
+    """
+    A read-through cache of serialized recipes in an SQLite file, shared
+    by all processes on the host that use the same path.
+
+    Every invalidation of a recipe gives it a new generation number,
+    and every invalidation of an ingredient bumps the generation of all
+    ingredients. An entry is only stored if both generations are the
+    same as when loading started, so a worker that was slow to load a
+    recipe can't put back a copy that was invalidated in the meantime.
+    Recipes without a generation of their own have the floor
+    generation, which is raised when old generations are forgotten.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, name=None):
+        """
+        Keyword arguments
+
+        path -- the SQLite file to keep the cache in, created if needed
+
+        max_bytes -- the total size of the serialized recipes to keep;
+        the least recently used are evicted beyond that
+
+        name -- the name of the change feed consumer that drops the
+        recipes changed on other hosts (see
+        kokbok.model.sync_recipe_cache()), by default recipe-cache-
+        followed by the host name
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.name = name or "recipe-cache-" + socket.gethostname()
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections must not be shared across fork() or
+        # between threads, so every thread of every process has its own
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def _counter(self, conn, name):
+        row = conn.execute("SELECT Value FROM Counter WHERE Name = ?",
+                           [name]).fetchone()
+        return row[0] if row else None
+
+    def _set_counter(self, conn, name, value):
+        conn.execute("INSERT OR REPLACE INTO Counter (Name, Value) "
+                     "VALUES (?, ?)", [name, value])
+
+    def generation(self, recipe_id):
+        """
+        Return the current (recipe, ingredient) generations of the
+        recipe with recipe_id, to pass to put().
+        """
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT Generation FROM Generation WHERE RecipeID = ?",
+            [recipe_id]).fetchone()
+        if row is None:
+            row = (self._counter(conn, 'floor') or 0,)
+        return (row[0], self._counter(conn, 'ingredients') or 0)
+
+    def get(self, recipe_id):
+        """
+        Return the cached recipe with recipe_id, or None.
+        """
+        # Invalidation deletes the entries, so any entry is current
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT Data, LastUsed FROM Entry WHERE RecipeID = ?",
+            [recipe_id]).fetchone()
+
+        if row is None:
+            return None
+
+        (data, last_used) = row
+        now = time.time()
+        if now - last_used > TOUCH_INTERVAL:
+            conn.execute("UPDATE Entry SET LastUsed = ? WHERE RecipeID = ?",
+                         [now, recipe_id])
+
+        return pickle.loads(data)
+
+    def put(self, recipe_id, recipe, generation, ingredient_ids=()):
+        """
+        Store recipe (any picklable object) as recipe_id, unless the
+        recipe or any ingredient has been invalidated since generation
+        was read. The entry is invalidated along with any of
+        ingredient_ids.
+        """
+        data = pickle.dumps(recipe, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.generation(recipe_id) != generation:
+                conn.execute("ROLLBACK")
+                return
+
+            conn.execute("INSERT OR REPLACE INTO Entry (RecipeID, Generation, "
+                         "Data, Size, LastUsed) VALUES (?, ?, ?, ?, ?)",
+                         [recipe_id, generation[0], data, len(data),
+                          time.time()])
+            conn.execute("DELETE FROM Entry_Ingredient WHERE RecipeID = ?",
+                         [recipe_id])
+            conn.executemany("INSERT OR IGNORE INTO Entry_Ingredient "
+                             "(IngredientID, RecipeID) VALUES (?, ?)",
+                             [(i, recipe_id) for i in set(ingredient_ids)])
+            self._evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_or_load(self, recipe_id, load, ingredient_ids=lambda recipe: ()):
+        """
+        Return the cached recipe with recipe_id, calling load() to get
+        it on a miss. ingredient_ids(recipe) gives the ingredients the
+        loaded recipe depends on.
+        """
+        generation = self.generation(recipe_id)
+
+        recipe = self.get(recipe_id)
+        if recipe is None:
+            recipe = load()
+            self.put(recipe_id, recipe, generation, ingredient_ids(recipe))
+
+        return recipe
+
+    def _evict(self, conn):
+        (total,) = conn.execute("SELECT IFNULL(SUM(Size), 0) "
+                                "FROM Entry").fetchone()
+
+        while total > self.max_bytes:
+            rows = conn.execute("SELECT RecipeID, Size FROM Entry "
+                                "ORDER BY LastUsed LIMIT 32").fetchall()
+            for (recipe_id, size) in rows:
+                conn.execute("DELETE FROM Entry WHERE RecipeID = ?",
+                             [recipe_id])
+                conn.execute("DELETE FROM Entry_Ingredient "
+                             "WHERE RecipeID = ?", [recipe_id])
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def _bump(self, conn, recipe_ids):
+        recipe_ids = [(i,) for i in set(recipe_ids)]
+        if not recipe_ids:
+            return
+
+        generation = (self._counter(conn, 'generation') or 0) + 1
+        self._set_counter(conn, 'generation', generation)
+        conn.executemany("INSERT OR REPLACE INTO Generation "
+                         "(RecipeID, Generation) VALUES (?, %d)"
+                         % generation, recipe_ids)
+        conn.executemany("DELETE FROM Entry WHERE RecipeID = ?", recipe_ids)
+        conn.executemany("DELETE FROM Entry_Ingredient WHERE RecipeID = ?",
+                         recipe_ids)
+
+        (count,) = conn.execute("SELECT COUNT(*) FROM Generation").fetchone()
+        if count > MAX_GENERATIONS:
+            # No recipe gets back a generation it had before
+            conn.execute("DELETE FROM Generation")
+            self._set_counter(conn, 'floor', generation)
+
+    def _bump_ingredients(self, conn, ingredient_ids):
+        ingredients = self._counter(conn, 'ingredients') or 0
+        self._set_counter(conn, 'ingredients', ingredients + 1)
+
+        recipe_ids = []
+        for ingredient_id in set(ingredient_ids):
+            recipe_ids.extend(r for (r,) in conn.execute(
+                "SELECT RecipeID FROM Entry_Ingredient WHERE IngredientID = ?",
+                [ingredient_id]))
+        self._bump(conn, recipe_ids)
+
+    def invalidate(self, recipe_id):
+        """
+        Drop the recipe with recipe_id from the cache.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._bump(conn, [recipe_id])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def invalidate_ingredient(self, ingredient_id):
+        """
+        Drop all cached recipes using the ingredient with ingredient_id,
+        and keep recipes being loaded from being stored.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._bump_ingredients(conn, [ingredient_id])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def outbox_position(self):
+        """
+        Return the ID of the last change from the change outbox applied
+        with apply_changes() or clear(), or None.
+        """
+        return self._counter(self._connection(), 'outbox')
+
+    def apply_changes(self, recipe_ids, ingredient_ids, position):
+        """
+        Invalidate the recipes with recipe_ids and the ingredients with
+        ingredient_ids, and record that the changes up to position in
+        the change outbox have been applied, at once.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if ingredient_ids:
+                self._bump_ingredients(conn, ingredient_ids)
+            self._bump(conn, recipe_ids)
+            self._set_counter(conn, 'outbox', position)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self, position=None):
+        """
+        Drop all cached recipes, and keep recipes being loaded from
+        being stored. position is the ID of the last change in the
+        change outbox the empty cache reflects, if known.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            recipe_ids = [r for (r,) in conn.execute("SELECT RecipeID "
+                                                     "FROM Entry")]
+            self._bump_ingredients(conn, [])
+            self._bump(conn, recipe_ids)
+            if position is not None:
+                self._set_counter(conn, 'outbox', position)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def size(self):
+        """
+        Return the total size in bytes of the cached recipes.
+        """
+        (total,) = self._connection().execute(
+            "SELECT IFNULL(SUM(Size), 0) FROM Entry").fetchone()
+        return total
+
+    def __len__(self):
+        (count,) = self._connection().execute(
+            "SELECT COUNT(*) FROM Entry").fetchone()
+        return count
@@ -0,0 +1,221 @@
+import collections
+import time
+
+from kokbok.model import connect
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+# How often (in seconds) follow() looks for new changes when idle
+DEFAULT_POLL_INTERVAL = 1.0
+
+
+Change = collections.namedtuple('Change', ['id', 'entity', 'entity_id',
+                                           'operation', 'created'])
+
+
+def settled_prefix(changes, position, settled=0):
+    """
+    Return the changes (in ID order following position) up to the
+    first gap in the IDs that may still be filled. A gap is left by a
+    transaction that has reserved an ID but not committed yet, or that
+    rolled back; gaps below the ID settled are known to be rollbacks
+    and are skipped.
+    """
+    result = []
+    expected = position + 1
+    for change in changes:
+        if change.id != expected and change.id > settled:
+            break
+        result.append(change)
+        expected = change.id + 1
+    return result
+
+
+def transactions_open_since(started):
+    """
+    Return whether a transaction (other than our own) that started at
+    or before the time started is still open. Needs the PROCESS
+    privilege to read information_schema.innodb_trx.
+    """
+    with connect() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM information_schema.innodb_trx "
+                       "WHERE trx_started <= %s "
+                       "AND trx_mysql_thread_id != CONNECTION_ID()",
+                       [started])
+        (count,) = cursor.fetchone()
+    return count > 0
+
+
+def latest(changes):
+    """
+    Return an OrderedDict mapping (entity, entity ID) to the last
+    operation on it in changes, so that an object changed many times in
+    a batch is only processed once.
+    """
+    result = collections.OrderedDict()
+    for change in changes:
+        key = (change.entity, change.entity_id)
+        if key in result:
+            del result[key]
+        result[key] = change.operation
+    return result
+
+
+def prune():
+    """
+    Delete the changes that every consumer has seen. Returns the number
+    of changes deleted.
+    """
+    with connect() as cursor:
+        cursor.execute("SELECT MIN(Position) FROM ChangeConsumer")
+        (position,) = cursor.fetchone()
+        if position is None:
+            return 0
+        cursor.execute("DELETE FROM ChangeOutbox WHERE ID <= %s", [position])
+        return cursor.rowcount
+
+
+def settled_position():
+    """
+    Return the ID of the last change before the first gap in the outbox
+    that may still be filled: the position of a consumer that has seen
+    every change committed so far.
+    """
+    with connect() as cursor:
+        cursor.execute("SELECT MAX(Position) FROM ChangeConsumer")
+        (position,) = cursor.fetchone()
+
+    # No consumer is past the first gap, so start at the furthest
+    feed = ChangeFeed(None)
+    position = position or 0
+    while True:
+        batch = feed.read(position)
+        if not batch:
+            return position
+        position = batch[-1].id
+
+
+class ChangeFeed():
+    """
+    Read the changes recorded by the model (see
+    kokbok.model.record_changes()) in order, in batches.
+
+    Every consumer has a name under which its position in the outbox is
+    checkpointed in the database, so that it continues where it left off
+    after a restart. Changes are delivered at least once: a batch that
+    was being processed when the consumer stopped is delivered again.
+    """
+
+    def __init__(self, name, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Keyword arguments
+
+        name -- the name of the consumer
+
+        batch_size -- the maximum number of changes per batch
+        """
+        self.name = name
+        self.batch_size = batch_size
+
+    def position(self):
+        """
+        Return the ID of the last change checkpointed by this consumer,
+        0 if none.
+        """
+        with connect() as cursor:
+            cursor.execute("SELECT Position FROM ChangeConsumer "
+                           "WHERE Name = %s", [self.name])
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _fetch(self, position):
+        # The changes after position, and a time after they were
+        # committed
+        query = """SELECT ID, Entity, EntityID, Operation, Created
+        FROM ChangeOutbox WHERE ID > %s ORDER BY ID LIMIT %s"""
+
+        with connect() as cursor:
+            cursor.execute(query, [position, self.batch_size])
+            changes = [Change(*row) for row in cursor.fetchall()]
+            cursor.execute("SELECT NOW()")
+            (now,) = cursor.fetchone()
+        return (changes, now)
+
+    def read(self, position=None):
+        """
+        Return the next batch of (at most batch_size) changes after
+        position (default: the checkpointed position) as Change tuples.
+
+        The batch ends before the first gap in the IDs. A gap at the
+        start is only skipped once no transaction that could hold its
+        ID is still open: IDs are reserved in order, so the holder of a
+        missing ID started before the changes after it were committed.
+        """
+        if position is None:
+            position = self.position()
+
+        (changes, now) = self._fetch(position)
+        batch = settled_prefix(changes, position)
+        if batch or not changes or transactions_open_since(now):
+            return batch
+
+        # The gaps below the changes read are rollbacks, or commits
+        # made since; read again to get the latter
+        settled = changes[-1].id
+        (changes, _) = self._fetch(position)
+        return settled_prefix(changes, position, settled)
+
+    def commit(self, position):
+        """
+        Checkpoint that the changes up to and including the one with ID
+        position have been processed.
+        """
+        with connect() as cursor:
+            cursor.execute("INSERT INTO ChangeConsumer (Name, Position) "
+                           "VALUES (%s, %s) ON DUPLICATE KEY UPDATE "
+                           "Position = GREATEST(Position, VALUES(Position))",
+                           [self.name, position])
+
+    def reset(self, position=0):
+        """
+        Move this consumer back (or forward) to position, e.g. to
+        reprocess all changes.
+        """
+        with connect() as cursor:
+            cursor.execute("REPLACE INTO ChangeConsumer (Name, Position) "
+                           "VALUES (%s, %s)", [self.name, position])
+
+    def batches(self):
+        """
+        Yield the batches of changes available now. A batch is
+        checkpointed when the next one is asked for, i.e. once the loop
+        body has processed it:
+
+        .. code-block:: python
+
+            for batch in ChangeFeed("search").batches():
+                reindex(latest(batch))
+        """
+        position = self.position()
+        while True:
+            batch = self.read(position)
+            if not batch:
+                return
+
+            yield batch
+
+            position = batch[-1].id
+            self.commit(position)
+
+    def follow(self, handle, poll_interval=DEFAULT_POLL_INTERVAL,
+               sleep=time.sleep):
+        """
+        Call handle(batch) for every batch of changes as they come,
+        forever (or until handle raises).
+        """
+        while True:
+            for batch in self.batches():
+                handle(batch)
+            sleep(poll_interval)
+
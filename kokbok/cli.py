@@ -0,0 +1,346 @@
+import argparse
+import os.path
+import sys
+import time
+
+
+# Maximum wall-clock time in seconds for `kokbok --help` to run, see
+# `kokbok bench --startup`
+STARTUP_BUDGET = 0.25
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'bin', 'kokbok')
+
+# Tables reported by `kokbok stats` and analyzed by `kokbok reindex`
+TABLES = ["Recipe", "Ingredient", "IngredientList",
+          "IngredientList_Ingredient", "Instruction", "Author", "Comment",
+          "Picture", "RecipeCategory", "IngredientCategory"]
+
+
+# The commands import the model (and with it the database driver and
+# config) themselves, so that only the ones that need it pay for it.
+
+def cmd_init(args):
+    from kokbok import model
+    model.db_init()
+
+
+def cmd_import(args):
+    from kokbok import importer
+    importer.main(args)
+
+
+def cmd_dump(args):
+    import json
+    from kokbok import model
+    from kokbok.importer import dump_recipe
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output \
+        else sys.stdout
+    try:
+        for _id in model.Recipe.iter_ids():
+            recipe = model.Recipe.by_id_uncached(_id)
+            out.write(json.dumps(dump_recipe(recipe), ensure_ascii=False))
+            out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def similarity_threshold(value):
+    """
+    argparse type for name similarity thresholds, see
+    kokbok.fuzzy.similarity_threshold().
+    """
+    from kokbok import fuzzy
+    return fuzzy.similarity_threshold(value)
+
+
+def startup_time(runs):
+    """
+    Return the best wall-clock time of runs runs of `kokbok --help`.
+    """
+    import subprocess
+
+    best = None
+    for _ in range(runs):
+        started = time.time()
+        subprocess.check_call([sys.executable, SCRIPT, '--help'],
+                              stdout=subprocess.DEVNULL)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def cmd_bench(args):
+    if args.startup:
+        best = startup_time(args.runs)
+        print("startup: %.3f s (budget %.3f s)" % (best, STARTUP_BUDGET))
+        if best > STARTUP_BUDGET:
+            sys.exit(1)
+        return
+
+    if args.matching:
+        from kokbok import fuzzy
+
+        rate = max(fuzzy.match_rate()[0] for _ in range(args.runs))
+        print("matching: %d names/s (budget %d names/s)"
+              % (rate, fuzzy.MATCH_BUDGET))
+        if rate < fuzzy.MATCH_BUDGET:
+            sys.exit(1)
+        return
+
+    from kokbok import model
+
+    ids = []
+    for _id in model.Recipe.iter_ids():
+        ids.append(_id)
+        if len(ids) >= args.recipes:
+            break
+
+    if not ids:
+        print("no recipes to load")
+        return
+
+    workers = args.workers or model.LOAD_WORKERS
+    for _ in range(args.runs):
+        started = time.time()
+        for _id in ids:
+            model.Recipe.by_id(_id)
+        elapsed = time.time() - started
+
+        started = time.time()
+        model.Recipe.load_many_concurrently(ids, workers=workers)
+        concurrent = time.time() - started
+        print("%d recipes in %.3f s (%.1f ms/recipe), %.3f s with %d "
+              "workers (%.1fx)" % (len(ids), elapsed,
+                                   1000 * elapsed / len(ids), concurrent,
+                                   workers, elapsed / concurrent))
+
+
+def cmd_stats(args):
+    from kokbok import model
+
+    with model.connect() as cursor:
+        for table in TABLES:
+            cursor.execute("SELECT COUNT(*) FROM " + table)
+            print("%-28s %10d" % (table, cursor.fetchone()[0]))
+
+    cache = model.recipe_cache()
+    if cache is not None:
+        print("%-28s %10d (%d bytes)" % ("cached recipes", len(cache),
+                                         cache.size()))
+
+
+def cmd_reindex(args):
+    from kokbok import model, similar
+
+    with model.connect() as cursor:
+        cursor.execute("ANALYZE TABLE " + ", ".join(TABLES))
+        cursor.fetchall()
+
+    if args.full:
+        count = similar.rebuild()
+    else:
+        count = similar.update_pending()
+    print("similar recipes updated for %d recipes" % count)
+
+    cache = model.recipe_cache()
+    if cache is not None:
+        cache.clear()
+
+
+def cmd_merge_ingredients(args):
+    from kokbok import fuzzy
+
+    for (keep_id, duplicate_ids) in fuzzy.find_duplicates(args.threshold):
+        print("%d <- %s" % (keep_id, ", ".join(str(d) for d in duplicate_ids)))
+        if args.dry_run:
+            continue
+        dropped = fuzzy.merge_ingredients(keep_id, duplicate_ids)
+        for (recipe_id, list_id, magnitude, unit) in dropped:
+            print("  recipe %d, list %d: dropped %s %s, the list already "
+                  "has %d in another unit" % (recipe_id, list_id, magnitude,
+                                              unit, keep_id))
+
+
+def cmd_export(args):
+    from kokbok import export
+
+    if args.refresh:
+        count = export.refresh_from_changes(args.directory)
+        print("%d changes applied" % count)
+    else:
+        export.export(args.directory)
+
+
+def cmd_serve(args):
+    from kokbok import api
+    api.serve(args.host, args.port, cache_entries=args.cache_entries,
+              max_age=args.max_age)
+
+
+def cmd_mealplan(args):
+    import json
+    from kokbok import mealplan
+
+    with open(args.targets, encoding='utf-8') as f:
+        targets = [mealplan.Target(**json.loads(line))
+                   for line in f if line.strip()]
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output \
+        else sys.stdout
+    started = time.time()
+    try:
+        for plan in mealplan.plan_batch(args.directory, targets,
+                                        workers=args.workers):
+            out.write(json.dumps(None if plan is None else plan._asdict()))
+            out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.time() - started
+    print("%d plans in %.1f s (%.0f plans/minute)"
+          % (len(targets), elapsed, 60 * len(targets) / max(elapsed, 1e-9)),
+          file=sys.stderr)
+
+
+def cmd_plans(args):
+    from kokbok import plans
+
+    if args.update and not args.baseline:
+        sys.exit("--update needs --baseline")
+
+    report = plans.run(args.recipes, args.threshold)
+    for (query, entry) in report.items():
+        if entry['problems'] or args.verbose:
+            print(query)
+            for step in entry['plan']:
+                print("  %(table)s: %(type)s %(key)s (%(rows)d rows)" % step)
+            for problem in entry['problems']:
+                print("  ! " + problem)
+            for suggestion in entry['suggestions']:
+                print("  + " + suggestion)
+
+    if args.update:
+        plans.save_baseline(args.baseline, report)
+        print("%d plans saved to %s" % (len(report), args.baseline))
+        return
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        baseline = plans.load_baseline(args.baseline)
+
+    failures = plans.check(report, baseline)
+    for (query, failure) in failures:
+        print("FAIL %s\n  %s" % (query, failure))
+    print("%d queries, %d failures" % (len(report), len(failures)))
+    if failures:
+        sys.exit(1)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="kokbok")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    p = commands.add_parser('init', help="create a clean database")
+    p.set_defaults(func=cmd_init)
+
+    # Arguments are parsed by kokbok.importer, see main()
+    commands.add_parser('import', help="bulk import recipes", add_help=False)
+
+    p = commands.add_parser('dump', help="write all recipes as JSON lines")
+    p.add_argument('--output', '-o', metavar='FILE')
+    p.set_defaults(func=cmd_dump)
+
+    p = commands.add_parser('export',
+                            help="write the catalogue as column files")
+    p.add_argument('directory')
+    p.add_argument('--refresh', action='store_true',
+                   help="only apply the changes since the last export")
+    p.set_defaults(func=cmd_export)
+
+    p = commands.add_parser('mealplan',
+                            help="plan meals for targets from an export")
+    p.add_argument('directory', help="the directory written by export")
+    p.add_argument('targets',
+                   help="JSON lines of mealplan.Target keyword arguments")
+    p.add_argument('--output', '-o', metavar='FILE')
+    p.add_argument('--workers', type=int,
+                   help="planning processes (default: one per CPU)")
+    p.set_defaults(func=cmd_mealplan)
+
+    p = commands.add_parser('serve', help="serve the catalogue over HTTP")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8000)
+    p.add_argument('--cache-entries', type=int, default=10000,
+                   help="serialized responses to keep in memory")
+    p.add_argument('--max-age', type=int, default=0,
+                   help="seconds clients may reuse responses for")
+    p.set_defaults(func=cmd_serve)
+
+    p = commands.add_parser('plans',
+                            help="check the query plans of the model "
+                                 "against a synthetic database")
+    p.add_argument('--recipes', type=int, default=5000)
+    p.add_argument('--threshold', type=int, default=1000,
+                   help="rows a scan or sort may touch before it fails")
+    p.add_argument('--baseline', metavar='FILE',
+                   help="JSON file of known plans to compare against")
+    p.add_argument('--update', action='store_true',
+                   help="save the plans as the new baseline")
+    p.add_argument('--verbose', '-v', action='store_true',
+                   help="show every plan, not just the bad ones")
+    p.set_defaults(func=cmd_plans)
+
+    p = commands.add_parser('bench', help="time loading recipes, one at "
+                            "a time and concurrently")
+    p.add_argument('--recipes', type=int, default=100)
+    p.add_argument('--runs', type=int, default=3)
+    p.add_argument('--workers', type=int, default=None,
+                   help="threads loading recipes concurrently to compare "
+                   "with (default: kokbok.model.LOAD_WORKERS)")
+    p.add_argument('--startup', action='store_true',
+                   help="time starting the command line tool instead")
+    p.add_argument('--matching', action='store_true',
+                   help="time matching misspelt ingredient names instead")
+    p.set_defaults(func=cmd_bench)
+
+    p = commands.add_parser('stats', help="show table sizes")
+    p.set_defaults(func=cmd_stats)
+
+    p = commands.add_parser('reindex',
+                            help="refresh index statistics, similar "
+                                 "recipes and caches")
+    p.add_argument('--full', action='store_true',
+                   help="recompute similar recipes for all recipes, "
+                        "not just the changed ones")
+    p.set_defaults(func=cmd_reindex)
+
+    p = commands.add_parser('merge-ingredients',
+                            help="merge ingredients with similar names")
+    p.add_argument('--threshold', type=similarity_threshold, default=0.85,
+                   help="name similarity (0-1) to merge at")
+    p.add_argument('--dry-run', action='store_true',
+                   help="only list the ingredients that would be merged")
+    p.set_defaults(func=cmd_merge_ingredients)
+
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv[:1] == ['import']:
+        cmd_import(argv[1:])
+        return
+
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        sys.exit(2)
+
+    args.func(args)
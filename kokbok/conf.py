@@ -21,3 +21,80 @@ def get_db_conf():
         dbconf['passwd'] = password
 
     return dbconf
+
+
+def get_picture_dir():
+    """
+    Return the directory pictures are stored in, from KOK_PICTURE_DIR.
+    """
+
+    return os.getenv('KOK_PICTURE_DIR', 'pictures')
+
+
+def get_cache_conf():
+    """
+    Return a config dict for the shared recipe cache from
+    KOK_CACHE_PATH, KOK_CACHE_MAX_BYTES and KOK_CACHE_NAME, or None if
+    KOK_CACHE_PATH is not set.
+    """
+
+    path = os.getenv('KOK_CACHE_PATH', None)
+    if not path:
+        return None
+
+    cacheconf = {"path": path}
+
+    max_bytes = os.getenv('KOK_CACHE_MAX_BYTES', None)
+    if max_bytes:
+        cacheconf['max_bytes'] = int(max_bytes)
+
+    name = os.getenv('KOK_CACHE_NAME', None)
+    if name:
+        cacheconf['name'] = name
+
+    return cacheconf
+
+
+def get_replica_confs():
+    """
+    Return a list of config dicts, one per read replica listed in
+    KOK_DB_REPLICAS as comma-separated host[:port] pairs. Replicas use
+    the same database name and credentials as the primary.
+    """
+
+    replicas = []
+
+    for replica in os.getenv('KOK_DB_REPLICAS', '').split(','):
+        if not replica.strip():
+            continue
+
+        replicaconf = get_db_conf()
+        host, _, port = replica.strip().partition(':')
+        replicaconf['host'] = host
+        if port:
+            replicaconf['port'] = int(port)
+        else:
+            replicaconf.pop('port', None)
+        replicas.append(replicaconf)
+
+    return replicas
+
+
+def get_routing_conf():
+    """
+    Return the read routing settings from KOK_DB_REPLICA_STRATEGY
+    ("round-robin" or "least-loaded") and KOK_DB_REPLICA_MAX_LAG (in
+    seconds), as keyword arguments for kokbok.routing.ReplicaRouter.
+    """
+
+    routingconf = {}
+
+    strategy = os.getenv('KOK_DB_REPLICA_STRATEGY', None)
+    max_lag = os.getenv('KOK_DB_REPLICA_MAX_LAG', None)
+
+    if strategy:
+        routingconf['strategy'] = strategy
+    if max_lag:
+        routingconf['max_lag'] = float(max_lag)
+
+    return routingconf
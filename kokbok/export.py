@@ -0,0 +1,492 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from kokbok.changes import ChangeFeed, settled_position
+from kokbok.model import Unit, connect_read
+
+
+# Marks a column of strings, stored as UTF-8 bytes in <name>.strings and
+# the offsets of each string in them in <name>.offsets.npy
+STRING = 'string'
+
+# Unit codes in the edge table's unit column; -1 is no unit
+UNITS = [Unit.G, Unit.ML, Unit.PCS]
+
+# Nullable numbers are exported as floats, with NaN for NULL
+TABLES = {
+    'ingredient': {
+        'query': """SELECT ID, Name, Price, Energy, Fat, Protein,
+        Carbohydrate, GramsPerMilliliter, GramsPerUnit FROM Ingredient""",
+        'key': 'ID',
+        'columns': [('id', np.int64), ('name', STRING),
+                    ('price', np.float64), ('energy', np.float64),
+                    ('fat', np.float64), ('protein', np.float64),
+                    ('carbohydrate', np.float64),
+                    ('grams_per_ml', np.float64),
+                    ('grams_per_unit', np.float64)],
+        'order': ['id'],
+    },
+    'recipe': {
+        'query': """SELECT ID, Title, CookingTimePrepMinutes,
+        CookingTimeCookMinutes, Servings, Version, KcalPerServing
+        FROM Recipe""",
+        'key': 'ID',
+        'columns': [('id', np.int64), ('title', STRING),
+                    ('prep_minutes', np.float64),
+                    ('cook_minutes', np.float64),
+                    ('servings', np.float64), ('version', np.float64),
+                    ('kcal_per_serving', np.float64)],
+        'order': ['id'],
+    },
+    # IngredientList_Ingredient, keyed by recipe
+    'edge': {
+        'query': """SELECT IL.RecipeID, IL.ID, ILI.IngredientID,
+        ILI.Magnitude, ILI.Unit
+        FROM IngredientList AS IL
+        JOIN IngredientList_Ingredient AS ILI
+        ON ILI.IngredientListID = IL.ID""",
+        'key': 'IL.RecipeID',
+        'columns': [('recipe_id', np.int64), ('list_id', np.int64),
+                    ('ingredient_id', np.int64), ('quantity', np.float64),
+                    ('unit', np.int8)],
+        'order': ['recipe_id', 'list_id', 'ingredient_id'],
+    },
+}
+
+# IDs per query when reading changed rows, and per page when reading all
+FETCH_BATCH_SIZE = 1000
+
+CURRENT = 'CURRENT'
+MANIFEST = 'manifest.json'
+
+# The change feed consumer refresh_from_changes() checkpoints as
+CONSUMER = 'export'
+
+
+def member(values, ids):
+    """
+    Return a boolean array telling which of values are in ids.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    ids = np.unique(np.asarray(list(ids), dtype=np.int64))
+    if not len(ids):
+        return np.zeros(len(values), dtype=bool)
+
+    positions = np.minimum(np.searchsorted(ids, values), len(ids) - 1)
+    return ids[positions] == values
+
+
+def encode_strings(strings):
+    """
+    Return (data, offsets) for a string column of strings.
+    """
+    encoded = [s.encode('utf-8') if s is not None else b"" for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = b"".join(encoded)
+    if not data:
+        return (np.zeros(0, dtype=np.uint8), offsets)
+    return (np.frombuffer(data, dtype=np.uint8), offsets)
+
+
+def take_strings(data, offsets, rows):
+    """
+    Return (data, offsets) for the strings at rows of a string column,
+    copying the bytes without decoding them.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+
+    # Position in data of every byte of the result
+    shift = np.repeat(starts - new_offsets[:-1], lengths)
+    return (data[np.arange(new_offsets[-1]) + shift], new_offsets)
+
+
+class StringColumn():
+    """
+    A read-only column of strings, decoded on access.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return bytes(self.data[self.offsets[row]:self.offsets[row + 1]]) \
+            .decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def build(table, rows):
+    """
+    Return the columns (a dict of arrays, and (data, offsets) for string
+    columns) of table for rows as read by its query.
+    """
+    columns = {}
+    for i, (name, dtype) in enumerate(TABLES[table]['columns']):
+        values = [row[i] for row in rows]
+        if dtype == STRING:
+            columns[name] = encode_strings(values)
+        elif name == 'unit':
+            columns[name] = np.array([UNITS.index(v) if v in UNITS else -1
+                                      for v in values], dtype=dtype)
+        elif dtype == np.float64:
+            columns[name] = np.array([np.nan if v is None else v
+                                      for v in values], dtype=dtype)
+        else:
+            columns[name] = np.array(values, dtype=dtype)
+    return columns
+
+
+def take(table, columns, rows):
+    """
+    Return the rows at rows (an index array) of the columns of table.
+    """
+    result = {}
+    for (name, dtype) in TABLES[table]['columns']:
+        if dtype == STRING:
+            result[name] = take_strings(columns[name][0], columns[name][1],
+                                        rows)
+        else:
+            result[name] = np.asarray(columns[name])[rows]
+    return result
+
+
+def concat(table, first, second):
+    """
+    Return the rows of first followed by those of second, in table
+    order.
+    """
+    result = {}
+    for (name, dtype) in TABLES[table]['columns']:
+        if dtype == STRING:
+            (data1, offsets1) = first[name]
+            (data2, offsets2) = second[name]
+            result[name] = (np.concatenate([data1, data2]),
+                            np.concatenate([offsets1[:-1],
+                                            offsets2 + offsets1[-1]]))
+        else:
+            result[name] = np.concatenate([first[name], second[name]])
+
+    order = np.lexsort([result[name] for name
+                        in reversed(TABLES[table]['order'])])
+    return take(table, result, order)
+
+
+def merge(table, old, new, changed_ids):
+    """
+    Return the columns of table with the rows of old for changed_ids
+    (recipe IDs for edges) replaced by the rows in new.
+    """
+    key = TABLES[table]['columns'][0][0]
+    keep = np.nonzero(~member(old[key], changed_ids))[0]
+    return concat(table, take(table, old, keep), new)
+
+
+def same_column(old, new):
+    """
+    Return whether the columns old and new (arrays, or (data, offsets)
+    for strings) are equal, NaN included.
+    """
+    if isinstance(old, tuple):
+        return all(same_column(o, n) for (o, n) in zip(old, new))
+    if old is new:
+        return True
+
+    old = np.asarray(old)
+    new = np.asarray(new)
+    if old.shape != new.shape or old.dtype != new.dtype:
+        return False
+    equal = old == new
+    if old.dtype.kind == 'f':
+        equal |= np.isnan(old) & np.isnan(new)
+    return bool(equal.all())
+
+
+def link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def write_columns(directory, table, columns, previous=None):
+    """
+    Write the columns of table to directory. previous is (directory,
+    columns) of an earlier generation: the files of the columns that are
+    the same in it are linked instead of written.
+    """
+    for (name, dtype) in TABLES[table]['columns']:
+        filename = table + '.' + name
+        path = os.path.join(directory, filename)
+
+        if previous is not None and same_column(previous[1][name],
+                                                columns[name]):
+            for suffix in (['.strings', '.offsets.npy'] if dtype == STRING
+                           else ['.npy']):
+                link_or_copy(os.path.join(previous[0], filename + suffix),
+                             path + suffix)
+        elif dtype == STRING:
+            (data, offsets) = columns[name]
+            with open(path + '.strings', 'wb') as f:
+                f.write(np.asarray(data, dtype=np.uint8).tobytes())
+            np.save(path + '.offsets.npy', offsets)
+        else:
+            np.save(path + '.npy', columns[name])
+
+
+def load_array(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # Empty arrays can't be mapped
+        return np.load(path)
+
+
+def load_bytes(path):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def read_columns(directory, table):
+    columns = {}
+    for (name, dtype) in TABLES[table]['columns']:
+        path = os.path.join(directory, table + '.' + name)
+        if dtype == STRING:
+            columns[name] = (load_bytes(path + '.strings'),
+                             load_array(path + '.offsets.npy'))
+        else:
+            columns[name] = load_array(path + '.npy')
+    return columns
+
+
+def current_generation(path):
+    try:
+        with open(os.path.join(path, CURRENT)) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_generation(path, tables, position, previous=None):
+    """
+    Write tables (a dict of table name to columns) as a new generation
+    of the export in path and make it the current one. Readers that
+    have the previous generation open keep reading it.
+
+    previous is the Catalogue the tables were derived from; the columns
+    that are the same as in it are linked to its files, not written.
+    """
+    current = current_generation(path)
+    generation = 1 if current is None else current + 1
+    directory = os.path.join(path, str(generation))
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    for (table, columns) in tables.items():
+        write_columns(directory, table, columns,
+                      None if previous is None else
+                      (previous.directory, previous.table(table)))
+
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump({'position': position,
+                   'rows': dict((table, len(columns[TABLES[table]
+                                                    ['columns'][0][0]]))
+                                for (table, columns) in tables.items())}, f)
+
+    tmp = os.path.join(path, CURRENT + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(str(generation))
+    os.replace(tmp, os.path.join(path, CURRENT))
+
+    # Keep the previous generation for readers that just opened it
+    for name in os.listdir(path):
+        if name.isdigit() and int(name) < generation - 1:
+            shutil.rmtree(os.path.join(path, name))
+
+
+class Catalogue():
+    """
+    The current generation of an export, memory-mapped. Number columns
+    are read-only NumPy arrays; string columns are StringColumns. The
+    tables are sorted by ID, and the edges by recipe, list and
+    ingredient ID, so rows are found by binary search:
+
+    .. code-block:: python
+
+        catalogue = Catalogue("export")
+        kcal = catalogue.column('recipe', 'kcal_per_serving')
+        ingredients = catalogue.column('edge', 'ingredient_id')[
+            catalogue.edges(recipe_id)]
+    """
+
+    def __init__(self, path):
+        generation = current_generation(path)
+        if generation is None:
+            raise FileNotFoundError("no export in %s" % path)
+
+        self.directory = os.path.join(path, str(generation))
+        with open(os.path.join(self.directory, MANIFEST)) as f:
+            manifest = json.load(f)
+
+        self.position = manifest['position']
+        self.rows = manifest['rows']
+        self._tables = {}
+
+    def table(self, table):
+        """
+        Return the columns of table as in build().
+        """
+        if table not in self._tables:
+            self._tables[table] = read_columns(self.directory, table)
+        return self._tables[table]
+
+    def column(self, table, name):
+        column = self.table(table)[name]
+        if isinstance(column, tuple):
+            return StringColumn(*column)
+        return column
+
+    def row(self, table, _id):
+        """
+        Return the row number of the object with _id in table (ingredient
+        or recipe), or None.
+        """
+        ids = self.column(table, 'id')
+        row = int(np.searchsorted(ids, _id))
+        return row if row < len(ids) and ids[row] == _id else None
+
+    def edges(self, recipe_id):
+        """
+        Return the slice of the edge table for the recipe with recipe_id.
+        """
+        recipe_ids = self.column('edge', 'recipe_id')
+        return slice(int(np.searchsorted(recipe_ids, recipe_id, 'left')),
+                     int(np.searchsorted(recipe_ids, recipe_id, 'right')))
+
+
+def fetch(table, ids):
+    """
+    Return the columns of table for the objects with ids (recipe IDs for
+    edges), read from the database.
+    """
+    ids = sorted(set(int(_id) for _id in ids))
+    rows = []
+    with connect_read() as cursor:
+        for start in range(0, len(ids), FETCH_BATCH_SIZE):
+            chunk = ids[start:start + FETCH_BATCH_SIZE]
+            cursor.execute(TABLES[table]['query'] + " WHERE " +
+                           TABLES[table]['key'] + " IN (" +
+                           ", ".join(["%s"] * len(chunk)) + ")", chunk)
+            rows.extend(cursor.fetchall())
+    return concat(table, build(table, []), build(table, rows))
+
+
+def fetch_all(table):
+    """
+    Return the columns of table (ingredient or recipe) for all rows in
+    the database, read a page of IDs at a time.
+    """
+    rows = []
+    last = 0
+    with connect_read() as cursor:
+        while True:
+            cursor.execute(TABLES[table]['query'] + " WHERE ID > %s "
+                           "ORDER BY ID LIMIT %s", [last, FETCH_BATCH_SIZE])
+            page = cursor.fetchall()
+            if not page:
+                break
+            rows.extend(page)
+            last = page[-1][0]
+    return build(table, rows)
+
+
+def export(path):
+    """
+    Export the whole catalogue to the directory path, and checkpoint
+    the CONSUMER change feed at it, so that the changes since are kept
+    for refresh_from_changes().
+    """
+    # Changes from here on are picked up by refresh_from_changes(); the
+    # ones up to a gap that may still be filled are already committed
+    position = settled_position()
+    recipes = fetch_all('recipe')
+    tables = {'ingredient': fetch_all('ingredient'),
+              'recipe': recipes,
+              'edge': fetch('edge', recipes['id'])}
+    write_generation(path, tables, position)
+    ChangeFeed(CONSUMER).reset(position)
+
+
+def refresh(path, recipe_ids=(), ingredient_ids=(), position=None):
+    """
+    Update the export in path for the recipes with recipe_ids and the
+    ingredients with ingredient_ids having been saved or deleted, only
+    reading those from the database and writing the columns they
+    change.
+    """
+    catalogue = Catalogue(path)
+    recipe_ids = set(recipe_ids)
+    ingredient_ids = set(ingredient_ids)
+
+    tables = {}
+    for (table, ids) in (('ingredient', ingredient_ids),
+                         ('recipe', recipe_ids), ('edge', recipe_ids)):
+        old = catalogue.table(table)
+        tables[table] = merge(table, old, fetch(table, ids), ids) if ids \
+            else old
+
+    write_generation(path, tables, catalogue.position if position is None
+                     else position, catalogue)
+
+
+def refresh_from_changes(path):
+    """
+    Update the export in path for the changes recorded in the change
+    outbox since it was written, and checkpoint the CONSUMER change
+    feed at them. Returns the number of changes applied.
+    """
+    position = Catalogue(path).position
+    feed = ChangeFeed(CONSUMER)
+    recipe_ids = set()
+    ingredient_ids = set()
+    count = 0
+
+    while True:
+        batch = feed.read(position)
+        if not batch:
+            break
+        for change in batch:
+            if change.entity == "Ingredient":
+                ingredient_ids.add(change.entity_id)
+            elif change.entity == "Recipe":
+                recipe_ids.add(change.entity_id)
+        count += len(batch)
+        position = batch[-1].id
+
+    # Ingredient lists are always saved along with their recipe
+    if count:
+        refresh(path, recipe_ids, ingredient_ids, position)
+        feed.commit(position)
+    return count
@@ -0,0 +1,198 @@
+import heapq
+
+
+# Upper bounds (exclusive) of the prep time buckets, in minutes
+PREP_TIME_BUCKETS = [(15, "0-15"), (30, "15-30"), (60, "30-60"),
+                     (None, "60+")]
+
+FACETS = ("category", "ingredient_category", "prep_time")
+
+
+def prep_time_bucket(minutes):
+    """
+    Return the name of the prep time bucket for minutes, or None if the
+    prep time is unknown.
+    """
+    if minutes is None:
+        return None
+
+    for (limit, name) in PREP_TIME_BUCKETS:
+        if limit is None or minutes < limit:
+            return name
+
+
+def popcount(bits):
+    return bin(bits).count("1")
+
+
+class FacetIndex():
+    """
+    An in-memory index for faceted browsing of recipes.
+
+    Every facet value has a bitmap (a Python int, one bit per recipe),
+    so that filtering and counting are a handful of AND/OR operations
+    instead of multi-join COUNT queries. Within a facet the selected
+    values are OR:ed together, and the facets are AND:ed. The bits of
+    removed recipes are reused, so the bitmaps stay as long as the
+    largest number of recipes indexed at once.
+    """
+
+    def __init__(self):
+        self._ids = []
+        self._positions = {}
+        self._free = []
+        self._all = 0
+        self._bitmaps = dict((facet, {}) for facet in FACETS)
+
+    def __len__(self):
+        return popcount(self._all)
+
+    def add(self, recipe_id, category=(), ingredient_category=(),
+            prep_time=None):
+        """
+        Add (or replace) the recipe with recipe_id.
+
+        Keyword arguments
+
+        category -- the names of the recipe's categories
+
+        ingredient_category -- the names of the categories of its
+        ingredients
+
+        prep_time -- its prep time in minutes
+        """
+        if recipe_id in self._positions:
+            self.remove(recipe_id)
+
+        if self._free:
+            position = heapq.heappop(self._free)
+            self._ids[position] = recipe_id
+        else:
+            position = len(self._ids)
+            self._ids.append(recipe_id)
+        self._positions[recipe_id] = position
+        bit = 1 << position
+        self._all |= bit
+
+        values = {"category": category,
+                  "ingredient_category": ingredient_category,
+                  "prep_time": [prep_time_bucket(prep_time)]}
+
+        for facet in FACETS:
+            bitmaps = self._bitmaps[facet]
+            for value in values[facet]:
+                if value is not None:
+                    bitmaps[value] = bitmaps.get(value, 0) | bit
+
+    def remove(self, recipe_id):
+        """
+        Remove the recipe with recipe_id, if present.
+        """
+        position = self._positions.pop(recipe_id, None)
+        if position is None:
+            return
+
+        mask = ~(1 << position)
+        self._all &= mask
+        for bitmaps in self._bitmaps.values():
+            for value in list(bitmaps):
+                bitmaps[value] &= mask
+                if not bitmaps[value]:
+                    del bitmaps[value]
+
+        self._ids[position] = None
+        heapq.heappush(self._free, position)
+
+    def _select(self, filters, skip=None):
+        bits = self._all
+
+        for (facet, values) in filters.items():
+            if facet not in self._bitmaps:
+                raise ValueError("unknown facet: %s" % facet)
+            if facet == skip or values is None:
+                continue
+            if isinstance(values, str):
+                values = [values]
+
+            selected = 0
+            for value in values:
+                selected |= self._bitmaps[facet].get(value, 0)
+            bits &= selected
+
+        return bits
+
+    def _ids_of(self, bits):
+        # Least significant bit first
+        digits = bin(bits)[:1:-1]
+        return sorted(self._ids[position]
+                      for (position, digit) in enumerate(digits)
+                      if digit == "1")
+
+    def filter(self, **filters):
+        """
+        Return the IDs of the recipes matching filters in ascending
+        order, for example
+        filter(category=["dinner"], prep_time=["0-15", "15-30"]).
+        """
+        return self._ids_of(self._select(filters))
+
+    def counts(self, **filters):
+        """
+        Return {facet: {value: count}} for every facet value, where count
+        is the number of recipes that would match if value was also
+        selected. The filters on a facet itself are ignored when
+        counting its values, so that alternatives stay visible.
+        """
+        counts = {}
+        for facet in FACETS:
+            bits = self._select(filters, skip=facet)
+            counts[facet] = dict((value, popcount(bits & bitmap))
+                                 for (value, bitmap)
+                                 in self._bitmaps[facet].items())
+        return counts
+
+    def browse(self, **filters):
+        """
+        Return (recipe IDs, facet counts) for filters.
+        """
+        return (self.filter(**filters), self.counts(**filters))
+
+    @classmethod
+    def from_db(cls):
+        """
+        Build an index of all recipes in the database.
+        """
+        from kokbok.model import connect_read
+
+        category_query = """SELECT RRC.RecipeID, RC.Name
+        FROM Recipe_RecipeCategory AS RRC JOIN RecipeCategory AS RC
+        ON RC.ID = RRC.RecipeCategoryID"""
+
+        ingredient_category_query = """SELECT DISTINCT IL.RecipeID, IC.Name
+        FROM IngredientList AS IL
+        JOIN IngredientList_Ingredient AS ILI ON ILI.IngredientListID = IL.ID
+        JOIN Ingredient_IngredientCategory AS IIC
+        ON IIC.IngredientID = ILI.IngredientID
+        JOIN IngredientCategory AS IC ON IC.ID = IIC.IngredientCategoryID"""
+
+        with connect_read() as cursor:
+            cursor.execute("SELECT ID, CookingTimePrepMinutes FROM Recipe")
+            recipes = cursor.fetchall()
+
+            categories = dict((_id, []) for (_id, _) in recipes)
+            ingredient_categories = dict((_id, []) for (_id, _) in recipes)
+
+            cursor.execute(category_query)
+            for (recipe_id, name) in cursor.fetchall():
+                categories[recipe_id].append(name)
+
+            cursor.execute(ingredient_category_query)
+            for (recipe_id, name) in cursor.fetchall():
+                ingredient_categories[recipe_id].append(name)
+
+        index = cls()
+        for (recipe_id, prep_time) in recipes:
+            index.add(recipe_id, category=categories[recipe_id],
+                      ingredient_category=ingredient_categories[recipe_id],
+                      prep_time=prep_time)
+        return index
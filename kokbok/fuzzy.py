@@ -0,0 +1,412 @@
+import collections
+import heapq
+import random
+import time
+import unicodedata
+
+from kokbok.model import (Operation, connect, connect_read,
+                          invalidate_ingredient, queue_similar_update,
+                          record_changes, update_kcal_per_serving)
+
+
+# Names at least this similar (0-1, see similarity()) are the same
+DEFAULT_THRESHOLD = 0.85
+
+# Number of best trigram candidates checked by edit distance
+CANDIDATES = 5
+
+# Rows rewritten per transaction when merging
+MERGE_BATCH_SIZE = 1000
+
+# Matches per second IngredientMatcher should manage on misspelt
+# synthetic names, see match_rate()
+MATCH_BUDGET = 2000
+
+# Made-up ingredient names for match_rate() are strung from these
+SYLLABLES = ["mjö", "vete", "rå", "gräd", "de", "fil", "ost", "smör", "kar",
+             "dem", "um", "pep", "par", "ka", "ris", "lök", "vit", "svart",
+             "röd", "grön", "mos", "sal", "la", "ta"]
+
+
+def normalise(name):
+    """
+    Return name lower-cased, without diacritics and with whitespace
+    collapsed, so that "Vetemjöl", "vetemjöl " and "vetemjol" are equal.
+    """
+    decomposed = unicodedata.normalize('NFKD', name.lower())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.split())
+
+
+def similarity_threshold(value):
+    """
+    Return value as a float, raising ValueError unless it is above 0
+    and at most 1. At 0 any two names would be the same.
+    """
+    threshold = float(value)
+    if not 0 < threshold <= 1:
+        raise ValueError("similarity threshold must be above 0 and at most "
+                         "1, not %r" % value)
+    return threshold
+
+
+def trigrams(name):
+    padded = "  " + name + " "
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def edit_distance(a, b, limit=None):
+    """
+    Return the Levenshtein distance between the strings a and b, or
+    limit + 1 if it is greater than limit. Only the diagonal band of
+    width limit is computed.
+    """
+    if len(a) < len(b):
+        (a, b) = (b, a)
+    if limit is None:
+        limit = len(a)
+    if len(a) - len(b) > limit:
+        return limit + 1
+
+    over = limit + 1
+    previous = [j if j <= limit else over for j in range(len(b) + 1)]
+
+    for i, ca in enumerate(a, start=1):
+        current = [over] * (len(b) + 1)
+        current[0] = i if i <= limit else over
+        row_min = current[0]
+
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            value = previous[j - 1] + (ca != b[j - 1])
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if value > over:
+                value = over
+            current[j] = value
+            if value < row_min:
+                row_min = value
+
+        if row_min > limit:
+            return over
+        previous = current
+
+    return previous[-1]
+
+
+def similarity(a, b, threshold=0.0):
+    """
+    Return how similar the normalised names a and b are, from 0 to 1 (1
+    minus their edit distance relative to the longest). Below threshold
+    the result is only known to be below threshold.
+    """
+    longest = max(len(a), len(b))
+    if longest == 0:
+        return 1.0
+
+    limit = int((1 - threshold) * longest)
+    return 1.0 - float(edit_distance(a, b, limit)) / longest
+
+
+class IngredientMatcher():
+    """
+    Resolve ingredient names to existing ingredients, tolerating case,
+    whitespace, diacritics and small misspellings.
+
+    Exact matches of the normalised name are a dict lookup. Otherwise,
+    since every edit changes at most three trigrams, a name within the
+    allowed number of edits must share at least one of the query's
+    3 * edits + 1 rarest trigrams. Only names found through those in an
+    index from trigrams to names are considered, and the few sharing
+    the most trigrams with the query are compared by edit distance.
+
+    The threshold must be above 0 and at most 1, see
+    similarity_threshold().
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = similarity_threshold(threshold)
+        self._ids = {}
+        self._names = []
+        self._name_trigrams = []
+        self._trigrams = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, name, _id):
+        """
+        Add the ingredient name with _id. The first ID added for a
+        normalised name is kept.
+        """
+        key = normalise(name)
+        if key in self._ids:
+            return
+
+        self._ids[key] = _id
+        position = len(self._names)
+        self._names.append(key)
+        self._name_trigrams.append(trigrams(key))
+        for trigram in self._name_trigrams[position]:
+            self._trigrams[trigram].append(position)
+
+    def match(self, name):
+        """
+        Return (ID, score) for the ingredient best matching name, or
+        None if none is at least threshold similar.
+        """
+        key = normalise(name)
+        if key in self._ids:
+            return (self._ids[key], 1.0)
+
+        if not key or not self._names:
+            return None
+
+        # Names may be up to 1/threshold times longer than key
+        max_edits = int((1 - self.threshold) * len(key) / self.threshold)
+        query = trigrams(key)
+        rarest = sorted(query, key=lambda t: len(self._trigrams.get(t, ())))
+
+        candidates = set()
+        for trigram in rarest[:3 * max_edits + 1]:
+            candidates.update(self._trigrams.get(trigram, ()))
+
+        shared = [(len(query & self._name_trigrams[position]), position)
+                  for position in candidates
+                  if abs(len(self._names[position]) - len(key)) <= max_edits]
+
+        best = None
+        for (_, position) in heapq.nlargest(CANDIDATES, shared):
+            candidate = self._names[position]
+            score = similarity(key, candidate, self.threshold)
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (self._ids[candidate], score)
+
+        return best
+
+    @classmethod
+    def from_db(cls, threshold=DEFAULT_THRESHOLD):
+        """
+        Return a matcher for all ingredients in the database.
+        """
+        matcher = cls(threshold)
+        with connect_read() as cursor:
+            cursor.execute("SELECT ID, Name FROM Ingredient ORDER BY ID")
+            for (_id, name) in cursor.fetchall():
+                matcher.add(name, _id)
+        return matcher
+
+
+def synthetic_names(count, rng):
+    """
+    Return a sorted list of count distinct made-up ingredient names,
+    drawn with the random.Random rng.
+    """
+    names = set()
+    while len(names) < count:
+        names.add(" ".join("".join(rng.choice(SYLLABLES)
+                                   for _ in range(rng.randint(2, 4)))
+                           for _ in range(rng.randint(1, 2))))
+    return sorted(names)
+
+
+def misspell(name, rng):
+    """
+    Return name with one letter replaced, or upper-cased if it is too
+    short for a typo to stay within DEFAULT_THRESHOLD.
+    """
+    if len(name) <= 7:
+        return name.upper()
+    i = rng.randrange(len(name))
+    return name[:i] + "x" + name[i + 1:]
+
+
+def match_rate(names=5000, queries=1000, seed=4711):
+    """
+    Return (matches per second, share of queries matched) for looking
+    up queries misspelt names in a matcher of names synthetic_names().
+    """
+    rng = random.Random(seed)
+    known = synthetic_names(names, rng)
+    matcher = IngredientMatcher()
+    for (n, name) in enumerate(known):
+        matcher.add(name, n)
+    misspelt = [misspell(name, rng) for name in rng.sample(known, queries)]
+
+    started = time.time()
+    matched = [matcher.match(query) for query in misspelt]
+    elapsed = time.time() - started
+
+    return (len(misspelt) / elapsed,
+            sum(m is not None for m in matched) / float(len(misspelt)))
+
+
+def find_duplicates(threshold=DEFAULT_THRESHOLD):
+    """
+    Return [(ID to keep, [duplicate IDs])] for the ingredients whose
+    names match an older ingredient.
+    """
+    with connect_read() as cursor:
+        cursor.execute("SELECT ID, Name FROM Ingredient ORDER BY ID")
+        ingredients = cursor.fetchall()
+
+    matcher = IngredientMatcher(threshold)
+    duplicates = collections.OrderedDict()
+
+    for (_id, name) in ingredients:
+        found = matcher.match(name)
+        if found is None:
+            matcher.add(name, _id)
+        else:
+            duplicates.setdefault(found[0], []).append(_id)
+
+    return list(duplicates.items())
+
+
+def merge_entries(cursor, keep_id, duplicate_id, limit):
+    """
+    Make up to limit ingredient list entries of duplicate_id use keep_id
+    instead, and record the changed lists and recipes. Returns (number
+    of entries, [(recipe ID, ingredient list ID, magnitude, unit)] of
+    the quantities dropped).
+
+    Where a list already has keep_id, a quantity in the same unit is
+    added to it; one in another unit is dropped.
+    """
+    cursor.execute("""SELECT D.IngredientListID, IL.RecipeID, D.Magnitude,
+    D.Unit, K.IngredientID, K.Magnitude, K.Unit
+    FROM IngredientList_Ingredient AS D
+    JOIN IngredientList AS IL ON IL.ID = D.IngredientListID
+    LEFT JOIN IngredientList_Ingredient AS K
+    ON K.IngredientListID = D.IngredientListID AND K.IngredientID = %s
+    WHERE D.IngredientID = %s
+    ORDER BY D.IngredientListID LIMIT %s FOR UPDATE""",
+                   [keep_id, duplicate_id, limit])
+    rows = cursor.fetchall()
+    if not rows:
+        return (0, [])
+
+    moved = []
+    merged = []
+    dropped = []
+    for (list_id, recipe_id, magnitude, unit,
+         kept, kept_magnitude, kept_unit) in rows:
+        if kept is None:
+            moved.append(list_id)
+        elif magnitude is None:
+            merged.append((kept_magnitude, kept_unit, list_id))
+        elif kept_magnitude is None:
+            merged.append((magnitude, unit, list_id))
+        elif unit == kept_unit:
+            merged.append((magnitude + kept_magnitude, unit, list_id))
+        else:
+            merged.append((kept_magnitude, kept_unit, list_id))
+            dropped.append((recipe_id, list_id, magnitude, unit))
+
+    if moved:
+        cursor.execute("UPDATE IngredientList_Ingredient SET IngredientID = %s"
+                       " WHERE IngredientID = %s AND IngredientListID IN (" +
+                       ", ".join(["%s"] * len(moved)) + ")",
+                       [keep_id, duplicate_id] + moved)
+    if merged:
+        cursor.executemany("UPDATE IngredientList_Ingredient "
+                           "SET Magnitude = %s, Unit = %s "
+                           "WHERE IngredientListID = %s AND IngredientID = %s",
+                           [row + (keep_id,) for row in merged])
+        cursor.executemany("DELETE FROM IngredientList_Ingredient "
+                           "WHERE IngredientListID = %s AND IngredientID = %s",
+                           [(list_id, duplicate_id)
+                            for (_, _, list_id) in merged])
+
+    list_ids = [row[0] for row in rows]
+    recipe_ids = sorted(set(row[1] for row in rows))
+    update_kcal_per_serving(cursor, recipe_ids)
+    queue_similar_update(cursor, recipe_ids)
+    record_changes(cursor, "IngredientList", list_ids, Operation.UPDATE)
+    record_changes(cursor, "Recipe", recipe_ids, Operation.UPDATE)
+
+    return (len(rows), dropped)
+
+
+def merge_categories(cursor, keep_id, duplicate_id, limit):
+    """
+    Move up to limit categories of duplicate_id to keep_id, and record
+    the changed ingredients and the recipes using them. Returns (number
+    of categories, []), like merge_entries().
+    """
+    cursor.execute("SELECT IngredientCategoryID "
+                   "FROM Ingredient_IngredientCategory WHERE IngredientID = %s"
+                   " ORDER BY IngredientCategoryID LIMIT %s FOR UPDATE",
+                   [duplicate_id, limit])
+    batch = [key for (key,) in cursor.fetchall()]
+    if not batch:
+        return (0, [])
+
+    where = (" WHERE IngredientID = %s AND IngredientCategoryID IN (" +
+             ", ".join(["%s"] * len(batch)) + ")")
+    cursor.execute("UPDATE IGNORE Ingredient_IngredientCategory "
+                   "SET IngredientID = %s" + where,
+                   [keep_id, duplicate_id] + batch)
+    added = cursor.rowcount
+    # Rows left over are where keep_id already had the category
+    cursor.execute("DELETE FROM Ingredient_IngredientCategory" + where,
+                   [duplicate_id] + batch)
+
+    record_changes(cursor, "Ingredient", [duplicate_id], Operation.UPDATE)
+    if added:
+        cursor.execute("SELECT DISTINCT IL.RecipeID "
+                       "FROM IngredientList_Ingredient AS ILI "
+                       "JOIN IngredientList AS IL "
+                       "ON IL.ID = ILI.IngredientListID "
+                       "WHERE ILI.IngredientID IN (%s, %s)",
+                       [keep_id, duplicate_id])
+        recipe_ids = sorted(_id for (_id,) in cursor.fetchall())
+        record_changes(cursor, "Ingredient", [keep_id], Operation.UPDATE)
+        record_changes(cursor, "Recipe", recipe_ids, Operation.UPDATE)
+
+    return (len(batch), [])
+
+
+def merge_ingredients(keep_id, duplicate_ids, batch_size=MERGE_BATCH_SIZE):
+    """
+    Make every ingredient list and category using one of duplicate_ids
+    use keep_id instead, and delete the duplicates. References are
+    rewritten batch_size rows per transaction, to keep lock times short,
+    and the changes to each batch are recorded in its transaction.
+
+    Returns the quantities that couldn't be merged into an entry of
+    keep_id in the same list, see merge_entries().
+    """
+    dropped = []
+
+    for duplicate_id in duplicate_ids:
+        for merge in (merge_entries, merge_categories):
+            count = batch_size
+            while count == batch_size:
+                with connect() as cursor:
+                    (count, lost) = merge(cursor, keep_id, duplicate_id,
+                                          batch_size)
+                dropped.extend(lost)
+
+        with connect() as cursor:
+            # Nothing can start using the duplicate while it is locked,
+            # so this catches what was added since the batches read
+            cursor.execute("SELECT ID FROM Ingredient WHERE ID = %s "
+                           "FOR UPDATE", [duplicate_id])
+            for merge in (merge_entries, merge_categories):
+                count = batch_size
+                while count == batch_size:
+                    (count, lost) = merge(cursor, keep_id, duplicate_id,
+                                          batch_size)
+                    dropped.extend(lost)
+
+            cursor.execute("DELETE FROM Ingredient WHERE ID = %s",
+                           [duplicate_id])
+            record_changes(cursor, "Ingredient", [duplicate_id],
+                           Operation.DELETE)
+
+        invalidate_ingredient(duplicate_id)
+    invalidate_ingredient(keep_id)
+
+    return dropped
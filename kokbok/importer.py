@@ -0,0 +1,497 @@
+import argparse
+import concurrent.futures
+import json
+import sys
+import threading
+import time
+
+from kokbok.fuzzy import (IngredientMatcher, DEFAULT_THRESHOLD,
+                          similarity_threshold)
+from kokbok.model import (Operation, connect, driver, ids_by_name,
+                          record_changes, update_kcal_per_serving)
+
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_CONNECTIONS = 4
+
+# Rows per multi-row INSERT of rows whose IDs are needed
+INSERT_CHUNK = 1000
+
+# Times to retry a batch that was picked as a deadlock victim
+DEADLOCK_RETRIES = 3
+ER_LOCK_DEADLOCK = 1213
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+def parse_file(path):
+    """
+    Parse a file of recipes to import and return them as a list of
+    dicts. The file has one JSON object per line, for example:
+
+    .. code-block:: json
+
+        {"title": "bread", "servings": 4, "cook_time_prep": 30,
+         "cook_time_cook": 30, "description": "Jättegott bröd",
+         "author": "Albin Stjerna", "categories": ["bröd"],
+         "instructions": ["Blanda mjöl", "sätt på ugnen", "klart!"],
+         "ingredients": [{"title": "",
+                          "ingredients": [{"name": "vetemjöl",
+                                           "quantity": 500, "unit": "g",
+                                           "prepnotes": null}]}]}
+
+    Only title is required.
+    """
+    recipes = []
+
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                recipe = json.loads(line)
+            except ValueError as e:
+                raise ImportFormatError("%s:%d: %s" % (path, line_no, e))
+
+            if not isinstance(recipe, dict) or not recipe.get('title'):
+                raise ImportFormatError("%s:%d: recipe has no title"
+                                        % (path, line_no))
+
+            recipes.append(normalise(recipe))
+
+    return recipes
+
+
+def normalise(recipe):
+    """
+    Fill in defaults for the optional fields of a parsed recipe.
+    """
+    return {'title': recipe['title'],
+            'servings': recipe.get('servings'),
+            'cook_time_prep': recipe.get('cook_time_prep'),
+            'cook_time_cook': recipe.get('cook_time_cook'),
+            'description': recipe.get('description'),
+            'version': recipe.get('version', 1),
+            'author': recipe.get('author'),
+            'categories': recipe.get('categories') or [],
+            'instructions': recipe.get('instructions') or [],
+            'ingredients': [{'title': il.get('title', ''),
+                             'ingredients': [{'name': i['name'].strip(),
+                                              'quantity': i.get('quantity'),
+                                              'unit': i.get('unit'),
+                                              'prepnotes': i.get('prepnotes')}
+                                             for i in il.get('ingredients',
+                                                             [])]}
+                            for il in recipe.get('ingredients') or []]}
+
+
+def dump_recipe(recipe):
+    """
+    Return recipe (a model.Recipe) as a dict in the format read by
+    parse_file().
+    """
+    return {'title': recipe.title,
+            'servings': recipe.servings,
+            'cook_time_prep': recipe.cook_time_prep,
+            'cook_time_cook': recipe.cook_time_cook,
+            'description': recipe.description,
+            'version': recipe.version,
+            'author': recipe.author,
+            'categories': list(recipe.categories),
+            'instructions': list(recipe.instructions),
+            'ingredients': [{'title': il.title,
+                             'ingredients': [{'name': i['ingredient'].name,
+                                              'quantity': i['quantity'],
+                                              'unit': i['unit'],
+                                              'prepnotes': i['prepnotes']}
+                                             for i in il.ingredients]}
+                            for il in recipe.ingredient_lists]}
+
+
+def chunks(items, size):
+    """
+    Yield successive lists of at most size items from items.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def insert_rows(cursor, table, columns, rows, increment=1):
+    """
+    Insert rows (tuples of values for columns) into table with multi-row
+    INSERTs and return their AUTO_INCREMENT IDs, in order.
+
+    A multi-row INSERT ... VALUES is a "simple insert", for which InnoDB
+    reserves all the IDs at once, so they are consecutive (in steps of
+    auto_increment_increment, passed as increment) in every
+    innodb_autoinc_lock_mode, and start at lastrowid.
+    """
+    values = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    ids = []
+    for chunk in chunks(rows, INSERT_CHUNK):
+        cursor.execute("INSERT INTO " + table + " (" + ", ".join(columns) +
+                       ") VALUES " + ", ".join([values] * len(chunk)),
+                       [value for row in chunk for value in row])
+        if cursor.rowcount != len(chunk):
+            raise RuntimeError("inserted %d rows into %s instead of %d"
+                               % (cursor.rowcount, table, len(chunk)))
+        first = cursor.lastrowid
+        ids.extend(range(first, first + len(chunk) * increment, increment))
+    return ids
+
+
+class ImportStats():
+
+    def __init__(self):
+        self.files = 0
+        self.recipes = 0
+        self.started = time.time()
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        """
+        Recipes imported per second.
+        """
+        elapsed = self.seconds or (time.time() - self.started)
+        return self.recipes / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return ("%d recipes from %d files in %.1f s (%.0f recipes/s)"
+                % (self.recipes, self.files, self.seconds, self.rate))
+
+
+class Importer():
+
+    def __init__(self, workers=None, connections=DEFAULT_CONNECTIONS,
+                 batch_size=DEFAULT_BATCH_SIZE, create_ingredients=True,
+                 match_threshold=DEFAULT_THRESHOLD, progress=None):
+        """
+        Import recipes in bulk
+
+        Keyword arguments
+
+        workers -- the number of processes parsing input files (default:
+        one per CPU)
+
+        connections -- the number of database connections writing
+        recipes concurrently
+
+        batch_size -- the number of recipes written per transaction
+
+        create_ingredients -- whether to create ingredients that aren't
+        in the database (with unknown nutrition); otherwise importing a
+        recipe using one fails with KeyError
+
+        match_threshold -- how similar (0-1) an ingredient name must be
+        to an existing one to be taken as the same ingredient, see
+        kokbok.fuzzy; 1 only allows differences in case, whitespace and
+        diacritics
+
+        progress -- if given, called with the ImportStats after each
+        batch
+        """
+        self.workers = workers
+        self.connections = connections
+        self.batch_size = batch_size
+        self.create_ingredients = create_ingredients
+        self.match_threshold = similarity_threshold(match_threshold)
+        self.progress = progress
+
+        self._local = threading.local()
+        self._all_connections = []
+        self._lock = threading.Lock()
+        self._ingredient_ids = {}
+        self._author_ids = {}
+        self._category_ids = {}
+        self._matcher = None
+
+    def run(self, paths):
+        """
+        Import the recipes in the files at paths and return ImportStats.
+        """
+        stats = ImportStats()
+
+        parsers = concurrent.futures.ProcessPoolExecutor(self.workers)
+        writers = concurrent.futures.ThreadPoolExecutor(self.connections)
+        with parsers, writers:
+            pending = set()
+
+            def collect(done):
+                for future in done:
+                    stats.recipes += future.result()
+                    if self.progress:
+                        self.progress(stats)
+
+            for recipes in parsers.map(parse_file, paths):
+                stats.files += 1
+
+                for batch in chunks(recipes, self.batch_size):
+                    # Don't parse ahead much further than we can write
+                    if len(pending) >= 2 * self.connections:
+                        done, pending = concurrent.futures.wait(
+                            pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                        collect(done)
+
+                    pending.add(writers.submit(self.write_batch, batch))
+
+            collect(concurrent.futures.wait(pending).done)
+
+        self.close()
+
+        stats.seconds = time.time() - stats.started
+        return stats
+
+    def close(self):
+        """
+        Close the database connections of the writers.
+        """
+        with self._lock:
+            for conn in self._all_connections:
+                conn.close()
+            self._all_connections = []
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = connect()
+            conn.autocommit(False)
+            cursor = conn.cursor()
+            cursor.execute("SELECT @@auto_increment_increment")
+            (self._local.increment,) = cursor.fetchone()
+            cursor.close()
+            self._local.conn = conn
+            with self._lock:
+                self._all_connections.append(conn)
+        return conn
+
+    def _resolve(self, cursor, cache, table, names, create, inserted=None):
+        """
+        Return a dict of the IDs of names in table (Ingredient, Author or
+        RecipeCategory), looking up the ones not already in cache, and
+        add the IDs of the rows created for them to the set inserted.
+        """
+        with self._lock:
+            missing = sorted(set(n for n in names if n not in cache))
+
+        for chunk in chunks(missing, INSERT_CHUNK):
+            count = 0
+            if create:
+                cursor.execute("INSERT IGNORE INTO " + table +
+                               " (Name) VALUES " +
+                               ", ".join(["(%s)"] * len(chunk)), chunk)
+                (count, first) = (cursor.rowcount, cursor.lastrowid)
+
+            found = ids_by_name(cursor, table, chunk)
+            if count and inserted is not None:
+                # The IDs reserved for the INSERT (see insert_rows())
+                # start at or before the first one it used, and the rows
+                # created since have larger ones
+                inserted.update(sorted(_id for _id in set(found.values())
+                                       if _id >= first)[:count])
+            with self._lock:
+                cache.update(found)
+
+        with self._lock:
+            return dict((n, cache[n]) for n in names if n in cache)
+
+    def _resolve_ingredients(self, cursor, names):
+        """
+        Return a dict of the IDs of the ingredients named names, matching
+        them against the existing ingredients with an IngredientMatcher
+        and creating the rest (once per group of similar names).
+        """
+        with self._lock:
+            if self._matcher is None:
+                self._matcher = IngredientMatcher.from_db(self.match_threshold)
+
+            ids = {}
+            new_names = IngredientMatcher(self.match_threshold)
+            aliases = {}
+            for name in set(names):
+                found = self._matcher.match(name)
+                if found is not None:
+                    ids[name] = found[0]
+                    continue
+
+                # Similar new names in the batch become one ingredient
+                alias = new_names.match(name)
+                if alias is None:
+                    new_names.add(name, name)
+                    aliases[name] = name
+                else:
+                    aliases[name] = alias[0]
+
+        if aliases:
+            inserted = set()
+            created = self._resolve(cursor, self._ingredient_ids,
+                                    "Ingredient", set(aliases.values()),
+                                    self.create_ingredients, inserted)
+            # Names resolved to existing rows aren't changes
+            if inserted:
+                record_changes(cursor, "Ingredient", sorted(inserted),
+                               Operation.INSERT)
+            with self._lock:
+                for (name, _id) in created.items():
+                    self._matcher.add(name, _id)
+
+            for (name, alias) in aliases.items():
+                if alias in created:
+                    ids[name] = created[alias]
+
+        return ids
+
+    def resolve_names(self, batch):
+        """
+        Return (ingredient IDs, author IDs, category IDs) by name for the
+        recipes in batch, in their own short transaction.
+        """
+        ingredient_names = [i['name'] for recipe in batch
+                            for il in recipe['ingredients']
+                            for i in il['ingredients']]
+        author_names = [r['author'] for r in batch if r['author']]
+        category_names = [c for r in batch for c in r['categories']]
+
+        conn = self._connection()
+        cursor = conn.cursor()
+        try:
+            ingredients = self._resolve_ingredients(cursor, ingredient_names)
+            authors = self._resolve(cursor, self._author_ids, "Author",
+                                    author_names, True)
+            categories = self._resolve(cursor, self._category_ids,
+                                       "RecipeCategory", category_names, True)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        return (ingredients, authors, categories)
+
+    def write_batch(self, batch):
+        """
+        Write the recipes in batch in a single transaction and return
+        the number of recipes written.
+        """
+        (ingredients, authors, categories) = self.resolve_names(batch)
+
+        for attempt in range(DEADLOCK_RETRIES + 1):
+            conn = self._connection()
+            cursor = conn.cursor()
+            try:
+                self._write(cursor, batch, ingredients, authors, categories)
+                conn.commit()
+                return len(batch)
+            except driver().OperationalError as e:
+                conn.rollback()
+                if (e.args[0] != ER_LOCK_DEADLOCK or
+                        attempt == DEADLOCK_RETRIES):
+                    raise
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def _write(self, cursor, batch, ingredients, authors, categories):
+        increment = self._local.increment
+        recipe_ids = insert_rows(
+            cursor, "Recipe", ["Title", "CookingTimePrepMinutes",
+                               "CookingTimeCookMinutes", "Servings",
+                               "Description", "Version"],
+            [(r['title'], r['cook_time_prep'], r['cook_time_cook'],
+              r['servings'], r['description'], r['version'])
+             for r in batch], increment)
+
+        lists = [(recipe_id, il) for (recipe, recipe_id)
+                 in zip(batch, recipe_ids) for il in recipe['ingredients']]
+        list_ids = insert_rows(cursor, "IngredientList",
+                               ["Title", "RecipeID"],
+                               [(il['title'], recipe_id)
+                                for (recipe_id, il) in lists], increment)
+
+        steps = [(recipe_id, step, text) for (recipe, recipe_id)
+                 in zip(batch, recipe_ids)
+                 for (step, text) in enumerate(recipe['instructions'],
+                                               start=1)]
+        instruction_ids = insert_rows(cursor, "Instruction", ["Text"],
+                                      [(text,) for (_, _, text) in steps],
+                                      increment)
+
+        list_rows = [(list_id, ingredients[i['name']], i['prepnotes'],
+                      i['quantity'], i['unit'])
+                     for ((_, il), list_id) in zip(lists, list_ids)
+                     for i in il['ingredients']]
+        instruction_rows = [(recipe_id, instruction_id, step)
+                            for ((recipe_id, step, _), instruction_id)
+                            in zip(steps, instruction_ids)]
+        author_rows = [(authors[recipe['author']], recipe_id)
+                       for (recipe, recipe_id) in zip(batch, recipe_ids)
+                       if recipe['author']]
+        category_rows = [(recipe_id, categories[name])
+                         for (recipe, recipe_id) in zip(batch, recipe_ids)
+                         for name in set(recipe['categories'])]
+
+        # The same ingredient twice in a list keeps the first row
+        cursor.executemany("""INSERT IGNORE INTO IngredientList_Ingredient
+        (IngredientListID, IngredientID, PrepNotes, Magnitude, Unit)
+        VALUES (%s, %s, %s, %s, %s)""", list_rows)
+        cursor.executemany("INSERT INTO Recipe_Instruction "
+                           "(RecipeID, InstructionID, Step) "
+                           "VALUES (%s, %s, %s)", instruction_rows)
+        cursor.executemany("INSERT INTO Author_Recipe (AuthorID, RecipeID) "
+                           "VALUES (%s, %s)", author_rows)
+        cursor.executemany("INSERT INTO Recipe_RecipeCategory "
+                           "(RecipeID, RecipeCategoryID) VALUES (%s, %s)",
+                           category_rows)
+        update_kcal_per_serving(cursor, recipe_ids)
+        record_changes(cursor, "Recipe", recipe_ids, Operation.INSERT)
+        record_changes(cursor, "IngredientList", list_ids, Operation.INSERT)
+
+
+def print_progress(stats):
+    sys.stderr.write("\r%d recipes, %d files, %.0f recipes/s"
+                     % (stats.recipes, stats.files, stats.rate))
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import recipes from JSON lines files.")
+    parser.add_argument('paths', nargs='+', metavar='FILE')
+    parser.add_argument('--workers', type=int, default=None,
+                        help="parser processes (default: one per CPU)")
+    parser.add_argument('--connections', type=int,
+                        default=DEFAULT_CONNECTIONS,
+                        help="concurrent database connections")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="recipes per transaction")
+    parser.add_argument('--no-create-ingredients', action='store_true',
+                        help="fail on unknown ingredients")
+    parser.add_argument('--match-threshold', type=similarity_threshold,
+                        default=DEFAULT_THRESHOLD,
+                        help="similarity (0-1) for an ingredient name to "
+                             "match an existing ingredient")
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    importer = Importer(workers=args.workers, connections=args.connections,
+                        batch_size=args.batch_size,
+                        create_ingredients=not args.no_create_ingredients,
+                        match_threshold=args.match_threshold,
+                        progress=None if args.quiet else print_progress)
+    stats = importer.run(args.paths)
+
+    if not args.quiet:
+        sys.stderr.write("\n")
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
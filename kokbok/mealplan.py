@@ -0,0 +1,412 @@
+import collections
+import concurrent.futures
+
+import numpy as np
+
+from kokbok.export import UNITS, Catalogue, member
+from kokbok.model import Unit
+
+
+# Nutrients of a plan, in the order of RecipeVectors.nutrition; all but
+# energy (in kcal) are in grammes. Ingredient amounts are per 100 g.
+NUTRIENTS = ['kcal', 'protein', 'fat', 'carbohydrate']
+
+# Ingredient columns of the export the nutrients are computed from
+NUTRIENT_COLUMNS = ['energy', 'protein', 'fat', 'carbohydrate']
+
+# kcal per gramme, to weigh missed targets of different nutrients
+# against each other
+NUTRIENT_WEIGHTS = np.array([1.0, 4.0, 9.0, 4.0])
+
+# Recipes (one per meal) in a plan, e.g. a week of dinners
+DEFAULT_MEALS = 7
+
+# Most servings of one recipe in a plan
+DEFAULT_MAX_SERVINGS = 4
+
+# Candidate recipes kept per plan, the cheapest per kcal and per
+# gramme of each nutrient with a target; the search only looks at these
+POOL_SIZE = 1000
+
+# Rounds of improving moves before the search gives up
+MAX_ROUNDS = 50
+
+# Differences in violation or cost smaller than this are ties
+EPSILON = 1e-9
+
+# Targets per task when planning in several processes
+PLAN_CHUNK = 100
+
+
+Plan = collections.namedtuple('Plan', ['recipe_ids', 'servings', 'cost',
+                                       'nutrition', 'feasible'])
+
+
+class RecipeVectors():
+    """
+    The cost, nutrition and prep time of one serving of every recipe in
+    a Catalogue, as arrays indexed like its recipe table.
+
+    Ingredient prices are taken to be per 100 g, like the nutrients.
+    Recipes with an ingredient of unknown price or weight, or without
+    servings, have a NaN cost and can't be planned. As for
+    Recipe.KcalPerServing, unknown nutrients count as nothing.
+    """
+
+    def __init__(self, ids, cost, nutrition, prep_minutes):
+        """
+        Keyword arguments
+
+        ids -- the recipe IDs, sorted
+
+        cost -- the cost per serving
+
+        nutrition -- an array of (number of recipes, len(NUTRIENTS)) of
+        nutrients per serving
+
+        prep_minutes -- the preparation time of the recipes
+        """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.cost = np.asarray(cost, dtype=np.float64)
+        self.nutrition = np.asarray(nutrition, dtype=np.float64)
+        self.prep_minutes = np.asarray(prep_minutes, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_catalogue(cls, catalogue):
+        recipe_ids = catalogue.column('recipe', 'id')
+        ingredient_ids = catalogue.column('ingredient', 'id')
+        edge_recipes = catalogue.column('edge', 'recipe_id')
+        edge_ingredients = catalogue.column('edge', 'ingredient_id')
+        quantity = catalogue.column('edge', 'quantity')
+        unit = catalogue.column('edge', 'unit')
+
+        # Edges of ingredients missing from the export weigh nothing
+        rows = np.minimum(np.searchsorted(ingredient_ids, edge_ingredients),
+                          max(len(ingredient_ids) - 1, 0))
+        known = (ingredient_ids[rows] == edge_ingredients
+                 if len(ingredient_ids) else np.zeros(len(unit), dtype=bool))
+
+        def ingredient(name):
+            values = np.full(len(rows), np.nan)
+            values[known] = catalogue.column('ingredient', name)[rows[known]]
+            return values
+
+        grams = np.full(len(rows), np.nan)
+        for (code, factor) in ((UNITS.index(Unit.G), None),
+                               (UNITS.index(Unit.ML), 'grams_per_ml'),
+                               (UNITS.index(Unit.PCS), 'grams_per_unit')):
+            edges = unit == code
+            grams[edges] = quantity[edges]
+            if factor is not None:
+                grams[edges] *= ingredient(factor)[edges]
+
+        recipe_rows = np.searchsorted(recipe_ids, edge_recipes)
+        servings = catalogue.column('recipe', 'servings')
+        servings = np.where(servings > 0, servings, np.nan)
+
+        def per_serving(amounts):
+            return np.bincount(recipe_rows, weights=amounts,
+                               minlength=len(recipe_ids)) / servings / 100
+
+        price = grams * ingredient('price')
+        incomplete = np.bincount(recipe_rows, weights=np.isnan(price),
+                                 minlength=len(recipe_ids)) > 0
+        cost = per_serving(np.nan_to_num(price))
+        cost[incomplete] = np.nan
+
+        nutrition = np.column_stack(
+            [per_serving(np.nan_to_num(grams * ingredient(name)))
+             for name in NUTRIENT_COLUMNS])
+
+        return cls(recipe_ids, cost, nutrition,
+                   catalogue.column('recipe', 'prep_minutes'))
+
+
+class Target():
+
+    def __init__(self, kcal, protein=None, fat=None, carbohydrate=None,
+                 meals=DEFAULT_MEALS, max_servings=DEFAULT_MAX_SERVINGS,
+                 max_prep=None, exclude=()):
+        """
+        What a plan must meet
+
+        Keyword arguments
+
+        kcal -- (min, max) energy of the whole plan, either may be None
+
+        protein, fat, carbohydrate -- (min, max) grammes of the nutrient
+        in the whole plan, or None
+
+        meals -- the number of different recipes in the plan
+
+        max_servings -- the most servings of a recipe
+
+        max_prep -- the longest preparation time in minutes of a recipe
+
+        exclude -- IDs of recipes not to use, e.g. last week's
+        """
+        self.meals = meals
+        self.max_servings = max_servings
+        self.max_prep = max_prep
+        self.exclude = list(exclude)
+
+        bounds = [kcal, protein, fat, carbohydrate]
+        self.low = np.array([b[0] if b and b[0] is not None else -np.inf
+                             for b in bounds])
+        self.high = np.array([b[1] if b and b[1] is not None else np.inf
+                              for b in bounds])
+
+    def violation(self, nutrition):
+        """
+        Return how far the totals nutrition (with NUTRIENTS last) miss
+        the target, in kcal.
+        """
+        missed = (np.maximum(self.low - nutrition, 0) +
+                  np.maximum(nutrition - self.high, 0))
+        return np.dot(missed, NUTRIENT_WEIGHTS)
+
+
+class Planner():
+    """
+    Choose the cheapest plans of recipes and servings meeting Targets.
+
+    A plan starts from the recipes that are cheapest for their share of
+    the energy target, with servings to match. It is then improved by
+    local search: in turn, each meal is replaced by the recipe and
+    number of servings (possibly its own) that best reduce first how
+    far the plan misses its targets and then its cost, all candidates
+    at once with NumPy. When no replacement helps, the servings of one
+    meal are changed along with the replacement of another, until that
+    doesn't help either. Plans are not necessarily optimal, but a plan
+    takes milliseconds.
+    """
+
+    def __init__(self, vectors, pool_size=POOL_SIZE, max_rounds=MAX_ROUNDS):
+        self.vectors = vectors
+        self.pool_size = pool_size
+        self.max_rounds = max_rounds
+
+        self._plannable = (np.isfinite(vectors.cost) &
+                           (vectors.nutrition[:, 0] > 0))
+
+    @classmethod
+    def from_export(cls, path, **kwargs):
+        return cls(RecipeVectors.from_catalogue(Catalogue(path)), **kwargs)
+
+    def candidates(self, target):
+        """
+        Return the rows of the recipes target may use, at most
+        pool_size of them.
+        """
+        vectors = self.vectors
+        allowed = self._plannable.copy()
+        if target.max_prep is not None:
+            allowed &= ~(vectors.prep_minutes > target.max_prep)
+        if target.exclude:
+            allowed &= ~member(vectors.ids, target.exclude)
+
+        rows = np.nonzero(allowed)[0]
+        if len(rows) <= self.pool_size:
+            return rows
+
+        # The cheapest sources of each nutrient the plan needs
+        wanted = [0] + [i for i in range(1, len(NUTRIENTS))
+                        if target.low[i] > 0]
+        share = max(self.pool_size // len(wanted), 1)
+        pool = []
+        for i in wanted:
+            price = vectors.cost[rows] / np.maximum(
+                vectors.nutrition[rows, i], 1e-9)
+            pool.append(rows[np.argpartition(price, share - 1)[:share]])
+        return np.unique(np.concatenate(pool))
+
+    def plan(self, target):
+        """
+        Return a Plan for target, with feasible false if no plan found
+        meets it, or None if fewer than target.meals recipes may be
+        used.
+        """
+        rows = self.candidates(target)
+        if len(rows) < target.meals:
+            return None
+        search = _Search(self.vectors, rows, target)
+
+        for _ in range(self.max_rounds):
+            if not (search.improve() or search.improve_pairs()):
+                break
+
+        chosen = rows[search.chosen]
+        order = np.argsort(self.vectors.ids[chosen])
+        return Plan(recipe_ids=[int(_id) for _id in
+                                self.vectors.ids[chosen][order]],
+                    servings=[int(s) for s in search.servings[order]],
+                    cost=float(search.cost),
+                    nutrition=dict(zip(NUTRIENTS,
+                                       (float(t) for t in search.total))),
+                    feasible=bool(search.score[0] <= EPSILON))
+
+    def plan_many(self, targets):
+        return [self.plan(target) for target in targets]
+
+
+class _Search():
+    """
+    The state of the local search for a plan for target from the
+    recipes at rows of vectors.
+    """
+
+    def __init__(self, vectors, rows, target):
+        self.target = target
+        self.cost_per_serving = vectors.cost[rows]
+        self.nutrition = vectors.nutrition[rows]
+        self.options = np.arange(1, target.max_servings + 1)
+
+        # Every recipe in every number of servings, with the amounts of
+        # just the nutrients target bounds
+        self.option_cost = self.cost_per_serving[:, None] * self.options
+        self.bounds = [(i, target.low[i], target.high[i])
+                       for i in range(len(NUTRIENTS))
+                       if np.isfinite(target.low[i]) or
+                       np.isfinite(target.high[i])]
+        self.option_nutrition = [self.nutrition[:, i][:, None] * self.options
+                                 for (i, _, _) in self.bounds]
+
+        # Start from the recipes cheapest for their share of the energy
+        # target (or its bound), in servings to match
+        (low, high) = (target.low[0], target.high[0])
+        bounds = [b for b in (low, high) if np.isfinite(b)]
+        per_meal = sum(bounds) / len(bounds) / target.meals if bounds else 0
+        servings = np.clip(np.round(per_meal / self.nutrition[:, 0]), 1,
+                           target.max_servings).astype(np.int64)
+        self.chosen = np.argpartition(self.cost_per_serving * servings,
+                                      target.meals - 1)[:target.meals]
+        self.servings = servings[self.chosen]
+
+        self.used = np.zeros(len(rows), dtype=bool)
+        self.used[self.chosen] = True
+        self.cost = np.dot(self.cost_per_serving[self.chosen], self.servings)
+        self.total = np.dot(self.servings, self.nutrition[self.chosen])
+        self.score = (target.violation(self.total), self.cost)
+
+    def better(self, score):
+        return (score[0] < self.score[0] - EPSILON or
+                (score[0] <= self.score[0] + EPSILON and
+                 score[1] < self.score[1] - EPSILON))
+
+    def violations(self, total):
+        """
+        Return target.violation() of total plus every recipe in every
+        number of servings.
+        """
+        result = np.zeros(self.option_cost.shape)
+        for ((i, low, high), amounts) in zip(self.bounds,
+                                             self.option_nutrition):
+            totals = amounts + total[i]
+            if np.isfinite(low):
+                result += NUTRIENT_WEIGHTS[i] * np.maximum(low - totals, 0)
+            if np.isfinite(high):
+                result += NUTRIENT_WEIGHTS[i] * np.maximum(totals - high, 0)
+        return result
+
+    def best_replacement(self, meal, total, cost):
+        """
+        Return (score, row, option) for the best recipe and servings to
+        replace meal with in a plan of total nutrition and cost.
+        """
+        (row, count) = (self.chosen[meal], self.servings[meal])
+        violation = self.violations(total - self.nutrition[row] * count)
+        new_cost = self.option_cost + (cost -
+                                       self.cost_per_serving[row] * count)
+
+        # No repeats, but the meal may keep its recipe
+        own = violation[row].copy()
+        violation[self.used] = np.inf
+        violation[row] = own
+
+        least = violation.min()
+        best = np.argmin(np.where(violation <= least + EPSILON, new_cost,
+                                  np.inf))
+        (new_row, option) = np.unravel_index(best, new_cost.shape)
+        return ((least, new_cost[new_row, option]), new_row, option)
+
+    def replace(self, meal, row, option):
+        old = (self.chosen[meal], self.servings[meal])
+        new = (row, self.options[option])
+        self.total = (self.total - self.nutrition[old[0]] * old[1] +
+                      self.nutrition[new[0]] * new[1])
+        self.cost = (self.cost - self.cost_per_serving[old[0]] * old[1] +
+                     self.cost_per_serving[new[0]] * new[1])
+        self.used[old[0]] = False
+        self.used[new[0]] = True
+        (self.chosen[meal], self.servings[meal]) = new
+        self.score = (self.target.violation(self.total), self.cost)
+
+    def improve(self):
+        """
+        Replace each meal in turn by its best replacement, if better.
+        Returns whether any was.
+        """
+        improved = False
+        for meal in range(self.target.meals):
+            (score, row, option) = self.best_replacement(meal, self.total,
+                                                         self.cost)
+            if self.better(score):
+                self.replace(meal, row, option)
+                improved = True
+        return improved
+
+    def improve_pairs(self):
+        """
+        Make the first change to the servings of one meal together with
+        the best replacement of another that is better. Returns whether
+        there was one.
+        """
+        for other in range(self.target.meals):
+            (row, count) = (self.chosen[other], self.servings[other])
+            for option in range(len(self.options)):
+                change = self.options[option] - count
+                if change == 0:
+                    continue
+                total = self.total + self.nutrition[row] * change
+                cost = self.cost + self.cost_per_serving[row] * change
+
+                for meal in range(self.target.meals):
+                    if meal == other:
+                        continue
+                    (score, new_row, new_option) = self.best_replacement(
+                        meal, total, cost)
+                    if self.better(score):
+                        self.replace(other, row, option)
+                        self.replace(meal, new_row, new_option)
+                        return True
+        return False
+
+
+# Planners of the worker processes of plan_batch(), by export path
+_planners = {}
+
+
+def _plan_chunk(path, targets):
+    if path not in _planners:
+        _planners[path] = Planner.from_export(path)
+    return _planners[path].plan_many(targets)
+
+
+def plan_batch(path, targets, workers=None, chunk_size=PLAN_CHUNK):
+    """
+    Yield a Plan (or None) for each of targets, in order, planned in
+    workers processes (default: one per CPU) from the export in path.
+    Every process maps the export once and plans chunk_size targets per
+    task.
+    """
+    targets = list(targets)
+    chunks = [targets[start:start + chunk_size]
+              for start in range(0, len(targets), chunk_size)]
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for plans in pool.map(_plan_chunk, [path] * len(chunks), chunks):
+            for plan in plans:
+                yield plan
@@ -1,13 +1,390 @@
-import MySQLdb
-from _mysql_exceptions import IntegrityError, MySQLError
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import os.path
+import threading
+import time
 
 from abc import ABCMeta, abstractmethod
 
 import kokbok.conf
+from kokbok.cache import RecipeCache
+from kokbok.pictures import PictureStore
+from kokbok.routing import ReplicaRouter, replica_lag
 
 
-global dbconf
-dbconf = kokbok.conf.get_db_conf()
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'kokbok.sql')
+
+# The database config and the driver are loaded on first use, so that
+# importing this module doesn't cost anything for commands that never
+# touch the database.
+_dbconf = None
+
+
+def get_dbconf():
+    """
+    Return the database config dict, read from the environment on first
+    use (see kokbok.conf.get_db_conf()).
+    """
+    global _dbconf
+    if _dbconf is None:
+        _dbconf = kokbok.conf.get_db_conf()
+    return _dbconf
+
+
+def driver():
+    """
+    Return the MySQLdb module, importing it on first use.
+    """
+    import MySQLdb
+    return MySQLdb
+
+
+def connect(conf=None):
+    """
+    Return a new connection to the database described by conf (default:
+    the primary, from get_dbconf()). Used as a context manager it gives a
+    cursor and commits on exit.
+
+    Connecting to the primary counts as a write, and sends the current
+    thread's reads to the primary for a while (see ReplicaRouter).
+    """
+    if conf is None:
+        conf = get_dbconf()
+        replica_router().note_write()
+    return driver().connect(**conf)
+
+
+# Guards creating the shared objects below, which may first be asked
+# for by several threads at once
+_shared_lock = threading.Lock()
+
+_replica_router = None
+
+
+def replica_router():
+    """
+    Return the ReplicaRouter for the replicas in KOK_DB_REPLICAS.
+    """
+    global _replica_router
+    if _replica_router is None:
+        with _shared_lock:
+            if _replica_router is None:
+                _replica_router = ReplicaRouter(
+                    kokbok.conf.get_replica_confs(), probe=probe_replica,
+                    **kokbok.conf.get_routing_conf())
+    return _replica_router
+
+
+# Seconds to wait for a replica to accept a lag probe's connection
+PROBE_CONNECT_TIMEOUT = 2
+
+# The connections of the lag probes, by replica. Every replica is only
+# probed by one thread at a time (see ReplicaRouter).
+_probe_connections = {}
+
+
+def probe_replica(conf):
+    """
+    Return the replication lag of the replica with the config dict
+    conf, on a connection kept open between probes.
+    """
+    key = tuple(sorted(conf.items()))
+    conn = _probe_connections.get(key)
+    try:
+        if conn is None:
+            conn = driver().connect(
+                **dict(conf, connect_timeout=PROBE_CONNECT_TIMEOUT))
+            conn.autocommit(True)
+            _probe_connections[key] = conn
+        cursor = conn.cursor()
+        try:
+            return replica_lag(cursor)
+        finally:
+            cursor.close()
+    except Exception:
+        _probe_connections.pop(key, None)
+        if conn is not None:
+            conn.close()
+        raise
+
+
+@contextlib.contextmanager
+def connect_read():
+    """
+    Give a cursor for reading, on a replica if there is one that is up
+    to date enough, and on the primary otherwise. Use as:
+
+    .. code-block:: python
+
+        with connect_read() as cursor:
+            cursor.execute(...)
+
+    Inside a Session all reads go to the server picked for the
+    session's first read (or to the primary while the thread must see
+    its own writes), see read_session().
+    """
+    router = replica_router()
+    session = current_session()
+
+    if session is not None:
+        cursor = session.connection(session.read_conf(),
+                                    autocommit=True).cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+        return
+
+    index = router.acquire()
+    conf = get_dbconf() if index is None else router.replicas[index]
+    try:
+        with driver().connect(**conf) as cursor:
+            yield cursor
+    finally:
+        router.release(index)
+
+
+@contextlib.contextmanager
+def read_session():
+    """
+    Make the reads in the with block that make up one logical read go
+    to the same server, so that no part of the result is older than
+    the parts read before it. Uses the current Session, or a new one
+    for the block.
+    """
+    if current_session() is not None:
+        yield
+    else:
+        with Session():
+            yield
+
+
+@contextlib.contextmanager
+def read_snapshot():
+    """
+    Make the reads in the with block see the database as of one point
+    in time: a read_session() whose reads are made in one read-only
+    transaction.
+    """
+    with read_session():
+        session = current_session()
+        conn = session.connection(session.read_conf(), autocommit=True)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, "
+                           "READ ONLY")
+            yield
+        finally:
+            cursor.close()
+            conn.rollback()
+
+
+def primary_reads():
+    """
+    Return a context manager within which the current thread reads from
+    the primary, for sessions that must see their own writes.
+    """
+    return replica_router().primary_reads()
+
+
+# The current thread's session and transaction
+_local = threading.local()
+
+
+class Session():
+    """
+    Database connections kept open for the model calls of one thread,
+    instead of connecting for every call. Use as:
+
+    .. code-block:: python
+
+        with Session():
+            recipes = [Recipe.by_id(_id) for _id in ids]
+
+    A session belongs to the thread that created it, and using it from
+    another one raises RuntimeError. Model objects are no more thread
+    safe than sessions: saving one changes it, so each thread should
+    work on objects of its own.
+    """
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self._connections = {}
+        # The replica reads go to, once picked (None for the primary)
+        self._router = None
+        self._replica = None
+
+    def _check_thread(self):
+        if threading.get_ident() != self.thread:
+            raise RuntimeError("session used outside of its thread")
+
+    def connection(self, conf, autocommit):
+        """
+        Return this session's connection to the server described by
+        conf, connecting on first use. Read connections autocommit, so
+        that every read sees the latest data.
+        """
+        self._check_thread()
+        key = (tuple(sorted(conf.items())), autocommit)
+        conn = self._connections.get(key)
+        if conn is None:
+            conn = driver().connect(**conf)
+            conn.autocommit(autocommit)
+            self._connections[key] = conn
+        return conn
+
+    def read_conf(self):
+        """
+        Return the config of the server this session reads from: the
+        replica picked for the first read, or the primary if the thread
+        had to see its own writes then or since. Once on the primary,
+        reads stay there, as a replica may be behind what was read.
+        """
+        router = replica_router()
+        if self._router is None:
+            self._replica = router.acquire()
+            self._router = router
+        elif self._replica is not None and router.reading_own_writes():
+            self._router.release(self._replica)
+            self._replica = None
+
+        if self._replica is None:
+            return get_dbconf()
+        return self._router.replicas[self._replica]
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections = {}
+        if self._router is not None:
+            self._router.release(self._replica)
+            self._router = None
+
+    def __enter__(self):
+        self._check_thread()
+        if current_session() is not None:
+            raise RuntimeError("a session is already active in this thread")
+        _local.session = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.session = None
+        self.close()
+
+
+def current_session():
+    """
+    Return the Session active in the current thread, or None.
+    """
+    return getattr(_local, 'session', None)
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Give a cursor on the primary whose writes are committed together
+    when the with block ends, or rolled back if it raises. Model writes
+    made by the same thread inside the block (execute_one(), save()
+    etc.) join the transaction instead of committing on their own.
+    """
+    cursor = getattr(_local, 'cursor', None)
+    if cursor is not None:
+        yield cursor
+        return
+
+    session = current_session()
+    if session is None:
+        conn = connect()
+    else:
+        replica_router().note_write()
+        conn = session.connection(get_dbconf(), autocommit=False)
+
+    _local.cursor = conn.cursor()
+    _local.after_commit = []
+    try:
+        yield _local.cursor
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        callbacks = _local.after_commit
+        _local.cursor.close()
+        _local.cursor = None
+        _local.after_commit = None
+        if session is None:
+            conn.close()
+
+    for callback in callbacks:
+        callback()
+
+
+def after_commit(callback):
+    """
+    Call callback() when the current thread's transaction (see
+    transaction()) has been committed, or right away outside of one.
+    """
+    callbacks = getattr(_local, 'after_commit', None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+class Operation():
+    """
+    The kinds of change recorded in the change outbox:
+    - INSERT
+    - UPDATE
+    - DELETE
+    """
+
+    INSERT = "insert"
+    UPDATE = "update"
+    DELETE = "delete"
+
+
+def record_changes(cursor, entity, ids, operation):
+    """
+    Append a change record for each of the objects of type entity
+    ("Recipe", "IngredientList" or "Ingredient") with ids to the change
+    outbox, in the transaction of cursor. The records are read back by
+    kokbok.changes.ChangeFeed.
+
+    Updated recipes and ingredients also get their Revision bumped.
+    """
+    ids = list(collections.OrderedDict.fromkeys(ids))
+    if not ids:
+        return
+
+    cursor.executemany("INSERT INTO ChangeOutbox (Entity, EntityID, "
+                       "Operation) VALUES (%s, %s, %s)",
+                       [(entity, _id, operation) for _id in ids])
+
+    if entity in ("Recipe", "Ingredient") and operation == Operation.UPDATE:
+        cursor.execute("UPDATE " + entity + " SET Revision = Revision + 1 "
+                       "WHERE ID IN (" + ", ".join(["%s"] * len(ids)) + ")",
+                       ids)
+
+
+def revision(entity, _id):
+    """
+    Return the revision of the Recipe or Ingredient with _id, which
+    changes whenever it does. Raises NotFoundException if it doesn't
+    exist.
+    """
+    with connect_read() as cursor:
+        cursor.execute("SELECT Revision FROM " + entity + " WHERE ID = %s",
+                       [_id])
+        result = cursor.fetchone()
+
+    if result is None:
+        raise NotFoundException
+    return result[0]
 
 
 class Unit():
@@ -24,20 +401,41 @@ class Unit():
     PCS = "pcs"
 
 
+# Number of comments loaded with a recipe, and per page by default
+COMMENT_PAGE_SIZE = 20
+
+# Number of IDs returned by Recipe.find() by default
+FIND_PAGE_SIZE = 100
+
+# Recipes deleted per transaction by Recipe.delete_many()
+DELETE_CHUNK = 500
+
+# Threads used by Recipe.load_many_concurrently() by default
+LOAD_WORKERS = 8
+
+# Recipe.find() order_by values and the columns they sort on
+FIND_ORDERS = {'id': 'ID',
+               'prep': 'CookingTimePrepMinutes',
+               'cook': 'CookingTimeCookMinutes',
+               'servings': 'Servings',
+               'kcal_per_serving': 'KcalPerServing'}
+
+
 def db_init():
     """
     Initialise a new (clean) database.
     """
+    dbconf = get_dbconf()
     conf_no_db_name = dbconf.copy()
     conf_no_db_name.pop('db')
 
-    with MySQLdb.connect(**conf_no_db_name) as cursor:
-        with open('kokbok.sql') as x:
+    with connect(conf_no_db_name) as cursor:
+        with open(SCHEMA_PATH) as x:
             for line_no, line in enumerate(x.read().split(';\n')):
                 if len(line.strip()) > 0:
                     try:
                         cursor.execute(line % {'dbname': dbconf['db']})
-                    except MySQLError as e:
+                    except driver().MySQLError as e:
                         print(("Error executing command number %(lineno)d: "
                                "%(line)s. Error was: %(error)s")
                               % {'line': line.strip(),
@@ -46,6 +444,263 @@ def db_init():
                         raise e
 
 
+# How often (in seconds) each process drops the recipes changed by
+# other hosts from the shared recipe cache
+CACHE_SYNC_INTERVAL = 1.0
+
+_recipe_cache = None
+_recipe_cache_synced = 0
+
+
+def recipe_cache():
+    """
+    Return the RecipeCache configured by KOK_CACHE_PATH, or None if
+    recipes aren't cached.
+    """
+    global _recipe_cache
+    if _recipe_cache is None:
+        cacheconf = kokbok.conf.get_cache_conf()
+        if cacheconf is None:
+            return None
+        with _shared_lock:
+            if _recipe_cache is None:
+                _recipe_cache = RecipeCache(**cacheconf)
+    return _recipe_cache
+
+
+def invalidate_recipe(recipe_id):
+    """
+    Drop the recipe with recipe_id from the recipe cache, if any, once
+    the current transaction is committed.
+    """
+    cache = recipe_cache()
+    if cache is not None and recipe_id is not None:
+        after_commit(lambda: cache.invalidate(recipe_id))
+
+
+def invalidate_ingredient(ingredient_id):
+    """
+    Drop the recipes using the ingredient with ingredient_id from the
+    recipe cache, if any, once the current transaction is committed.
+    """
+    cache = recipe_cache()
+    if cache is not None and ingredient_id is not None:
+        after_commit(lambda: cache.invalidate_ingredient(ingredient_id))
+
+
+def sync_recipe_cache(force=False):
+    """
+    Drop the recipes that have changed since the last call (on any
+    host) from the recipe cache, if any, reading them from the change
+    feed. Does nothing if the last call was less than
+    CACHE_SYNC_INTERVAL seconds ago, unless force is true.
+
+    The cache is a change feed consumer of its own, so that changes
+    aren't pruned before it has seen them. A new cache starts out empty
+    at the current position of the feed.
+    """
+    global _recipe_cache_synced
+    from kokbok.changes import ChangeFeed, settled_position
+
+    cache = recipe_cache()
+    now = time.time()
+    if cache is None or (not force and
+                         now - _recipe_cache_synced < CACHE_SYNC_INTERVAL):
+        return
+    _recipe_cache_synced = now
+
+    feed = ChangeFeed(cache.name)
+    position = cache.outbox_position()
+    if position is None:
+        position = settled_position()
+        cache.clear(position)
+        feed.commit(position)
+        return
+
+    start = position
+    while True:
+        batch = feed.read(position)
+        if not batch:
+            break
+
+        ids = dict((entity, set()) for entity in
+                   ("Recipe", "Ingredient", "IngredientList"))
+        for change in batch:
+            ids[change.entity].add(change.entity_id)
+
+        recipe_ids = ids["Recipe"]
+        list_ids = sorted(ids["IngredientList"])
+        if list_ids:
+            # Deleted lists come with a change to their recipe
+            with connect() as cursor:
+                cursor.execute("SELECT RecipeID FROM IngredientList "
+                               "WHERE ID IN (" +
+                               ", ".join(["%s"] * len(list_ids)) + ")",
+                               list_ids)
+                recipe_ids.update(r for (r,) in cursor.fetchall())
+
+        position = batch[-1].id
+        cache.apply_changes(recipe_ids, ids["Ingredient"], position)
+
+    if position != start:
+        feed.commit(position)
+
+
+def update_kcal_per_serving(cursor, recipe_ids):
+    """
+    Recompute Recipe.KcalPerServing for the recipes with recipe_ids from
+    their ingredient lists. Ingredient energy is per 100 g, like the
+    other nutrients; amounts that can't be converted to grammes count as
+    nothing.
+    """
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return
+
+    query = """UPDATE Recipe SET KcalPerServing = (
+        SELECT SUM(CASE ILI.Unit
+                   WHEN 'g' THEN ILI.Magnitude
+                   WHEN 'ml' THEN ILI.Magnitude * I.GramsPerMilliliter
+                   WHEN 'pcs' THEN ILI.Magnitude * I.GramsPerUnit
+                   END * I.Energy) / 100
+        FROM IngredientList AS IL
+        JOIN IngredientList_Ingredient AS ILI ON ILI.IngredientListID = IL.ID
+        JOIN Ingredient AS I ON I.ID = ILI.IngredientID
+        WHERE IL.RecipeID = Recipe.ID) / NULLIF(Servings, 0)
+    WHERE ID IN (""" + ", ".join(["%s"] * len(recipe_ids)) + ")"
+
+    cursor.execute(query, recipe_ids)
+
+
+def queue_similar_update(cursor, recipe_ids):
+    """
+    Queue the recipes with recipe_ids for kokbok.similar.update_pending().
+    Queuing a recipe again bumps its Version, so that an update running
+    meanwhile leaves it queued.
+    """
+    # IGNORE: a recipe deleted meanwhile fails the foreign key
+    cursor.executemany("INSERT IGNORE INTO RecipeSimilarPending (RecipeID) "
+                       "VALUES (%s) ON DUPLICATE KEY UPDATE "
+                       "Version = Version + 1",
+                       [(_id,) for _id in recipe_ids])
+
+
+def delete_recipes(cursor, recipe_ids):
+    """
+    Delete the recipes with recipe_ids in the transaction of cursor,
+    along with their ingredient lists and the instructions, comments and
+    pictures no other recipe uses. Returns the filenames of the deleted
+    pictures, to be removed from the picture store after commit.
+    """
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return []
+
+    placeholders = "(" + ", ".join(["%s"] * len(recipe_ids)) + ")"
+    in_recipes = "RecipeID IN " + placeholders
+
+    def select_ids(query):
+        cursor.execute(query, recipe_ids)
+        return [_id for (_id,) in cursor.fetchall()]
+
+    list_ids = select_ids("SELECT ID FROM IngredientList WHERE " + in_recipes)
+    instruction_ids = select_ids("SELECT InstructionID "
+                                 "FROM Recipe_Instruction WHERE " +
+                                 in_recipes)
+    comment_ids = select_ids("SELECT CommentID FROM Recipe_Comment WHERE " +
+                             in_recipes)
+    picture_ids = select_ids("SELECT PictureID FROM Recipe_Picture WHERE " +
+                             in_recipes)
+    # Recipes whose similar recipes lose one
+    neighbour_ids = select_ids("SELECT DISTINCT RecipeID FROM RecipeSimilar "
+                               "WHERE SimilarRecipeID IN " + placeholders)
+
+    # The rest (links, lists, similar recipes) cascade
+    cursor.execute("DELETE FROM Recipe WHERE ID IN " + placeholders,
+                   recipe_ids)
+
+    def delete_orphans(table, link, column, ids):
+        if ids:
+            cursor.execute("DELETE T FROM " + table + " AS T LEFT JOIN " +
+                           link + " AS L ON L." + column + " = T.ID "
+                           "WHERE T.ID IN (" + ", ".join(["%s"] * len(ids)) +
+                           ") AND L." + column + " IS NULL", ids)
+
+    delete_orphans("Instruction", "Recipe_Instruction", "InstructionID",
+                   instruction_ids)
+    delete_orphans("Comment", "Recipe_Comment", "CommentID", comment_ids)
+
+    filenames = []
+    if picture_ids:
+        cursor.execute("SELECT P.ID, P.Filename FROM Picture AS P "
+                       "LEFT JOIN Recipe_Picture AS RP ON RP.PictureID = P.ID "
+                       "WHERE P.ID IN (" +
+                       ", ".join(["%s"] * len(picture_ids)) +
+                       ") AND RP.PictureID IS NULL", picture_ids)
+        orphans = cursor.fetchall()
+        if orphans:
+            cursor.execute("DELETE FROM Picture WHERE ID IN (" +
+                           ", ".join(["%s"] * len(orphans)) + ")",
+                           [_id for (_id, _) in orphans])
+        filenames = [filename for (_, filename) in orphans]
+
+    deleted = set(recipe_ids)
+    neighbour_ids = [_id for _id in neighbour_ids if _id not in deleted]
+    queue_similar_update(cursor, neighbour_ids)
+
+    record_changes(cursor, "Recipe", recipe_ids, Operation.DELETE)
+    record_changes(cursor, "IngredientList", list_ids, Operation.DELETE)
+
+    return filenames
+
+
+def ids_by_name(cursor, table, names):
+    """
+    Return a dict mapping each of names to the ID of the row in table
+    with that Name, for the names that have one.
+
+    Names are compared by the database, under the collation of the
+    column, so "anna" finds "Anna". The names that aren't stored with
+    the same spelling are looked up one by one, to know which row each
+    of them matched.
+    """
+    names = list(set(names))
+    if not names:
+        return {}
+
+    placeholders = ", ".join(["%s"] * len(names))
+    cursor.execute("SELECT ID, Name FROM " + table + " WHERE Name IN ("
+                   + placeholders + ")", names)
+    stored = dict((name, _id) for (_id, name) in cursor.fetchall())
+
+    ids = {}
+    for name in names:
+        if name in stored:
+            ids[name] = stored[name]
+        elif stored:
+            cursor.execute("SELECT ID FROM " + table + " WHERE Name = %s",
+                           [name])
+            row = cursor.fetchone()
+            if row is not None:
+                ids[name] = row[0]
+    return ids
+
+
+def category_ids(cursor, table, names):
+    """
+    Return a dict mapping each of names to its ID in the category table
+    table (RecipeCategory or IngredientCategory), creating missing
+    categories.
+    """
+    names = list(set(names))
+    if not names:
+        return {}
+
+    cursor.executemany("INSERT IGNORE INTO " + table + " (Name) VALUES (%s)",
+                       [(name,) for name in names])
+    return ids_by_name(cursor, table, names)
+
+
 class CookBookObject(metaclass=ABCMeta):
 
     @abstractmethod
@@ -82,16 +737,16 @@ class CookBookObject(metaclass=ABCMeta):
         return NotImplemented
 
     def execute_one(self, query, arglist):
-        with MySQLdb.connect(**dbconf) as cursor:
+        with transaction() as cursor:
             cursor.execute(query, arglist)
 
             cursor.execute("SELECT LAST_INSERT_ID()")
             return cursor.fetchone()[0]
 
     def execute_many(self, query, arglist):
-        with MySQLdb.connect(**dbconf) as cursor:
-            cursor.execute_many(query, arglist)
-            return cursor.fetchone()
+        with transaction() as cursor:
+            cursor.executemany(query, arglist)
+            return cursor.rowcount
 
 
 class Ingredient(CookBookObject):
@@ -135,19 +790,59 @@ class Ingredient(CookBookObject):
         self._id = None
 
     def save(self):
+        """
+        Save the ingredient. Saving one that is already saved also
+        records the recipes using it as updated, as they show its name,
+        and recomputes their energy if its energy or conversion factors
+        changed.
+        """
+        arglist = (self.name, self.price, self.energy, self.fat,
+                   self.protein, self.carbohydrate,
+                   self.gramspermilliliter, self.gramsperunit)
+
         if self._id is None:
-            query = """INSERT INTO Ingredient (Name, Price, Energy, Fat, Protein,
-            Carbohydrate, GramsPerMilliliter, GramsPerUnit)
+            query = """INSERT INTO Ingredient (Name, Price, Energy, Fat,
+            Protein, Carbohydrate, GramsPerMilliliter, GramsPerUnit)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
-            arglist = (self.name, self.price, self.energy, self.fat,
-                       self.protein, self.carbohydrate,
-                       self.gramspermilliliter, self.gramsperunit)
-            self._id = self.execute_one(query, arglist)
+            with transaction() as cursor:
+                self._id = self.execute_one(query, arglist)
+                record_changes(cursor, "Ingredient", [self._id],
+                               Operation.INSERT)
+            return
+
+        query = """UPDATE Ingredient SET Name = %s, Price = %s, Energy = %s,
+        Fat = %s, Protein = %s, Carbohydrate = %s, GramsPerMilliliter = %s,
+        GramsPerUnit = %s WHERE ID = %s"""
+        with transaction() as cursor:
+            cursor.execute("SELECT Energy, GramsPerMilliliter, GramsPerUnit "
+                           "FROM Ingredient WHERE ID = %s FOR UPDATE",
+                           [self._id])
+            before = cursor.fetchone()
+            if before is None:
+                raise NotFoundException
+
+            cursor.execute(query, arglist + (self._id,))
+            record_changes(cursor, "Ingredient", [self._id], Operation.UPDATE)
+
+            cursor.execute("""SELECT DISTINCT IL.RecipeID
+            FROM IngredientList AS IL JOIN IngredientList_Ingredient AS ILI
+            ON ILI.IngredientListID = IL.ID
+            WHERE ILI.IngredientID = %s""", [self._id])
+            recipe_ids = [_id for (_id,) in cursor.fetchall()]
+            if tuple(before) != (self.energy, self.gramspermilliliter,
+                                 self.gramsperunit):
+                update_kcal_per_serving(cursor, recipe_ids)
+                queue_similar_update(cursor, recipe_ids)
+            # Bumps their revisions, and so the API's ETags
+            record_changes(cursor, "Recipe", recipe_ids, Operation.UPDATE)
+
+        invalidate_ingredient(self._id)
 
     @classmethod
     def by_id(cls, _id):
-        query = """SELECT * FROM Ingredient WHERE ID = %s"""
-        with MySQLdb.connect(**dbconf) as cursor:
+        query = """SELECT ID, Name, Price, Energy, Fat, Protein, Carbohydrate,
+        GramsPerMilliliter, GramsPerUnit FROM Ingredient WHERE ID = %s"""
+        with connect_read() as cursor:
             cursor.execute(query, [_id])
             ingredient = cursor.fetchone()
 
@@ -175,13 +870,47 @@ class Ingredient(CookBookObject):
         query = "DELETE FROM Ingredient WHERE ID = %s"
         arglist = [self._id]
         try:
-            self.execute_one(query, arglist)
-        except IntegrityError:
+            with transaction() as cursor:
+                self.execute_one(query, arglist)
+                record_changes(cursor, "Ingredient", [self._id],
+                               Operation.DELETE)
+        except driver().IntegrityError:
             raise IngredientInUseException()
+        invalidate_ingredient(self._id)
 
     def refresh(self):
         pass
 
+    def add_categories(self, names):
+        """
+        Put this (saved) ingredient in the ingredient categories with
+        the given names, creating them if needed.
+        """
+        assert self._id is not None
+
+        with transaction() as cursor:
+            ids = category_ids(cursor, "IngredientCategory", names)
+            cursor.executemany("INSERT IGNORE INTO "
+                               "Ingredient_IngredientCategory "
+                               "(IngredientID, IngredientCategoryID) "
+                               "VALUES (%s, %s)",
+                               [(self._id, _id) for _id in ids.values()])
+            record_changes(cursor, "Ingredient", [self._id], Operation.UPDATE)
+
+    def categories(self):
+        """
+        Return the names of the ingredient categories of this
+        ingredient.
+        """
+        query = """SELECT IC.Name FROM IngredientCategory AS IC
+        JOIN Ingredient_IngredientCategory AS IIC
+        ON IC.ID = IIC.IngredientCategoryID
+        WHERE IIC.IngredientID = %s ORDER BY IC.Name"""
+
+        with connect_read() as cursor:
+            cursor.execute(query, [self._id])
+            return [name for (name,) in cursor.fetchall()]
+
     def __eq__(self, other):
         return isinstance(other, Ingredient) and self._id == other._id
 
@@ -194,7 +923,8 @@ CookBookObject.register(Ingredient)
 class Recipe(CookBookObject):
     def __init__(self, title, cook_time_prep, cook_time_cook,
                  servings, description, version, ingredient_lists,
-                 author, instructions, comments, pictures, id=None):
+                 author, instructions, comments, pictures, id=None,
+                 categories=None):
         """
         Describe a recipe
 
@@ -222,6 +952,9 @@ class Recipe(CookBookObject):
 
         pictures -- a list of pictures of the recipe
 
+        categories -- a list of names of the categories (e.g. dinner,
+        snack) of the recipe
+
         """
 
         super(Recipe, self).__init__()
@@ -240,10 +973,12 @@ class Recipe(CookBookObject):
         self.instructions = instructions
         self.comments = comments
         self.pictures = pictures
+        self.categories = categories if categories is not None else []
 
     @classmethod
-    def new(_class, title, servings, cook_time_prep, cook_time_cook, ingredients,
-            author, instructions, description, version):
+    def new(_class, title, servings, cook_time_prep, cook_time_cook,
+            ingredients, author, instructions, description, version,
+            pictures=None, categories=None):
         """"
         Create a new recipe and save it to database.
 
@@ -258,13 +993,19 @@ class Recipe(CookBookObject):
             cook_time_prep=30,
             cook_time_cook=30,
             ingredients=[{'title': '',
-                          'ingredients': [{'unit': Unit.ML, 'quantity': 17, 'prepnotes': None,
-                                          'ingredient': Ingredient.from_name("wheat flour")}]}],
+                          'ingredients': [{
+                              'unit': Unit.ML, 'quantity': 17,
+                              'prepnotes': None,
+                              'ingredient': Ingredient.from_name("flour")}]}],
             author=Author.from_name("Albin Stjerna"),
             instructions=["Blanda mjöl", "sätt på ugnen", "klart!"]
             description="Jättegott bröd"
             version=1
             )
+
+        pictures is an optional list of Picture objects, for example
+        from Picture.upload(), and categories an optional list of
+        category names.
         """
         ingredient_lists = [IngredientList(**x) for x in ingredients]
 
@@ -272,53 +1013,191 @@ class Recipe(CookBookObject):
                         cook_time_cook=cook_time_cook, servings=servings,
                         description=description, version=version,
                         ingredient_lists=ingredient_lists, author=author,
-                        instructions=instructions, pictures=None, comments=None)
+                        instructions=instructions, pictures=pictures or [],
+                        comments=[], categories=categories)
         recipe.save()
         return recipe
 
     def save(self):
-        if self._id is None:
-            query = """INSERT INTO Recipe (Title, CookingTimePrepMinutes,
-            CookingTimeCookMinutes, Servings, Description, Version)
-            VALUES (%s, %s, %s, %s, %s, %s)"""
-            arglist = (self.title, self.cook_time_prep, self.cook_time_cook,
-                       self.servings, self.description, self.version)
-
-            self._id = self.execute_one(query, arglist)
-
-            # Link ingredient lists to this recipe
-            for ing_list in self.ingredient_lists:
-                ing_list.link_to_recipe(self)
-                ing_list.save()
-
-            instruction_query = """INSERT INTO Instruction (Text)
-            VALUES (%s)"""
-            recipe_instruction_query = """INSERT INTO Recipe_Instruction
-            (RecipeID, InstructionID, Step) VALUES (%s, %s, %s)"""
-
-            for step, instruction in enumerate(self.instructions, start=1):
-                instruction_id = self.execute_one(instruction_query, [instruction])
-
-                self.execute_one(recipe_instruction_query,
-                                 (self._id, instruction_id, step))
-
-            if self.author:
-                author_id = self.author_id(self.author)
-                if not author_id:
-                    author_id = self.execute_one(("INSERT INTO Author (Name)"
-                                                  " VALUES (%s)"),
-                                                 [self.author])
-                self.execute_one(("INSERT INTO Author_Recipe "
-                                  "(AuthorID, RecipeID) VALUES (%s, %s)"),
-                                  [author_id, self._id])
+        """
+        Save the recipe, with its ingredient lists, instructions, author,
+        pictures and categories, in one transaction. Saving a recipe that
+        is already saved only updates its own columns; its ingredient
+        lists, pictures and categories have methods of their own.
+        """
+        arglist = (self.title, self.cook_time_prep, self.cook_time_cook,
+                   self.servings, self.description, self.version)
+
+        with transaction() as cursor:
+            if self._id is None:
+                query = """INSERT INTO Recipe (Title, CookingTimePrepMinutes,
+                CookingTimeCookMinutes, Servings, Description, Version)
+                VALUES (%s, %s, %s, %s, %s, %s)"""
+
+                self._id = self.execute_one(query, arglist)
+                record_changes(cursor, "Recipe", [self._id],
+                               Operation.INSERT)
+
+                # Link ingredient lists to this recipe
+                for ing_list in self.ingredient_lists:
+                    ing_list.link_to_recipe(self)
+                    ing_list.save()
+
+                instruction_query = """INSERT INTO Instruction (Text)
+                VALUES (%s)"""
+                recipe_instruction_query = """INSERT INTO Recipe_Instruction
+                (RecipeID, InstructionID, Step) VALUES (%s, %s, %s)"""
+
+                for step, instruction in enumerate(self.instructions, start=1):
+                    instruction_id = self.execute_one(instruction_query,
+                                                      [instruction])
+
+                    self.execute_one(recipe_instruction_query,
+                                     (self._id, instruction_id, step))
+
+                if self.author:
+                    author_id = self.author_id(self.author)
+                    if not author_id:
+                        author_id = self.execute_one(("INSERT INTO Author "
+                                                      "(Name) VALUES (%s)"),
+                                                     [self.author])
+                    self.execute_one(("INSERT INTO Author_Recipe "
+                                      "(AuthorID, RecipeID) VALUES (%s, %s)"),
+                                     [author_id, self._id])
+
+                if self.pictures:
+                    self.link_pictures(self.pictures)
+
+                if self.categories:
+                    self.add_categories(self.categories)
+            else:
+                cursor.execute("SELECT ID FROM Recipe WHERE ID = %s "
+                               "FOR UPDATE", [self._id])
+                if cursor.fetchone() is None:
+                    raise NotFoundException
+
+                query = """UPDATE Recipe SET Title = %s,
+                CookingTimePrepMinutes = %s, CookingTimeCookMinutes = %s,
+                Servings = %s, Description = %s, Version = %s
+                WHERE ID = %s"""
+                cursor.execute(query, arglist + (self._id,))
+                record_changes(cursor, "Recipe", [self._id],
+                               Operation.UPDATE)
+
+            update_kcal_per_serving(cursor, [self._id])
+
+            # Picked up by kokbok.similar.update_pending()
+            queue_similar_update(cursor, [self._id])
+
+        invalidate_recipe(self._id)
+
+    def similar(self, limit=None):
+        """
+        Return [(recipe ID, score)] for the recipes most similar to this
+        one by ingredients, best first (see kokbok.similar).
+        """
+        query = """SELECT SimilarRecipeID, Score FROM RecipeSimilar
+        WHERE RecipeID = %s ORDER BY Position"""
+        arglist = [self._id]
+
+        if limit is not None:
+            query += " LIMIT %s"
+            arglist.append(limit)
+
+        with connect_read() as cursor:
+            cursor.execute(query, arglist)
+            return list(cursor.fetchall())
+
+    def add_categories(self, names):
+        """
+        Put this (saved) recipe in the recipe categories with the given
+        names, creating them if needed.
+        """
+        assert self._id is not None
+
+        with transaction() as cursor:
+            ids = category_ids(cursor, "RecipeCategory", names)
+            cursor.executemany("INSERT IGNORE INTO Recipe_RecipeCategory "
+                               "(RecipeID, RecipeCategoryID) VALUES (%s, %s)",
+                               [(self._id, _id) for _id in ids.values()])
+            record_changes(cursor, "Recipe", [self._id], Operation.UPDATE)
+
+        for name in names:
+            if name not in self.categories:
+                self.categories.append(name)
+
+        invalidate_recipe(self._id)
+
+    def add_comment(self, text, author=None, date=None):
+        """
+        Add a comment to this (saved) recipe and return it.
+
+        author is the name of the commenting author, who is created if
+        not already present.
+        """
+        comment = Comment(text, date=date, author=author)
+        comment.link_to_recipe(self)
+        comment.save()
+        return comment
+
+    def comment_page(self, after=None, limit=COMMENT_PAGE_SIZE):
+        """
+        Return a page of this recipe's comments, see
+        Comment.page_for_recipe().
+        """
+        return Comment.page_for_recipe(self._id, after=after, limit=limit)
+
+    def link_pictures(self, pictures):
+        """
+        Link pictures to this (saved) recipe, saving any pictures that
+        are not yet in the database. All rows are written in batches
+        in a single transaction.
+        """
+        assert self._id is not None
+
+        unsaved = [p for p in pictures if p._id is None]
+
+        with transaction() as cursor:
+            if unsaved:
+                cursor.executemany("INSERT IGNORE INTO Picture (Filename) "
+                                   "VALUES (%s)",
+                                   [(p.filename,) for p in unsaved])
+
+                placeholders = ", ".join(["%s"] * len(unsaved))
+                cursor.execute("SELECT ID, Filename FROM Picture "
+                               "WHERE Filename IN (" + placeholders + ")",
+                               [p.filename for p in unsaved])
+                ids = dict((filename, _id)
+                           for (_id, filename) in cursor.fetchall())
+
+                for picture in unsaved:
+                    picture._id = ids[picture.filename]
+
+            cursor.executemany("INSERT IGNORE INTO Recipe_Picture "
+                               "(RecipeID, PictureID) VALUES (%s, %s)",
+                               [(self._id, p._id) for p in pictures])
+            record_changes(cursor, "Recipe", [self._id], Operation.UPDATE)
+
+        for picture in pictures:
+            if picture not in self.pictures:
+                self.pictures.append(picture)
+
+        invalidate_recipe(self._id)
 
     def author_id(self, author):
         query = "SELECT ID from Author WHERE Name = %s"
-        with MySQLdb.connect(**dbconf) as cursor:
+        with transaction() as cursor:
             cursor.execute(query, [author])
             result = cursor.fetchone()
             return result[0] if result else result
-            
+
+    def ingredient_ids(self):
+        """
+        Return the IDs of all ingredients used in this recipe.
+        """
+        return [i['ingredient']._id for ing_list in self.ingredient_lists
+                for i in ing_list.ingredients]
+
     def __str__(self):
         s = ("%s %d") % (self.title, int(self._id))
         return s
@@ -326,10 +1205,209 @@ class Recipe(CookBookObject):
     __repr__ = __str__
 
 
+    @classmethod
+    def find_query(cls, prep_min=None, prep_max=None, cook_min=None,
+                   cook_max=None, servings_min=None, servings_max=None,
+                   kcal_per_serving_between=None, order_by='id',
+                   limit=FIND_PAGE_SIZE, after=None):
+        """
+        Return (query, arglist) for find().
+        """
+        if order_by not in FIND_ORDERS:
+            raise ValueError("can't order recipes by %s" % order_by)
+        column = FIND_ORDERS[order_by]
+
+        conditions = []
+        arglist = []
+
+        ranges = [("CookingTimePrepMinutes", prep_min, prep_max),
+                  ("CookingTimeCookMinutes", cook_min, cook_max),
+                  ("Servings", servings_min, servings_max)]
+        if kcal_per_serving_between is not None:
+            ranges.append(("KcalPerServing",) +
+                          tuple(kcal_per_serving_between))
+
+        for (range_column, low, high) in ranges:
+            if low is not None:
+                conditions.append(range_column + " >= %s")
+                arglist.append(low)
+            if high is not None:
+                conditions.append(range_column + " <= %s")
+                arglist.append(high)
+
+        if column != "ID":
+            conditions.append(column + " IS NOT NULL")
+
+        if column == "ID":
+            # The first page is the one after ID 0, so that every page
+            # is a range of the primary key
+            conditions.append("ID > %s")
+            arglist.append(0 if after is None else after)
+        elif after is not None:
+            (after_value, after_id) = after
+            conditions.append("(" + column + " > %s OR (" + column +
+                              " = %s AND ID > %s))")
+            arglist += [after_value, after_value, after_id]
+
+        if column == "ID":
+            query = "SELECT ID FROM Recipe"
+            order = "ID"
+        else:
+            query = "SELECT ID, " + column + " FROM Recipe"
+            order = column + ", ID"
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY " + order + " LIMIT %s"
+        arglist.append(limit + 1)
+
+        return (query, arglist)
+
+    @classmethod
+    def find(cls, **filters):
+        """
+        Return (IDs, next) for a page of recipes matching filters,
+        without loading them. next is the value to pass as after= to get
+        the following page, None if this was the last one.
+
+        Keyword arguments (all optional, bounds are inclusive)
+
+        prep_min, prep_max -- bounds on the prep time in minutes
+
+        cook_min, cook_max -- bounds on the cooking time in minutes
+
+        servings_min, servings_max -- bounds on the number of servings
+
+        kcal_per_serving_between -- a (low, high) pair of bounds on the
+        energy per serving; either may be None
+
+        order_by -- one of FIND_ORDERS; recipes where the ordering
+        attribute is unknown are left out
+
+        limit -- the maximum number of IDs to return
+
+        after -- the next value from the previous page
+
+        Every ordering has an index on Recipe that also holds the
+        filtered columns, so that a page is read from the index alone,
+        in order.
+
+        Example:
+
+        .. code-block:: python
+
+            ids, after = Recipe.find(prep_max=15,
+                                     kcal_per_serving_between=(None, 600),
+                                     order_by='kcal_per_serving')
+        """
+        (query, arglist) = cls.find_query(**filters)
+        limit = filters.get('limit', FIND_PAGE_SIZE)
+
+        with connect_read() as cursor:
+            cursor.execute(query, arglist)
+            rows = cursor.fetchall()
+
+        ids = [row[0] for row in rows[:limit]]
+        next_page = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_page = last[0] if len(last) == 1 else (last[1], last[0])
+
+        return (ids, next_page)
+
+    @classmethod
+    def explain_find(cls, **filters):
+        """
+        Return the rows of EXPLAIN for find() with filters, as dicts.
+        """
+        (query, arglist) = cls.find_query(**filters)
+
+        with connect_read() as cursor:
+            cursor.execute("EXPLAIN " + query, arglist)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @classmethod
+    def iter_ids(cls, batch_size=1000):
+        """
+        Yield the IDs of all recipes in ID order, fetching batch_size at
+        a time.
+        """
+        last_id = 0
+        while True:
+            with connect_read() as cursor:
+                cursor.execute("SELECT ID FROM Recipe WHERE ID > %s "
+                               "ORDER BY ID LIMIT %s", [last_id, batch_size])
+                ids = [_id for (_id,) in cursor.fetchall()]
+
+            if not ids:
+                return
+            for _id in ids:
+                yield _id
+            last_id = ids[-1]
+
     @classmethod
     def by_id(cls, _id):
+        """
+        Return the recipe with _id, from the shared recipe cache if one
+        is configured (see kokbok.conf.get_cache_conf()).
+        """
+        cache = recipe_cache()
+        if cache is None:
+            return cls.by_id_uncached(_id)
+
+        sync_recipe_cache()
+        return cache.get_or_load(_id, lambda: cls.by_id_uncached(_id),
+                                 ingredient_ids=cls.ingredient_ids)
+
+    @classmethod
+    def load_many_concurrently(cls, ids, workers=LOAD_WORKERS):
+        """
+        Return the recipes with ids (in the same order), loaded by at
+        most workers threads with a Session each. If a load fails, the
+        others are stopped and its exception is raised.
+        """
+        ids = list(ids)
+        recipes = [None] * len(ids)
+        positions = iter(range(len(ids)))
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def load():
+            with Session():
+                while not failed.is_set():
+                    with lock:
+                        position = next(positions, None)
+                    if position is None:
+                        return
+                    try:
+                        recipes[position] = cls.by_id(ids[position])
+                    except BaseException:
+                        failed.set()
+                        raise
+
+        workers = min(workers, len(ids))
+        if workers:
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                futures = [pool.submit(load) for _ in range(workers)]
+            for future in futures:
+                future.result()
 
-        recipe_query = """SELECT *
+        return recipes
+
+    @classmethod
+    def by_id_uncached(cls, _id):
+        """
+        Return the recipe with _id, read from the database (from one
+        server, see read_session()).
+        """
+        with read_session():
+            return cls._load(_id)
+
+    @classmethod
+    def _load(cls, _id):
+        recipe_query = """SELECT Title, CookingTimePrepMinutes,
+        CookingTimeCookMinutes, Servings, Description, Version
         FROM Recipe WHERE ID = %s"""
 
         ingredient_lists = IngredientList.from_recipe_id(_id)
@@ -346,8 +1424,14 @@ class Recipe(CookBookObject):
         ON Author.ID = Author_Recipe.AuthorID
         WHERE Author_Recipe.RecipeID = %s"""
 
-        with MySQLdb.connect(**dbconf) as cursor:
-            # Fetch from Recipe table, strip off ID
+        category_query = """SELECT Name
+        FROM RecipeCategory join Recipe_RecipeCategory
+        ON RecipeCategory.ID = Recipe_RecipeCategory.RecipeCategoryID
+        WHERE Recipe_RecipeCategory.RecipeID = %s
+        ORDER BY Name"""
+
+        with connect_read() as cursor:
+            # Fetch from Recipe table
             cursor.execute(recipe_query, [_id])
             result = cursor.fetchone()
 
@@ -361,26 +1445,50 @@ class Recipe(CookBookObject):
             cursor.execute(author_query, [_id])
             ret_author = cursor.fetchone()
             author = ret_author[0] if ret_author else ret_author
-            
-            recipe = result[1:]
-            
+
+            cursor.execute(category_query, [_id])
+            categories = [c for (c,) in cursor.fetchall()]
+
+            recipe = result
+
         # TBI
         #instructions = Instruction.from_recipe_id(_id)
 
-        comments = None
-        pictures = None
+        # Only the newest comments, use comment_page() for the rest
+        comments, _ = Comment.page_for_recipe(_id)
+        pictures = Picture.from_recipe_id(_id)
 
         return cls(*recipe, ingredient_lists=ingredient_lists, author=author,
                    instructions=instructions, comments=comments,
-                   pictures=pictures, id=_id)
+                   pictures=pictures, id=_id, categories=categories)
 
-    def delete(self):
-        query = "DELETE FROM Ingredient WHERE ID = %s"
-        arglist = [self._id]
-        try:
-            self.execute_one(query, arglist)
-        except IntegrityError:
-            raise IngredientInUseException()
+    def delete(self, store=None):
+        """
+        Delete the recipe with its ingredient lists, instructions,
+        comments and the pictures no other recipe uses, in one
+        transaction.
+        """
+        if self._id is not None:
+            self.delete_many([self._id], store=store)
+
+    @classmethod
+    def delete_many(cls, ids, chunk_size=DELETE_CHUNK, store=None):
+        """
+        Delete the recipes with ids like delete(), chunk_size recipes per
+        transaction so that large purges hold locks briefly and keep the
+        undo log small. A failure leaves the chunks before it deleted.
+        """
+        ids = list(ids)
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+
+            with transaction() as cursor:
+                filenames = delete_recipes(cursor, chunk)
+                after_commit(functools.partial(delete_pictures, filenames,
+                                               store))
+
+                for _id in chunk:
+                    invalidate_recipe(_id)
 
     def refresh(self):
         print("refresh not implemented yet")
@@ -394,10 +1502,16 @@ class Recipe(CookBookObject):
             selfdict.pop("_id")
             otherdict.pop("_id")
 
+            # Categories are a set, stored without an order
+            if set(selfdict.pop('categories')) != \
+                    set(otherdict.pop('categories')):
+                return False
+
             ingredient_lists1 = selfdict.pop('ingredient_lists')
             ingredient_lists2 = otherdict.pop('ingredient_lists')
 
-            same_lists = all((l1 == l2 for (l1, l2) in zip(ingredient_lists1, ingredient_lists2)))
+            same_lists = all((l1 == l2 for (l1, l2)
+                              in zip(ingredient_lists1, ingredient_lists2)))
 
             # for il1, il2 in zip(ingredient_lists1, ingredient_lists2):
             #     if not il1 == il2:
@@ -436,40 +1550,62 @@ class IngredientList(CookBookObject):
     def save(self):
         assert(self.recipe_id is not None)
 
-        if self._id is None:
-            insert_query = """INSERT INTO IngredientList (Title, RecipeID)
-            VALUES (%s, %s) """
-
-            self._id = self.execute_one(insert_query, [self.title, self.recipe_id])
-
-            for ingredient in self.ingredients:
-                coupling_query = """INSERT INTO IngredientList_Ingredient
-                      (IngredientListID, IngredientID, PrepNotes,
-                       Magnitude, Unit)
-                       VALUES(%s, %s, %s, %s, %s)"""
-
-                arglist = [self._id, ingredient['ingredient']._id,
-                           ingredient['prepnotes'], ingredient['quantity'],
-                           ingredient['unit']]
-                self.execute_one(coupling_query, arglist)
-
-        else:
-
-            update_query = """UPDATE IngredientList
-                       SET (Title, RecipeID) VALUES (%s, %s) """
-
-            self._id = self.execute_one(update_query, [self.title, self.recipe_id])
-
-            for ingredient in self.ingredients:
-                query = """UPDATE IngredientList_Ingredient
-                      (IngredientListID, IngredientID, PrepNotes,
-                       Magnitude, Unit)
-                       VALUES(%s, %s, 1, 1, 1)"""
-
-                arglist = [self._id, ingredient._id]
-
-                self.execute_one(query, arglist)
-
+        with transaction() as cursor:
+            if self._id is None:
+                insert_query = """INSERT INTO IngredientList (Title, RecipeID)
+                VALUES (%s, %s) """
+
+                self._id = self.execute_one(insert_query,
+                                            [self.title, self.recipe_id])
+                record_changes(cursor, "IngredientList", [self._id],
+                               Operation.INSERT)
+
+                for ingredient in self.ingredients:
+                    coupling_query = """INSERT INTO IngredientList_Ingredient
+                          (IngredientListID, IngredientID, PrepNotes,
+                           Magnitude, Unit)
+                           VALUES(%s, %s, %s, %s, %s)"""
+
+                    arglist = [self._id, ingredient['ingredient']._id,
+                               ingredient['prepnotes'], ingredient['quantity'],
+                               ingredient['unit']]
+                    self.execute_one(coupling_query, arglist)
+
+            else:
+                cursor.execute("SELECT RecipeID FROM IngredientList "
+                               "WHERE ID = %s FOR UPDATE", [self._id])
+                before = cursor.fetchone()
+                if before is None:
+                    raise NotFoundException
+
+                cursor.execute("UPDATE IngredientList SET Title = %s, "
+                               "RecipeID = %s WHERE ID = %s",
+                               [self.title, self.recipe_id, self._id])
+
+                # The entries are replaced as a whole
+                cursor.execute("DELETE FROM IngredientList_Ingredient "
+                               "WHERE IngredientListID = %s", [self._id])
+                if self.ingredients:
+                    cursor.execute(
+                        "INSERT INTO IngredientList_Ingredient "
+                        "(IngredientListID, IngredientID, PrepNotes, "
+                        "Magnitude, Unit) VALUES " +
+                        ", ".join(["(%s, %s, %s, %s, %s)"] *
+                                  len(self.ingredients)),
+                        [value for i in self.ingredients
+                         for value in (self._id, i['ingredient']._id,
+                                       i['prepnotes'], i['quantity'],
+                                       i['unit'])])
+
+                recipe_ids = sorted(set([before[0], self.recipe_id]))
+                update_kcal_per_serving(cursor, recipe_ids)
+                queue_similar_update(cursor, recipe_ids)
+                record_changes(cursor, "IngredientList", [self._id],
+                               Operation.UPDATE)
+                record_changes(cursor, "Recipe", recipe_ids,
+                               Operation.UPDATE)
+                for recipe_id in recipe_ids:
+                    invalidate_recipe(recipe_id)
 
     def link_to_recipe(self, recipe):
         """
@@ -506,21 +1642,26 @@ class IngredientList(CookBookObject):
         FROM IngredientList_Ingredient
         WHERE IngredientListID = %s"""
 
-        ingredientlist_query = """SELECT ID, Title, RecipeID FROM IngredientList
-        WHERE ID = %s"""
+        ingredientlist_query = """SELECT ID, Title, RecipeID
+        FROM IngredientList WHERE ID = %s"""
 
-        with MySQLdb.connect(**dbconf) as cursor:
+        with connect_read() as cursor:
             # Fetch list of ingredients
             cursor.execute(ingredients_query, [_id])
             ingredient_data = cursor.fetchall()
 
             # Fetch title and recipe ID
             cursor.execute(ingredientlist_query, [_id])
-            (il_id, il_title, il_recipeID) = cursor.fetchone()
+            result = cursor.fetchone()
+
+            if result is None:
+                raise NotFoundException
+
+            (il_id, il_title, il_recipeID) = result
 
             ingredients = [{"ingredient": Ingredient.by_id(ingr_id),
-                            "prepnotes": ingr_prepnotes, "quantity": ingr_quantity,
-                            "unit": ingr_unit}
+                            "prepnotes": ingr_prepnotes,
+                            "quantity": ingr_quantity, "unit": ingr_unit}
                            for (ingr_id, ingr_prepnotes, ingr_quantity,
                                 ingr_unit)
                            in ingredient_data]
@@ -534,7 +1675,26 @@ class IngredientList(CookBookObject):
         print("refresh is not implemented yet")
 
     def delete(self):
-        print("delete is not implemented yet")
+        """
+        Delete the ingredient list from its recipe.
+        """
+        if self._id is None:
+            return
+
+        with transaction() as cursor:
+            # IngredientList_Ingredient cascades
+            cursor.execute("DELETE FROM IngredientList WHERE ID = %s",
+                           [self._id])
+            record_changes(cursor, "IngredientList", [self._id],
+                           Operation.DELETE)
+
+            if self.recipe_id is not None:
+                record_changes(cursor, "Recipe", [self.recipe_id],
+                               Operation.UPDATE)
+                update_kcal_per_serving(cursor, [self.recipe_id])
+                queue_similar_update(cursor, [self.recipe_id])
+
+        invalidate_recipe(self.recipe_id)
 
     @classmethod
     def from_recipe_id(cls, recipe_id):
@@ -544,7 +1704,7 @@ class IngredientList(CookBookObject):
         query = """SELECT IL.ID FROM IngredientList as IL join
          Recipe as R on RecipeID = R.ID WHERE R.ID = %s"""
 
-        with MySQLdb.connect(**dbconf) as cursor:
+        with connect_read() as cursor:
             # Fetch ID:s of ingredient lists
             cursor.execute(query, [recipe_id])
             ingredient_lists_ids = cursor.fetchone()
@@ -562,6 +1722,313 @@ class IngredientList(CookBookObject):
 CookBookObject.register(IngredientList)
 
 
+_picture_store = None
+
+
+def picture_store():
+    """
+    Return the PictureStore configured by KOK_PICTURE_DIR.
+    """
+    global _picture_store
+    if _picture_store is None:
+        _picture_store = PictureStore(kokbok.conf.get_picture_dir())
+    return _picture_store
+
+
+def delete_pictures(filenames, store=None):
+    """
+    Remove the pictures with filenames, whose rows have been deleted,
+    from the picture store, unless they have been uploaded again since.
+    """
+    store = store or picture_store()
+    for filename in filenames:
+        with transaction() as cursor:
+            # Until the file is gone, this locks the filename against an
+            # upload saving it again, which then stores the file again
+            # (see Picture.upload())
+            cursor.execute("SELECT ID FROM Picture WHERE Filename = %s "
+                           "FOR UPDATE", [filename])
+            if cursor.fetchone() is None:
+                store.delete(filename)
+
+
+class Picture(CookBookObject):
+
+    def __init__(self, filename, _id=None):
+        """
+        Describe a picture
+
+        Keyword arguments
+
+        filename -- the content digest of the picture in the picture
+        store (see kokbok.pictures)
+        """
+
+        super(Picture, self).__init__()
+        self.filename = filename
+        self._id = _id
+
+    @classmethod
+    def upload(cls, fileobj, store=None):
+        """
+        Stream the binary file-like object fileobj into the picture
+        store and save it to the database. Uploading the same contents
+        twice gives back the same picture.
+        """
+        store = store or picture_store()
+        # Stored after the row is saved, see delete_pictures()
+        with store.stage(fileobj) as digest:
+            picture = cls(digest)
+            picture.save()
+        return picture
+
+    def save(self):
+        if self._id is None:
+            # Identical uploads share a row, so reuse it if present
+            query = """INSERT INTO Picture (Filename) VALUES (%s)
+            ON DUPLICATE KEY UPDATE ID = LAST_INSERT_ID(ID)"""
+            self._id = self.execute_one(query, [self.filename])
+
+    @classmethod
+    def by_id(cls, _id):
+        query = """SELECT ID, Filename FROM Picture WHERE ID = %s"""
+        with connect_read() as cursor:
+            cursor.execute(query, [_id])
+            result = cursor.fetchone()
+
+        if result is None:
+            raise NotFoundException
+
+        return cls(result[1], result[0])
+
+    @classmethod
+    def from_recipe_id(cls, recipe_id):
+        """
+        Returns the pictures of the recipe with recipe_id
+        """
+        query = """SELECT P.ID, P.Filename
+        FROM Picture AS P JOIN Recipe_Picture AS RP ON P.ID = RP.PictureID
+        WHERE RP.RecipeID = %s ORDER BY RP.PictureID"""
+
+        with connect_read() as cursor:
+            cursor.execute(query, [recipe_id])
+            return [cls(filename, _id) for (_id, filename)
+                    in cursor.fetchall()]
+
+    def open(self, store=None):
+        """
+        Return an unbuffered file object for the picture contents.
+        """
+        return (store or picture_store()).open(self.filename)
+
+    def mmap(self, store=None):
+        """
+        Return a read-only memory map of the picture contents.
+        """
+        return (store or picture_store()).mmap(self.filename)
+
+    def delete(self, store=None):
+        """
+        Delete the picture from the database (unlinking it from all
+        recipes) and from the picture store.
+        """
+        if self._id is not None:
+            with transaction() as cursor:
+                cursor.execute("SELECT RecipeID FROM Recipe_Picture "
+                               "WHERE PictureID = %s", [self._id])
+                recipe_ids = [_id for (_id,) in cursor.fetchall()]
+
+                cursor.execute("DELETE FROM Picture WHERE ID = %s",
+                               [self._id])
+                record_changes(cursor, "Recipe", recipe_ids,
+                               Operation.UPDATE)
+
+            for recipe_id in recipe_ids:
+                invalidate_recipe(recipe_id)
+        after_commit(functools.partial(delete_pictures, [self.filename],
+                                       store))
+
+    def refresh(self):
+        pass
+
+    def __str__(self):
+        return "Picture %s" % self.filename
+
+    __repr__ = __str__
+
+    def __eq__(self, other):
+        return (isinstance(other, Picture)
+                and self.filename == other.filename)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+CookBookObject.register(Picture)
+
+
+class Comment(CookBookObject):
+
+    def __init__(self, text, date=None, author=None, _id=None):
+        """
+        Describe a comment on a recipe
+
+        Keyword arguments
+
+        text -- the text of the comment
+
+        date -- the date of the comment (a datetime.date), defaults to
+        today
+
+        author -- the name of the author of the comment, if any
+        """
+
+        super(Comment, self).__init__()
+        self.text = text
+        self.date = date or datetime.date.today()
+        self.author = author
+        self._id = _id
+        self.recipe_id = None
+
+    def link_to_recipe(self, recipe):
+        """
+        Set recipe_id to the id of recipe
+        """
+        assert self.recipe_id is None
+        self.recipe_id = recipe._id
+
+    @property
+    def cursor(self):
+        """
+        The position of this comment in its recipe's comment thread, to
+        be passed as after= to page_for_recipe().
+        """
+        return (self.date, self._id)
+
+    def save(self):
+        assert self.recipe_id is not None
+
+        if self._id is None:
+            with transaction() as cursor:
+                cursor.execute("INSERT INTO Comment (Date, Text) "
+                               "VALUES (%s, %s)", [self.date, self.text])
+                self._id = cursor.lastrowid
+
+                cursor.execute("INSERT INTO Recipe_Comment "
+                               "(RecipeID, CommentID, Date) "
+                               "VALUES (%s, %s, %s)",
+                               [self.recipe_id, self._id, self.date])
+
+                if self.author:
+                    cursor.execute("INSERT INTO Author (Name) VALUES (%s) "
+                                   "ON DUPLICATE KEY UPDATE "
+                                   "ID = LAST_INSERT_ID(ID)", [self.author])
+                    cursor.execute("INSERT INTO Comment_Author "
+                                   "(AuthorID, CommentID) VALUES (%s, %s)",
+                                   [cursor.lastrowid, self._id])
+
+                record_changes(cursor, "Recipe", [self.recipe_id],
+                               Operation.UPDATE)
+
+            invalidate_recipe(self.recipe_id)
+
+    @classmethod
+    def by_id(cls, _id):
+        query = """SELECT C.ID, C.Date, C.Text, A.Name, RC.RecipeID
+        FROM Comment AS C
+        LEFT JOIN Recipe_Comment AS RC ON RC.CommentID = C.ID
+        LEFT JOIN Comment_Author AS CA ON CA.CommentID = C.ID
+        LEFT JOIN Author AS A ON A.ID = CA.AuthorID
+        WHERE C.ID = %s"""
+
+        with connect_read() as cursor:
+            cursor.execute(query, [_id])
+            result = cursor.fetchone()
+
+        if result is None:
+            raise NotFoundException
+
+        (c_id, c_date, c_text, c_author, c_recipe_id) = result
+        comment = cls(c_text, date=c_date, author=c_author, _id=c_id)
+        comment.recipe_id = c_recipe_id
+        return comment
+
+    @classmethod
+    def page_for_recipe(cls, recipe_id, after=None, limit=COMMENT_PAGE_SIZE):
+        """
+        Return (comments, next) where comments are at most limit comments
+        on the recipe with recipe_id, newest first, and next is the
+        value to pass as after= to get the following page (None if this
+        was the last one).
+
+        Pages are found by seeking in the (RecipeID, Date, CommentID)
+        index rather than with OFFSET, so every page costs the same no
+        matter how far into the thread it is.
+        """
+        query = """SELECT C.ID, RC.Date, C.Text, A.Name
+        FROM Recipe_Comment AS RC
+        JOIN Comment AS C ON C.ID = RC.CommentID
+        LEFT JOIN Comment_Author AS CA ON CA.CommentID = C.ID
+        LEFT JOIN Author AS A ON A.ID = CA.AuthorID
+        WHERE RC.RecipeID = %s {seek}
+        ORDER BY RC.Date DESC, RC.CommentID DESC
+        LIMIT %s"""
+
+        arglist = [recipe_id]
+        seek = ""
+
+        if after is not None:
+            (after_date, after_id) = after
+            seek = ("AND (RC.Date < %s OR "
+                    "(RC.Date = %s AND RC.CommentID < %s))")
+            arglist += [after_date, after_date, after_id]
+
+        # Fetch one extra row to know if there is a next page
+        arglist.append(limit + 1)
+
+        with connect_read() as cursor:
+            cursor.execute(query.format(seek=seek), arglist)
+            rows = cursor.fetchall()
+
+        comments = []
+        for (c_id, c_date, c_text, c_author) in rows[:limit]:
+            comment = cls(c_text, date=c_date, author=c_author, _id=c_id)
+            comment.recipe_id = recipe_id
+            comments.append(comment)
+
+        next_page = comments[-1].cursor if len(rows) > limit else None
+        return (comments, next_page)
+
+    def delete(self):
+        if self._id is not None:
+            with transaction() as cursor:
+                cursor.execute("DELETE FROM Comment WHERE ID = %s",
+                               [self._id])
+                if self.recipe_id is not None:
+                    record_changes(cursor, "Recipe", [self.recipe_id],
+                                   Operation.UPDATE)
+            invalidate_recipe(self.recipe_id)
+
+    def refresh(self):
+        pass
+
+    def __str__(self):
+        return "%s (%s, %s)" % (self.text, self.author, self.date)
+
+    __repr__ = __str__
+
+    def __eq__(self, other):
+        return (isinstance(other, Comment)
+                and (self.text, self.date, self.author)
+                == (other.text, other.date, other.author))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+CookBookObject.register(Comment)
+
+
 class IngredientInUseException(Exception):
     pass
 
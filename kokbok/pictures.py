@@ -0,0 +1,119 @@
+import contextlib
+import hashlib
+import io
+import mmap
+import os
+import os.path
+import tempfile
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class PictureStore():
+    """
+    Store picture files on local disk, addressed by the SHA-256 hash
+    of their contents. Identical uploads end up in the same file.
+
+    Files are laid out as <root>/ab/cd/abcd..., to keep the number of
+    entries per directory down.
+    """
+
+    def __init__(self, root):
+        """
+        Keyword arguments
+
+        root -- the directory to keep the pictures in. It is created if
+        it does not exist.
+        """
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest):
+        """
+        Return the path of the file with the given digest (whether it
+        exists or not).
+        """
+        if len(digest) < 4 or not all(c in "0123456789abcdef"
+                                      for c in digest):
+            raise ValueError("not a valid picture digest: %r" % digest)
+
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def put(self, fileobj):
+        """
+        Copy the contents of the binary file-like object fileobj into the
+        store, CHUNK_SIZE bytes at a time, and return the hex digest
+        identifying it.
+        """
+        with self.stage(fileobj) as digest:
+            return digest
+
+    @contextlib.contextmanager
+    def stage(self, fileobj):
+        """
+        Copy the contents of fileobj into a temporary file and give
+        their digest; when the with block ends without raising, store
+        them unless an identical picture is stored by then. A reference
+        to the picture saved in the block thus can't be left without a
+        file by an identical picture deleted meanwhile.
+        """
+        sha = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    tmp.write(chunk)
+
+            digest = sha.hexdigest()
+            yield digest
+
+            final_path = self.path(digest)
+            # Already stored, keep the old copy
+            if not os.path.exists(final_path):
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, final_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def put_bytes(self, data):
+        """
+        Store data (a bytes object) and return its digest.
+        """
+        return self.put(io.BytesIO(data))
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def open(self, digest):
+        """
+        Return an unbuffered binary file object for the picture with the
+        given digest, suitable for passing to os.sendfile() or
+        wsgi.file_wrapper. Raises FileNotFoundError if not present.
+        """
+        return open(self.path(digest), 'rb', buffering=0)
+
+    def mmap(self, digest):
+        """
+        Return a read-only memory map of the picture with the given
+        digest. Raises FileNotFoundError if not present (and ValueError
+        for empty files, which cannot be mapped).
+        """
+        with self.open(digest) as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    def delete(self, digest):
+        """
+        Remove the picture with the given digest from disk, if present.
+        """
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,581 @@
+import collections
+import contextlib
+import itertools
+import json
+import os.path
+import random
+import re
+import tempfile
+
+import kokbok.model as model
+from kokbok.cache import RecipeCache
+from kokbok.routing import ReplicaRouter
+
+
+# Recipes in the synthetic database the plans are checked against
+DEFAULT_RECIPES = 5000
+
+# Scans and sorts of fewer rows than this are not worth an index
+SCAN_ROWS_THRESHOLD = 1000
+
+# EXPLAIN access types, best first
+ACCESS_TYPES = ['system', 'const', 'eq_ref', 'ref', 'fulltext',
+                'ref_or_null', 'index_merge', 'unique_subquery',
+                'index_subquery', 'range', 'index', 'ALL']
+
+# Statements that scan a whole table on purpose (batch jobs), as regular
+# expressions matched against normalised queries
+ALLOWED_SCANS = [r"^SELECT ID, Name FROM Ingredient ORDER BY ID$",
+                 r"^SELECT COUNT\(\*\) FROM Recipe$",
+                 r"^SELECT RecipeID, Version FROM RecipeSimilarPending$"]
+
+# Recipe.find() filters exercised by workload()
+FIND_WORKLOAD = [{},
+                 {'prep_max': 15},
+                 {'cook_min': 60},
+                 {'servings_min': 6},
+                 {'kcal_per_serving_between': (None, 400),
+                  'order_by': 'kcal_per_serving'},
+                 {'order_by': 'prep'},
+                 {'order_by': 'cook'},
+                 {'order_by': 'servings'},
+                 {'prep_max': 15, 'order_by': 'kcal_per_serving'},
+                 {'servings_min': 6, 'order_by': 'prep'},
+                 {'cook_min': 60, 'kcal_per_serving_between': (None, 400),
+                  'order_by': 'cook'}]
+
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE")
+
+CLAUSE_END = r"(?=\bORDER BY\b|\bGROUP BY\b|\bLIMIT\b|\bON DUPLICATE\b|$)"
+
+KEYWORDS = ["ON", "WHERE", "JOIN", "LEFT", "RIGHT", "INNER", "ORDER",
+            "GROUP", "LIMIT", "SET", "USING", "AS"]
+
+TABLE_REFERENCE = (r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)"
+                   r"(?:\s+(?:AS\s+)?(?!(?:%s)\b)(\w+))?" % "|".join(KEYWORDS))
+
+
+def normalise_query(query):
+    """
+    Return query with whitespace collapsed and IN lists of any length
+    written as IN (%s, ...), so that the statements issued for
+    different arguments compare equal.
+    """
+    query = " ".join(query.split())
+    return re.sub(r"\bIN \((%s, )*%s\)", "IN (%s, ...)", query)
+
+
+class QueryLog():
+    """
+    The distinct statements issued through the database driver, by
+    normalised query, with the arguments of the first call of each.
+    """
+
+    def __init__(self):
+        self.queries = collections.OrderedDict()
+
+    def add(self, query, args):
+        key = normalise_query(query)
+        if key not in self.queries:
+            self.queries[key] = (query, args)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries.items())
+
+
+class RecordingCursor():
+
+    def __init__(self, cursor, log):
+        self._cursor = cursor
+        self._log = log
+
+    def execute(self, query, args=None):
+        self._log.add(query, args)
+        return self._cursor.execute(query, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class RecordingConnection():
+
+    def __init__(self, conn, log):
+        self._conn = conn
+        self._log = log
+
+    def cursor(self, *args):
+        return RecordingCursor(self._conn.cursor(*args), self._log)
+
+    def __enter__(self):
+        return RecordingCursor(self._conn.__enter__(), self._log)
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class RecordingDriver():
+
+    def __init__(self, real, log):
+        self._real = real
+        self._log = log
+
+    def connect(self, **conf):
+        return RecordingConnection(self._real.connect(**conf), self._log)
+
+    def __getattr__(self, name):
+        return getattr(self._real, name)
+
+
+@contextlib.contextmanager
+def recording(log):
+    """
+    Add every statement executed by the model inside the block to the
+    QueryLog log. Statements run with executemany() are writes and
+    aren't recorded.
+    """
+    real = model.driver
+    recorder = RecordingDriver(real(), log)
+    model.driver = lambda: recorder
+    try:
+        yield log
+    finally:
+        model.driver = real
+
+
+@contextlib.contextmanager
+def synthetic_database(name=None):
+    """
+    Point the model at a new database named name (default: the
+    configured one with a _plans suffix), without replicas or a shared
+    recipe cache, and drop it at the end of the block.
+    """
+    saved = (model._dbconf, model._replica_router, model._recipe_cache)
+    conf = dict(model.get_dbconf())
+    conf['db'] = name or conf['db'] + "_plans"
+    tmp = tempfile.TemporaryDirectory()
+
+    model._dbconf = conf
+    model._replica_router = ReplicaRouter([])
+    model._recipe_cache = RecipeCache(os.path.join(tmp.name, "cache.sqlite"))
+    try:
+        model.db_init()
+        yield conf
+    finally:
+        server = dict(conf)
+        server.pop('db')
+        with model.connect(server) as cursor:
+            cursor.execute("DROP DATABASE IF EXISTS " + conf['db'])
+        (model._dbconf, model._replica_router, model._recipe_cache) = saved
+        tmp.cleanup()
+
+
+def synthetic_recipes(count, seed=0):
+    """
+    Return count random recipes in the format of importer.normalise(),
+    sharing ingredients, authors and categories like a real catalogue.
+    """
+    rng = random.Random(seed)
+    ingredients = ["ingrediens %d" % i for i in range(max(count // 10, 20))]
+    authors = ["Kock %d" % i for i in range(max(count // 25, 5))]
+    categories = ["kategori %d" % i for i in range(20)]
+
+    recipes = []
+    for i in range(count):
+        lists = [{'title': "del %d" % j if j else "",
+                  'ingredients': [{'name': name,
+                                   'quantity': rng.randint(1, 500),
+                                   'unit': model.Unit.G,
+                                   'prepnotes': None}
+                                  for name in rng.sample(ingredients,
+                                                         rng.randint(3, 10))]}
+                 for j in range(rng.randint(1, 2))]
+        recipes.append({'title': "recept %d" % i,
+                        'servings': rng.randint(1, 8),
+                        'cook_time_prep': rng.randint(5, 120),
+                        'cook_time_cook': rng.randint(0, 240),
+                        'description': "",
+                        'version': 1,
+                        'author': rng.choice(authors),
+                        'categories': rng.sample(categories, 2),
+                        'instructions': ["steg %d" % j
+                                         for j in range(rng.randint(2, 6))],
+                        'ingredients': lists})
+    return recipes
+
+
+def populate(recipes=DEFAULT_RECIPES, seed=0):
+    """
+    Fill the (new) database with recipes synthetic recipes, some with
+    comments and pictures, the nutrition of their ingredients, similar
+    recipes and index statistics.
+    """
+    from kokbok import cli, similar
+    from kokbok.importer import Importer, chunks
+
+    rng = random.Random(seed)
+    importer = Importer(connections=1, match_threshold=1.0)
+    try:
+        for batch in chunks(synthetic_recipes(recipes, seed),
+                            importer.batch_size):
+            importer.write_batch(batch)
+    finally:
+        importer.close()
+
+    with model.connect() as cursor:
+        cursor.execute("SELECT ID FROM Ingredient")
+        for (_id,) in cursor.fetchall():
+            cursor.execute("UPDATE Ingredient SET Energy = %s, Protein = %s "
+                           "WHERE ID = %s", [rng.randint(0, 900),
+                                             rng.randint(0, 40), _id])
+        cursor.execute("SELECT ID FROM Recipe")
+        recipe_ids = [_id for (_id,) in cursor.fetchall()]
+        model.update_kcal_per_serving(cursor, recipe_ids)
+
+    for _id in rng.sample(recipe_ids, min(len(recipe_ids), 200)):
+        recipe = model.Recipe.by_id_uncached(_id)
+        for n in range(rng.randint(1, 5)):
+            recipe.add_comment("kommentar %d" % n, author="Kock 0")
+        recipe.link_pictures([model.Picture("%064x" % _id)])
+
+    similar.rebuild()
+
+    with model.connect() as cursor:
+        cursor.execute("ANALYZE TABLE " + ", ".join(
+            cli.TABLES + ["Recipe_Instruction", "Recipe_Comment",
+                          "Recipe_Picture", "Author_Recipe",
+                          "Recipe_RecipeCategory", "RecipeSimilar",
+                          "ChangeOutbox"]))
+        cursor.fetchall()
+
+
+def workload(sample=20, seed=0):
+    """
+    Run the queries the model issues when serving requests: loading
+    recipes with their comments, similar recipes, categories and
+    revisions, finding recipes, and saving and deleting a recipe; and
+    the ones of the jobs following them: reading and checkpointing the
+    change feed, importing, merging ingredients, updating similar
+    recipes and refreshing the export.
+    """
+    from kokbok import export, fuzzy, similar
+    from kokbok.changes import ChangeFeed
+    from kokbok.importer import Importer
+    from kokbok.pictures import PictureStore
+
+    rng = random.Random(seed)
+    recipe_ids = list(itertools.islice(model.Recipe.iter_ids(), 10000))
+
+    with model.primary_reads():
+        for _id in rng.sample(recipe_ids, min(sample, len(recipe_ids))):
+            recipe = model.Recipe.by_id_uncached(_id)
+            recipe.similar(10)
+            (comments, after) = recipe.comment_page(limit=2)
+            if after is not None:
+                recipe.comment_page(after=after, limit=2)
+            for comment in comments:
+                model.Comment.by_id(comment._id)
+            for picture in recipe.pictures:
+                model.Picture.by_id(picture._id)
+            model.revision("Recipe", _id)
+
+            ingredient = recipe.ingredient_lists[0].ingredients[0]
+            ingredient = model.Ingredient.by_id(ingredient['ingredient']._id)
+            ingredient.categories()
+            model.revision("Ingredient", ingredient._id)
+
+        for filters in FIND_WORKLOAD:
+            (ids, after) = model.Recipe.find(**filters)
+            if after is not None:
+                model.Recipe.find(after=after, **filters)
+
+        feed = ChangeFeed("plans")
+        batch = feed.read()
+        if batch:
+            feed.commit(batch[-1].id)
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "export")
+        export.export(path)
+
+        importer = Importer(connections=1, match_threshold=1.0)
+        try:
+            importer.write_batch([dict(r, title="importerat %d" % i)
+                                  for (i, r) in enumerate(
+                                      synthetic_recipes(2, seed + 1))])
+        finally:
+            importer.close()
+
+        flour = model.Ingredient.by_id(recipe.ingredient_ids()[0])
+        duplicate = model.Ingredient("dubblett", 1, 2, 3, 4, 5, None, None)
+        duplicate.save()
+        recipe = model.Recipe.new(
+            title="recept", servings=4, cook_time_prep=10,
+            cook_time_cook=20,
+            ingredients=[{'title': '',
+                          'ingredients': [{'unit': model.Unit.G,
+                                           'quantity': quantity,
+                                           'prepnotes': None,
+                                           'ingredient': ingredient}
+                                          for (ingredient, quantity)
+                                          in ((flour, 100),
+                                              (duplicate, 50))]}],
+            author="Kock 0", instructions=["Blanda", "Baka"],
+            description="", version=1, categories=["kategori 0"])
+        recipe.add_comment("gott")
+        recipe.link_pictures([model.Picture("f" * 64)])
+
+        fuzzy.merge_ingredients(flour._id, [duplicate._id])
+        similar.update_pending()
+        export.refresh_from_changes(path)
+
+        recipe.delete(store=PictureStore(root))
+
+
+def explain(cursor, query, args):
+    """
+    Return the rows of EXPLAIN for query with args, as dicts.
+    """
+    cursor.execute("EXPLAIN " + query, args)
+    columns = [c[0] for c in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def summarise(plan):
+    """
+    Return the parts of the EXPLAIN rows plan that are compared between
+    runs, one dict per table.
+    """
+    return [{'table': row['table'],
+             'type': row['type'],
+             'key': row.get('key'),
+             'rows': row.get('rows') or 0,
+             'filesort': "Using filesort" in (row.get('Extra') or ""),
+             'temporary': "Using temporary" in (row.get('Extra') or "")}
+            for row in plan if row.get('table')]
+
+
+def problems(query, steps, threshold=SCAN_ROWS_THRESHOLD,
+             allowed=ALLOWED_SCANS):
+    """
+    Return descriptions of the full scans and sorts of at least
+    threshold rows in the summarised plan steps of query. Scans of
+    whole indexes cut short by a LIMIT are fine.
+    """
+    if any(re.search(pattern, query) for pattern in allowed):
+        return []
+
+    found = []
+    limited = re.search(r"\bLIMIT\b", query) is not None
+    for step in steps:
+        if step['rows'] < threshold:
+            continue
+        if step['type'] == 'ALL' or (step['type'] == 'index' and
+                                     not limited):
+            found.append("scans %s (%d rows)" % (step['table'],
+                                                  step['rows']))
+        if step['filesort']:
+            found.append("sorts %s (%d rows)" % (step['table'],
+                                                  step['rows']))
+        if step['temporary']:
+            found.append("temporary table for %s (%d rows)"
+                         % (step['table'], step['rows']))
+    return found
+
+
+def regressions(baseline, steps):
+    """
+    Return descriptions of how the summarised plan steps are worse
+    than the ones in baseline: a worse access type for a table, or a
+    new filesort or temporary table.
+    """
+    before = dict((step['table'], step) for step in baseline)
+    found = []
+    for step in steps:
+        old = before.get(step['table'])
+        if old is None:
+            continue
+        if (step['type'] in ACCESS_TYPES and old['type'] in ACCESS_TYPES and
+                ACCESS_TYPES.index(step['type']) >
+                ACCESS_TYPES.index(old['type'])):
+            found.append("%s: %s (%s) -> %s (%s)"
+                         % (step['table'], old['type'], old['key'],
+                            step['type'], step['key']))
+        for flag in ('filesort', 'temporary'):
+            if step[flag] and not old[flag]:
+                found.append("%s: new %s" % (step['table'], flag))
+    return found
+
+
+def table_aliases(query):
+    """
+    Return a dict from the names (and aliases) tables are referred to
+    by in query to the tables.
+    """
+    aliases = {}
+    for (table, alias) in re.findall(TABLE_REFERENCE, query, re.I):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+
+def suggest_index(query, table, indexes=()):
+    """
+    Return the columns of an index on table that would serve query, or
+    None if there is no clear candidate or one of indexes (lists of
+    column names) already starts with them.
+
+    Columns compared with a value come first, then the ORDER BY columns
+    if they are all on this table, or else the first range condition.
+    A table without conditions of its own is looked up by its side of
+    the join conditions instead.
+    """
+    aliases = table_aliases(query)
+    names = [name for (name, t) in aliases.items() if t == table]
+    single = len(set(aliases.values())) == 1
+
+    where = re.search(r"\bWHERE\b(.*?)" + CLAUSE_END, query)
+    where = where.group(1) if where else ""
+    order = re.search(r"\bORDER BY\b(.*?)" + CLAUSE_END, query)
+    order = order.group(1).split(",") if order else []
+
+    def columns(pattern, text, qualified):
+        qualifier = r"\b(?:%s)\." % "|".join(names)
+        if not qualified:
+            qualifier = "(?:%s)?" % qualifier
+        found = []
+        for column in re.findall(qualifier + r"(\w+)" + pattern, text):
+            if column.upper() not in KEYWORDS and column not in found:
+                found.append(column)
+        return found
+
+    equal = columns(r"\s*(?:=\s*%s|IN\s*\()", where, not single)
+    ranged = columns(r"\s*(?:[<>]=?|BETWEEN)", where, not single)
+    driving = single or bool(equal or ranged)
+
+    if not driving:
+        for pair in re.findall(r"\bON\s+(\w+\.\w+)\s*=\s*(\w+\.\w+)",
+                               query):
+            for side in pair:
+                (name, column) = side.split(".")
+                if name in names and column not in equal:
+                    equal.append(column)
+
+    # Unqualified sort columns can only be served by the driving table
+    ordered = [c for part in order
+               for c in columns(r"(?:\s+(?:ASC|DESC))?\s*$", part,
+                                not driving)]
+
+    if order and len(ordered) == len(order):
+        wanted = equal + [c for c in ordered if c not in equal]
+    else:
+        wanted = equal + [c for c in ranged[:1] if c not in equal]
+
+    if not wanted:
+        return None
+    for index in indexes:
+        if list(index[:len(wanted)]) == wanted:
+            return None
+    return wanted
+
+
+def table_indexes(cursor, table):
+    """
+    Return the indexes of table as lists of column names.
+    """
+    cursor.execute("SHOW INDEX FROM " + table)
+    columns = [c[0] for c in cursor.description]
+    indexes = collections.OrderedDict()
+    for row in cursor.fetchall():
+        row = dict(zip(columns, row))
+        indexes.setdefault(row['Key_name'], []).append(row['Column_name'])
+    return list(indexes.values())
+
+
+def analyse(log, threshold=SCAN_ROWS_THRESHOLD):
+    """
+    Return {normalised query: {'plan': steps, 'problems': [...],
+    'suggestions': [...]}} for the statements in the QueryLog log that
+    can be explained.
+    """
+    report = collections.OrderedDict()
+    indexes = {}
+
+    with model.connect() as cursor:
+        for (key, (query, args)) in log:
+            if key.split(" ", 1)[0].upper() not in EXPLAINABLE:
+                continue
+
+            steps = summarise(explain(cursor, query, args))
+            found = problems(key, steps, threshold)
+
+            suggestions = []
+            if found:
+                for table in sorted(set(s['table'] for s in steps)):
+                    if table not in indexes:
+                        try:
+                            indexes[table] = table_indexes(cursor, table)
+                        except model.driver().MySQLError:
+                            # An alias or derived table
+                            continue
+                    wanted = suggest_index(key, table, indexes[table])
+                    if wanted:
+                        suggestions.append(
+                            "ALTER TABLE %s ADD INDEX %s_%s (%s)"
+                            % (table, table, "_".join(wanted),
+                               ", ".join(wanted)))
+
+            report[key] = {'plan': steps, 'problems': found,
+                           'suggestions': suggestions}
+    return report
+
+
+def run(recipes=DEFAULT_RECIPES, threshold=SCAN_ROWS_THRESHOLD):
+    """
+    Build a synthetic database with recipes recipes, run the workload
+    against it and return the analyse() report of its queries.
+    """
+    with synthetic_database():
+        populate(recipes)
+        log = QueryLog()
+        with recording(log):
+            workload()
+        return analyse(log, threshold)
+
+
+def check(report, baseline):
+    """
+    Return [(query, description)] for the problems in report and its
+    regressions from baseline, a {query: plan steps} dict saved by
+    save_baseline().
+    """
+    failures = []
+    for (query, entry) in report.items():
+        for problem in entry['problems']:
+            failures.append((query, problem))
+        for regression in regressions(baseline.get(query, []),
+                                      entry['plan']):
+            failures.append((query, regression))
+    return failures
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path, report):
+    plans = collections.OrderedDict((query, entry['plan'])
+                                    for (query, entry) in report.items())
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(plans, f, indent=2, sort_keys=True)
+        f.write("\n")
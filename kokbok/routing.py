@@ -0,0 +1,239 @@
+import contextlib
+import os
+import threading
+import time
+
+
+ROUND_ROBIN = "round-robin"
+LEAST_LOADED = "least-loaded"
+
+# Replicas further behind the primary than this (in seconds) get no reads
+DEFAULT_MAX_LAG = 5
+
+# How often (in seconds) to ask a replica how far behind it is
+DEFAULT_LAG_CHECK_INTERVAL = 5
+
+# Lag readings older than this many check intervals (e.g. while the
+# probe is stuck on a hung server) aren't trusted
+STALE_CHECKS = 3
+
+
+def replica_lag(cursor):
+    """
+    Return the number of seconds the server behind cursor lags behind
+    its primary, 0 if it isn't replicating from anything and None if
+    replication is broken.
+    """
+    try:
+        cursor.execute("SHOW REPLICA STATUS")
+    except Exception:
+        # Before MySQL 8.0.22
+        cursor.execute("SHOW SLAVE STATUS")
+
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+
+    columns = [c[0] for c in cursor.description]
+    for name in ("Seconds_Behind_Source", "Seconds_Behind_Master"):
+        if name in columns:
+            return row[columns.index(name)]
+
+    return None
+
+
+class ReplicaRouter():
+    """
+    Decide which server reads go to.
+
+    Reads are spread over the replicas that are no more than max_lag
+    seconds behind the primary. A thread that has written to the
+    primary reads from the primary for the next max_lag seconds, so
+    that it sees its own writes; so does code inside primary_reads().
+
+    The lag of every replica is probed by a background thread of its
+    own, so that picking a replica never waits for a server, and a
+    replica that doesn't answer only holds up its own readings. Until
+    a replica has been probed, it gets no reads.
+    """
+
+    def __init__(self, replicas, strategy=ROUND_ROBIN,
+                 max_lag=DEFAULT_MAX_LAG,
+                 lag_check_interval=DEFAULT_LAG_CHECK_INTERVAL,
+                 probe=None, clock=time.time, background=True):
+        """
+        Keyword arguments
+
+        replicas -- a list of connection config dicts, one per replica
+
+        strategy -- ROUND_ROBIN, or LEAST_LOADED to pick the replica with
+        the fewest reads in progress
+
+        max_lag -- the replication lag in seconds beyond which a replica
+        is not used
+
+        lag_check_interval -- how often in seconds to probe the lag
+
+        probe -- a function taking a replica config and returning its
+        lag in seconds (None if unknown); without it, replicas are
+        assumed to be up to date
+
+        clock -- a function returning the current time
+
+        background -- whether to start the probing threads on the first
+        acquire(); otherwise replicas are only probed by probe_once()
+        """
+        if strategy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError("unknown replica strategy: %s" % strategy)
+
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.probe = probe
+        self.clock = clock
+        self.background = background
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._in_flight = [0] * len(self.replicas)
+        self._lag = [(None, 0)] * len(self.replicas)
+        self._local = threading.local()
+        # The process the probing threads run in (they don't survive a
+        # fork)
+        self._probing_pid = None
+        self._closed = threading.Event()
+
+    def note_write(self):
+        """
+        Record that the current thread has written to the primary.
+        """
+        self._local.last_write = self.clock()
+
+    def reading_own_writes(self):
+        """
+        Return whether reads in the current thread must go to the
+        primary.
+        """
+        if getattr(self._local, 'primary_reads', 0):
+            return True
+
+        last_write = getattr(self._local, 'last_write', None)
+        return (last_write is not None
+                and self.clock() - last_write < self.max_lag)
+
+    @contextlib.contextmanager
+    def primary_reads(self):
+        """
+        Make the current thread read from the primary within a with
+        block.
+        """
+        self._local.primary_reads = getattr(self._local, 'primary_reads',
+                                            0) + 1
+        try:
+            yield
+        finally:
+            self._local.primary_reads -= 1
+
+    def probe_once(self, index):
+        """
+        Probe the lag of replica number index and record it.
+        """
+        try:
+            lag = self.probe(self.replicas[index])
+        except Exception:
+            lag = None
+
+        with self._lock:
+            self._lag[index] = (lag, self.clock())
+
+    def _probe_forever(self, index):
+        delay = 0
+        while not self._closed.wait(delay):
+            started = time.time()
+            self.probe_once(index)
+            delay = max(0, self.lag_check_interval -
+                        (time.time() - started))
+
+    def close(self):
+        """
+        Stop probing the replicas.
+        """
+        self._closed.set()
+
+    def _start_probing(self):
+        with self._lock:
+            if self._probing_pid == os.getpid():
+                return
+            self._probing_pid = os.getpid()
+
+        for index in range(len(self.replicas)):
+            thread = threading.Thread(target=self._probe_forever,
+                                      args=(index,), daemon=True,
+                                      name="replica-probe-%d" % index)
+            thread.start()
+
+    def lag(self, index):
+        """
+        Return the last lag reading of replica number index, or None if
+        there is no recent one.
+        """
+        if self.probe is None:
+            return 0
+
+        with self._lock:
+            (lag, checked) = self._lag[index]
+        if (not checked or self.clock() - checked >
+                STALE_CHECKS * self.lag_check_interval):
+            return None
+        return lag
+
+    def healthy(self):
+        """
+        Return the indexes of the replicas that are fit for reading.
+        """
+        healthy = []
+        for index in range(len(self.replicas)):
+            lag = self.lag(index)
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(index)
+        return healthy
+
+    def acquire(self):
+        """
+        Return the index of the replica to read from, or None to read
+        from the primary. Must be paired with release().
+        """
+        if not self.replicas or self.reading_own_writes():
+            return None
+
+        if (self.probe is not None and self.background and
+                self._probing_pid != os.getpid() and
+                not self._closed.is_set()):
+            self._start_probing()
+
+        candidates = self.healthy()
+        if not candidates:
+            return None
+
+        with self._lock:
+            if self.strategy == LEAST_LOADED:
+                n = len(self.replicas)
+                index = min(candidates,
+                            key=lambda i: (self._in_flight[i],
+                                           (i - self._next) % n))
+            else:
+                index = candidates[0]
+                for i in candidates:
+                    if i >= self._next % len(self.replicas):
+                        index = i
+                        break
+            self._next = index + 1
+            self._in_flight[index] += 1
+
+        return index
+
+    def release(self, index):
+        if index is not None:
+            with self._lock:
+                self._in_flight[index] -= 1
@@ -0,0 +1,450 @@
+import contextlib
+import itertools
+import re
+import time
+
+import numpy as np
+import scipy.sparse
+
+from kokbok.model import Unit, connect, connect_read
+
+
+# Number of neighbours kept per recipe
+DEFAULT_K = 10
+
+# Number of recipes compared against the catalogue at a time; the
+# similarities of a batch take batch_size * (number of recipes) floats
+DEFAULT_BATCH_SIZE = 128
+
+# Amounts that can't be converted to grammes count as this much
+DEFAULT_GRAMS = 100
+
+# Rows written per INSERT
+WRITE_CHUNK = 1000
+
+# IDs per IN list of a query
+QUERY_CHUNK = 1000
+
+# rebuild() fills this table and then swaps it for RecipeSimilar
+SHADOW_TABLE = "RecipeSimilarShadow"
+
+# Named lock held by rebuild() and update_pending(), and the seconds
+# rebuild() waits for it
+LOCK_NAME = "kokbok.similar"
+LOCK_TIMEOUT = 600
+
+ENTRY_QUERY = """SELECT IL.RecipeID, ILI.IngredientID, ILI.Magnitude, ILI.Unit,
+    I.GramsPerMilliliter, I.GramsPerUnit
+    FROM IngredientList AS IL
+    JOIN IngredientList_Ingredient AS ILI ON ILI.IngredientListID = IL.ID
+    JOIN Ingredient AS I ON I.ID = ILI.IngredientID"""
+
+
+def grams(quantity, unit, gramspermilliliter, gramsperunit):
+    """
+    Return quantity of unit as grammes of an ingredient, or None if the
+    ingredient lacks the needed conversion factor.
+    """
+    if quantity is None:
+        return None
+    if unit == Unit.G:
+        return float(quantity)
+    if unit == Unit.ML and gramspermilliliter:
+        return float(quantity * gramspermilliliter)
+    if unit == Unit.PCS and gramsperunit:
+        return float(quantity * gramsperunit)
+    return None
+
+
+def build_matrix(entries, recipe_ids=(), frequencies=None):
+    """
+    Return (recipe IDs, matrix) where row i of the sparse matrix is the
+    ingredient vector of recipe ID i, normalised to unit length.
+
+    entries are (recipe ID, ingredient ID, grammes) triples; recipes in
+    recipe_ids get a row even without any entries. An ingredient is
+    weighted by log(1 + grammes) times its inverse recipe frequency, so
+    that water and salt don't make every recipe look alike.
+
+    The frequencies are counted in entries, unless given as (number of
+    recipes, {ingredient ID: number of recipes using it}) for entries
+    that are only part of the catalogue.
+    """
+    entries = list(entries)
+    entry_recipes = np.array([e[0] for e in entries], dtype=np.int64)
+    entry_ingredients = np.array([e[1] for e in entries], dtype=np.int64)
+    entry_grams = np.array([DEFAULT_GRAMS if e[2] is None else e[2]
+                            for e in entries], dtype=np.float64)
+
+    rids = np.union1d(entry_recipes, np.array(list(recipe_ids),
+                                              dtype=np.int64))
+    iids = np.unique(entry_ingredients)
+
+    matrix = scipy.sparse.csr_matrix(
+        (np.log1p(np.maximum(entry_grams, 0)),
+         (np.searchsorted(rids, entry_recipes),
+          np.searchsorted(iids, entry_ingredients))),
+        shape=(len(rids), len(iids)))
+    matrix.sum_duplicates()
+
+    if len(rids) and len(iids):
+        if frequencies is None:
+            total = len(rids)
+            frequency = np.bincount(matrix.indices, minlength=len(iids))
+        else:
+            (total, counts) = frequencies
+            frequency = np.array([counts.get(int(_id), 0) for _id in iids],
+                                 dtype=np.int64)
+        idf = np.log(float(total) / np.maximum(frequency, 1))
+        matrix = matrix.dot(scipy.sparse.diags(idf, 0)).tocsr()
+
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1))
+                        .ravel())
+        norms[norms == 0] = 1
+        matrix = scipy.sparse.diags(1 / norms, 0).dot(matrix).tocsr()
+
+    return (rids, matrix.astype(np.float32))
+
+
+def top_k(matrix, rows, k=DEFAULT_K, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yield (row, [(neighbour row, score)]) with the (at most) k rows of
+    matrix most cosine-similar to each of rows, best first. Rows with
+    no similarity at all are not neighbours.
+    """
+    n = matrix.shape[0]
+    k = min(k, n - 1)
+    rows = np.asarray(rows, dtype=np.int64)
+    transposed = matrix.T.tocsc()
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        sims = matrix[batch].dot(transposed).toarray()
+        sims[np.arange(len(batch)), batch] = 0
+
+        if k <= 0:
+            for row in batch:
+                yield (row, [])
+            continue
+
+        best = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        scores = sims[np.arange(len(batch))[:, np.newaxis], best]
+        order = np.argsort(-scores, axis=1, kind='mergesort')
+
+        for i, row in enumerate(batch):
+            yield (row, [(best[i, j], float(scores[i, j]))
+                         for j in order[i] if scores[i, j] > 0])
+
+
+def select_in(cursor, query, ids, suffix=""):
+    """
+    Return the rows of query, which ends in "IN", for the IDs in ids,
+    querying QUERY_CHUNK of them at a time. suffix is appended to every
+    query.
+    """
+    ids = list(ids)
+    rows = []
+    for start in range(0, len(ids), QUERY_CHUNK):
+        chunk = ids[start:start + QUERY_CHUNK]
+        cursor.execute(query + " (" + ", ".join(["%s"] * len(chunk)) + ")" +
+                       suffix, chunk)
+        rows.extend(cursor.fetchall())
+    return rows
+
+
+def chunks(ids, size):
+    """
+    Yield the items of the list ids, size at a time.
+    """
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def load_entries(cursor, recipe_ids=None):
+    """
+    Return the (recipe ID, ingredient ID, grammes) entries of the
+    recipes with recipe_ids (default: all recipes), for build_matrix().
+    """
+    if recipe_ids is None:
+        cursor.execute(ENTRY_QUERY)
+        rows = cursor.fetchall()
+    else:
+        rows = select_in(cursor, ENTRY_QUERY + " WHERE IL.RecipeID IN",
+                         recipe_ids)
+
+    return [(recipe_id, ingredient_id, grams(quantity, unit, gpm, gpu))
+            for (recipe_id, ingredient_id, quantity, unit, gpm, gpu) in rows]
+
+
+def load_matrix():
+    """
+    Return build_matrix() for all recipes in the database.
+    """
+    with connect_read() as cursor:
+        cursor.execute("SELECT ID FROM Recipe")
+        recipe_ids = [_id for (_id,) in cursor.fetchall()]
+        entries = load_entries(cursor)
+
+    return build_matrix(entries, recipe_ids)
+
+
+def count_recipes(cursor, ingredient_ids, counts):
+    """
+    Add the number of recipes using each of ingredient_ids that isn't
+    in the dict counts yet to it.
+    """
+    missing = sorted(set(ingredient_ids) - set(counts))
+    counts.update(dict.fromkeys(missing, 0))
+    counts.update(select_in(
+        cursor, "SELECT ILI.IngredientID, COUNT(DISTINCT IL.RecipeID) "
+        "FROM IngredientList_Ingredient AS ILI "
+        "JOIN IngredientList AS IL ON IL.ID = ILI.IngredientListID "
+        "WHERE ILI.IngredientID IN", missing, " GROUP BY ILI.IngredientID"))
+
+
+def neighbourhood(cursor, recipe_ids, total, counts):
+    """
+    Return (recipe IDs, matrix, rows): build_matrix() for the recipes
+    with the sorted recipe_ids and every recipe that shares an
+    ingredient with one of them, which are the only ones that can be
+    similar to them, and the rows of recipe_ids in it.
+
+    total is the number of recipes in the catalogue, and counts the
+    recipe frequencies of ingredients, filled in with count_recipes().
+    """
+    entries = load_entries(cursor, recipe_ids)
+    ingredient_ids = set(e[1] for e in entries)
+    count_recipes(cursor, ingredient_ids, counts)
+
+    # Ingredients in every recipe weigh nothing
+    shared = sorted(_id for _id in ingredient_ids if counts[_id] < total)
+    others = set(_id for (_id,) in select_in(
+        cursor, "SELECT DISTINCT IL.RecipeID "
+        "FROM IngredientList_Ingredient AS ILI "
+        "JOIN IngredientList AS IL ON IL.ID = ILI.IngredientListID "
+        "WHERE ILI.IngredientID IN", shared))
+    entries.extend(load_entries(cursor, sorted(others - set(recipe_ids))))
+    count_recipes(cursor, (e[1] for e in entries), counts)
+
+    (rids, matrix) = build_matrix(entries, recipe_ids, (total, counts))
+    return (rids, matrix, np.searchsorted(rids, recipe_ids))
+
+
+def thresholds(cursor, rids, k):
+    """
+    Return the scores a recipe must beat to make it into the stored
+    neighbour lists of the recipes with IDs rids: the worst score in
+    full lists, and 0 in shorter ones.
+    """
+    positions = dict((int(_id), row) for (row, _id) in enumerate(rids))
+    result = np.zeros(len(rids), dtype=np.float32)
+    for (_id, worst, count) in select_in(
+            cursor, "SELECT RecipeID, MIN(Score), COUNT(*) "
+            "FROM RecipeSimilar WHERE RecipeID IN", [int(_id) for _id in rids],
+            " GROUP BY RecipeID"):
+        if count >= k:
+            result[positions[_id]] = worst
+    return result
+
+
+def by_id(rids, neighbours):
+    """
+    Yield the (row, [(neighbour row, score)]) from top_k() as (recipe
+    ID, [(neighbour recipe ID, score)]).
+    """
+    for (row, similar) in neighbours:
+        yield (int(rids[row]), [(int(rids[other]), score)
+                                for (other, score) in similar])
+
+
+def insert(cursor, neighbours, table="RecipeSimilar"):
+    """
+    Insert neighbours, a list of (recipe ID, [(neighbour recipe ID,
+    score)]), into table. Recipes deleted meanwhile are skipped.
+    """
+    rows = [(recipe_id, position, other, score)
+            for (recipe_id, similar) in neighbours
+            for position, (other, score) in enumerate(similar, start=1)]
+
+    for start in range(0, len(rows), WRITE_CHUNK):
+        cursor.executemany("INSERT IGNORE INTO " + table +
+                           " (RecipeID, Position, SimilarRecipeID, Score) "
+                           "VALUES (%s, %s, %s, %s)",
+                           rows[start:start + WRITE_CHUNK])
+
+
+def store(cursor, neighbours):
+    """
+    Replace the stored neighbour lists of the recipes in neighbours, a
+    list of (recipe ID, [(neighbour recipe ID, score)]).
+    """
+    for chunk in chunks([recipe_id for (recipe_id, _) in neighbours],
+                        WRITE_CHUNK):
+        cursor.execute("DELETE FROM RecipeSimilar WHERE RecipeID IN (" +
+                       ", ".join(["%s"] * len(chunk)) + ")", chunk)
+    insert(cursor, neighbours)
+
+
+def shadow_definition(ddl, suffix):
+    """
+    Return the CREATE TABLE statement of SHADOW_TABLE, from the one of
+    RecipeSimilar. Constraint names must be unique in the database and
+    survive the swap, so they are numbered with suffix.
+    """
+    ddl = re.sub(r"^CREATE TABLE `RecipeSimilar`",
+                 "CREATE TABLE `%s`" % SHADOW_TABLE, ddl)
+    numbers = itertools.count(1)
+    return re.sub(r"CONSTRAINT `\w+`",
+                  lambda match: "CONSTRAINT `RecipeSimilar_%s_%d`" %
+                  (suffix, next(numbers)), ddl)
+
+
+@contextlib.contextmanager
+def similar_lock(timeout):
+    """
+    Hold the named lock LOCK_NAME in the with block, waiting at most
+    timeout seconds for it. Gives whether the lock was acquired.
+    """
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT GET_LOCK(%s, %s)", [LOCK_NAME, timeout])
+        (acquired,) = cursor.fetchone()
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", [LOCK_NAME])
+    finally:
+        conn.close()
+
+
+def pending_versions(cursor):
+    """
+    Return the (recipe ID, version) of the recipes queued for an update.
+    """
+    cursor.execute("SELECT RecipeID, Version FROM RecipeSimilarPending")
+    return list(cursor.fetchall())
+
+
+def dequeue(cursor, pending):
+    """
+    Remove the recipes in pending, as from pending_versions(), from the
+    queue unless they have been queued again since.
+    """
+    cursor.executemany("DELETE FROM RecipeSimilarPending "
+                       "WHERE RecipeID = %s AND Version = %s", pending)
+
+
+def rebuild(k=DEFAULT_K, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Recompute the neighbour lists of all recipes. Returns the number
+    of recipes.
+
+    The lists are written to SHADOW_TABLE and swapped in at the end,
+    so readers see the old lists until then.
+    """
+    with similar_lock(LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            raise RuntimeError("similar recipes are already being updated")
+
+        with connect() as cursor:
+            pending = pending_versions(cursor)
+        (rids, matrix) = load_matrix()
+
+        with connect() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS " + SHADOW_TABLE)
+            cursor.execute("SHOW CREATE TABLE RecipeSimilar")
+            (_, ddl) = cursor.fetchone()
+            cursor.execute(shadow_definition(ddl, "%x" % int(time.time())))
+
+        neighbours = []
+        for item in by_id(rids, top_k(matrix, range(len(rids)), k,
+                                      batch_size)):
+            neighbours.append(item)
+            if len(neighbours) >= WRITE_CHUNK:
+                with connect() as cursor:
+                    insert(cursor, neighbours, SHADOW_TABLE)
+                neighbours = []
+
+        with connect() as cursor:
+            insert(cursor, neighbours, SHADOW_TABLE)
+
+        with connect() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS RecipeSimilarOld")
+            cursor.execute("RENAME TABLE RecipeSimilar TO RecipeSimilarOld, " +
+                           SHADOW_TABLE + " TO RecipeSimilar")
+            cursor.execute("DROP TABLE RecipeSimilarOld")
+            dequeue(cursor, pending)
+
+    return len(rids)
+
+
+def update(recipe_ids, k=DEFAULT_K, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Update the neighbour lists after the recipes with recipe_ids have
+    changed: theirs, the ones that list any of them, and the ones they
+    now belong in. Returns the number of lists recomputed.
+
+    Only the recipes sharing an ingredient with the ones recomputed are
+    loaded, batch_size recipes at a time.
+    """
+    recipe_ids = sorted(set(int(_id) for _id in recipe_ids))
+
+    with connect_read() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM Recipe")
+        (total,) = cursor.fetchone()
+        counts = {}
+
+        touched = [_id for (_id,) in select_in(
+            cursor, "SELECT ID FROM Recipe WHERE ID IN", recipe_ids)]
+        recompute = set(touched)
+        recompute.update(_id for (_id,) in select_in(
+            cursor, "SELECT DISTINCT RecipeID FROM RecipeSimilar "
+            "WHERE SimilarRecipeID IN", recipe_ids))
+
+        # Recipes that one of the touched recipes would now make it into
+        for batch in chunks(sorted(touched), batch_size):
+            (rids, matrix, rows) = neighbourhood(cursor, batch, total, counts)
+            sims = matrix[rows].dot(matrix.T.tocsc()).toarray()
+            sims[np.arange(len(rows)), rows] = 0
+            qualifying = (sims > thresholds(cursor, rids, k)).any(axis=0)
+            recompute.update(int(_id) for _id in rids[qualifying])
+
+        neighbours = []
+        for batch in chunks(sorted(recompute), batch_size):
+            (rids, matrix, rows) = neighbourhood(cursor, batch, total, counts)
+            neighbours.extend(by_id(rids, top_k(matrix, rows, k,
+                                                batch_size)))
+
+    for chunk in chunks(neighbours, WRITE_CHUNK):
+        with connect() as cursor:
+            store(cursor, chunk)
+
+    return len(neighbours)
+
+
+def update_pending(k=DEFAULT_K, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Update the neighbour lists for the recipes saved since the last
+    update (see Recipe.save). Returns the number of lists recomputed,
+    0 if rebuild() is running.
+
+    Recipes queued again while they are being updated stay queued.
+    """
+    with similar_lock(0) as acquired:
+        if not acquired:
+            return 0
+
+        with connect() as cursor:
+            pending = pending_versions(cursor)
+
+        if not pending:
+            return 0
+
+        updated = update([_id for (_id, _) in pending], k, batch_size)
+
+        with connect() as cursor:
+            dequeue(cursor, pending)
+
+    return updated
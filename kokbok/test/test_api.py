@@ -0,0 +1,182 @@
+import contextlib
+import gzip
+import json
+import wsgiref.util
+
+import pytest
+
+import kokbok.api
+from kokbok.api import Api, accepts_gzip, etag_matches, find_filters
+from kokbok.model import Ingredient, IngredientList, NotFoundException, Recipe
+
+
+def make_recipe(_id):
+    flour = Ingredient("Vetemjöl", 1, 2, 3, 4, 5, 6, 7)
+    flour._id = 3
+    ingredient_list = IngredientList("", [{'ingredient': flour,
+                                           'quantity': 500, 'unit': 'g',
+                                           'prepnotes': None}])
+    return Recipe("bröd", 30, 30, 4, "Gott " * 200, 1, [ingredient_list],
+                  None, ["Baka"], [], [], id=_id)
+
+
+class Backend():
+    def __init__(self, monkeypatch):
+        self.revisions = {("Recipe", 1): 0}
+        self.loads = 0
+        # The revisions the loads saw
+        self.loaded = []
+        # Changes committed before the next snapshot is taken
+        self.pending = {}
+
+        monkeypatch.setattr(kokbok.api, 'revision', self.revision)
+        monkeypatch.setattr(kokbok.api, 'read_snapshot', self.snapshot)
+        monkeypatch.setattr(Recipe, 'by_id_uncached',
+                            classmethod(lambda cls, _id: self.load(_id)))
+        monkeypatch.setattr(Recipe, 'find', classmethod(
+            lambda cls, **filters: ([1, 2], 2 if filters['limit'] == 2
+                                    else None)))
+
+    def revision(self, entity, _id):
+        if (entity, _id) not in self.revisions:
+            raise NotFoundException
+        return self.revisions[(entity, _id)]
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        self.revisions.update(self.pending)
+        self.pending = {}
+        yield
+
+    def load(self, _id):
+        self.loads += 1
+        self.loaded.append(self.revisions[("Recipe", _id)])
+        return make_recipe(_id)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    return Backend(monkeypatch)
+
+
+def get(app, path, query="", **headers):
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+    for (name, value) in headers.items():
+        environ['HTTP_' + name.upper()] = value
+    wsgiref.util.setup_testing_defaults(environ)
+
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    response['body'] = b"".join(app(environ, start_response))
+    return response
+
+
+def test_recipe(backend):
+    app = Api()
+    response = get(app, "/recipes/1")
+
+    assert response['status'] == "200 OK"
+    data = json.loads(response['body'].decode('utf-8'))
+    assert data['id'] == 1
+    assert data['title'] == "bröd"
+    assert data['ingredients'][0]['ingredients'][0]['id'] == 3
+
+    etag = response['headers']['ETag']
+    response = get(app, "/recipes/1", if_none_match=etag)
+    assert response['status'] == "304 Not Modified"
+    assert response['body'] == b""
+
+    # Served from the response cache until the recipe changes
+    assert get(app, "/recipes/1")['status'] == "200 OK"
+    assert backend.loads == 1
+
+    backend.revisions[("Recipe", 1)] = 1
+    response = get(app, "/recipes/1", if_none_match=etag)
+    assert response['status'] == "200 OK"
+    assert response['headers']['ETag'] != etag
+    assert backend.loads == 2
+
+    assert get(app, "/recipes/2")['status'] == "404 Not Found"
+    assert get(app, "/nothing")['status'] == "404 Not Found"
+
+
+def test_recipe_changed_while_loading(backend):
+    app = Api()
+    backend.pending = {("Recipe", 1): 1}
+    response = get(app, "/recipes/1")
+
+    # The ETag is the revision of the body sent
+    assert response['headers']['ETag'] == 'W/"recipe-1-1"'
+    assert backend.loaded == [1]
+
+    response = get(app, "/recipes/1", if_none_match='W/"recipe-1-1"')
+    assert response['status'] == "304 Not Modified"
+    assert backend.loads == 1
+
+
+def test_gzip(backend):
+    app = Api(gzip_min_bytes=100)
+    plain = get(app, "/recipes/1")
+    zipped = get(app, "/recipes/1", accept_encoding="deflate, gzip")
+
+    assert zipped['headers']['Content-Encoding'] == "gzip"
+    assert zipped['headers']['Vary'] == "Accept-Encoding"
+    assert gzip.decompress(zipped['body']) == plain['body']
+    assert len(zipped['body']) < len(plain['body'])
+    assert int(zipped['headers']['Content-Length']) == len(zipped['body'])
+
+    assert 'Content-Encoding' not in \
+        get(app, "/recipes/1", accept_encoding="gzip;q=0")['headers']
+
+
+def test_recipes(backend):
+    app = Api()
+    response = get(app, "/recipes", "prep_max=15&limit=2")
+    assert json.loads(response['body'].decode('utf-8')) == \
+        {'ids': [1, 2], 'next': "2"}
+
+    response = get(app, "/recipes", "prep_max=15&limit=2",
+                   if_none_match=response['headers']['ETag'])
+    assert response['status'] == "304 Not Modified"
+
+    assert get(app, "/recipes", "order_by=title")['status'] == \
+        "400 Bad Request"
+
+
+def test_read_only(backend):
+    environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': "/recipes/1"}
+    wsgiref.util.setup_testing_defaults(environ)
+    statuses = []
+    Api()(environ, lambda status, headers: statuses.append(status))
+    assert statuses == ["405 Method Not Allowed"]
+
+
+def test_find_filters():
+    assert find_filters({'prep_max': '15', 'kcal_max': '600',
+                         'order_by': 'kcal_per_serving',
+                         'after': '450.0,7'}) == \
+        {'prep_max': 15, 'kcal_per_serving_between': (None, 600.0),
+         'order_by': 'kcal_per_serving', 'limit': 100,
+         'after': (450.0, 7)}
+
+    for params in ({'limit': '0'}, {'prep_max': 'x'}, {'after': '1,2'},
+                   {'order_by': 'prep', 'after': '2'}):
+        with pytest.raises(ValueError):
+            find_filters(params)
+
+
+def test_headers():
+    assert etag_matches('W/"a", W/"b"', 'W/"b"')
+    assert etag_matches('"b"', 'W/"b"')
+    assert etag_matches('*', 'W/"b"')
+    assert not etag_matches('W/"a"', 'W/"b"')
+    assert not etag_matches(None, 'W/"b"')
+
+    assert accepts_gzip("gzip, deflate")
+    assert accepts_gzip("deflate, gzip;q=0.5")
+    assert not accepts_gzip("gzip; q=0")
+    assert not accepts_gzip(None)
@@ -0,0 +1,145 @@
+import multiprocessing
+
+import pytest
+
+import kokbok.cache
+from kokbok.cache import RecipeCache
+
+
+@pytest.fixture(scope="function")
+def cache(tmpdir):
+    return RecipeCache(str(tmpdir.join("recipes.sqlite")))
+
+
+def test_read_through(cache):
+    loads = []
+
+    def load():
+        loads.append(1)
+        return {"title": "bread"}
+
+    assert cache.get_or_load(1, load) == {"title": "bread"}
+    assert cache.get_or_load(1, load) == {"title": "bread"}
+    assert len(loads) == 1
+
+
+def test_invalidate(cache):
+    generation = cache.generation(1)
+    cache.put(1, "bread", generation)
+    cache.invalidate(1)
+
+    assert cache.get(1) is None
+    assert cache.generation(1) != generation
+
+
+def test_stale_put_is_dropped(cache):
+    generation = cache.generation(1)
+    cache.invalidate(1)
+    cache.put(1, "old bread", generation)
+
+    assert cache.get(1) is None
+
+
+def test_invalidate_ingredient(cache):
+    generation = cache.generation(1)
+    cache.put(1, "bread", generation, ingredient_ids=[10, 11])
+    cache.put(2, "cake", generation, ingredient_ids=[11])
+    cache.put(3, "soup", generation, ingredient_ids=[12])
+
+    cache.invalidate_ingredient(11)
+
+    assert cache.get(1) is None
+    assert cache.get(2) is None
+    assert cache.get(3) == "soup"
+
+
+def test_stale_put_after_ingredient_change(cache):
+    # The recipe isn't cached yet, so nothing links it to the ingredient
+    generation = cache.generation(1)
+    cache.invalidate_ingredient(10)
+    cache.put(1, "bread with old flour", generation, ingredient_ids=[10])
+
+    assert cache.get(1) is None
+
+
+def test_generations_are_pruned(cache, monkeypatch):
+    monkeypatch.setattr(kokbok.cache, 'MAX_GENERATIONS', 5)
+    loading = cache.generation(1)
+
+    for recipe_id in range(10):
+        cache.invalidate(recipe_id)
+    conn = cache._connection()
+    (count,) = conn.execute("SELECT COUNT(*) FROM Generation").fetchone()
+    assert count <= 5
+
+    # Forgetting the generation of recipe 1 doesn't bring back the old
+    cache.put(1, "old bread", loading)
+    assert cache.get(1) is None
+
+    generation = cache.generation(1)
+    cache.put(1, "bread", generation)
+    assert cache.get(1) == "bread"
+
+
+def test_apply_changes(cache):
+    assert cache.outbox_position() is None
+    cache.clear(position=10)
+    assert cache.outbox_position() == 10
+
+    generation = cache.generation(1)
+    cache.put(1, "bread", generation, ingredient_ids=[10])
+    cache.put(2, "cake", generation, ingredient_ids=[11])
+    cache.put(3, "soup", generation, ingredient_ids=[12])
+
+    cache.apply_changes({1}, {11}, 15)
+    assert cache.outbox_position() == 15
+    assert (cache.get(1), cache.get(2), cache.get(3)) == (None, None, "soup")
+
+
+def test_eviction(tmpdir):
+    cache = RecipeCache(str(tmpdir.join("small.sqlite")), max_bytes=2000)
+
+    for recipe_id in range(10):
+        cache.put(recipe_id, "x" * 500, cache.generation(recipe_id))
+
+    assert cache.size() <= 2000
+    assert 0 < len(cache) < 10
+    assert cache.get(9) == "x" * 500
+    assert cache.get(0) is None
+
+
+def _put_in_child(path):
+    cache = RecipeCache(path)
+    cache.put(7, "from another process", cache.generation(7))
+
+
+def test_shared_between_processes(tmpdir):
+    path = str(tmpdir.join("shared.sqlite"))
+    child = multiprocessing.Process(target=_put_in_child, args=(path,))
+    child.start()
+    child.join()
+
+    assert RecipeCache(path).get(7) == "from another process"
+
+
+def test_shared_between_threads(cache):
+    import threading
+
+    errors = []
+
+    def load(recipe_id):
+        try:
+            assert cache.get_or_load(recipe_id, lambda: recipe_id * 2) == \
+                recipe_id * 2
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load, args=(i % 4,))
+               for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(cache) == 4
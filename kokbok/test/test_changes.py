@@ -0,0 +1,128 @@
+import datetime
+
+import pytest
+
+import kokbok.changes
+import kokbok.model
+from kokbok.changes import Change, ChangeFeed, latest, settled_prefix
+from kokbok.model import Operation, after_commit, transaction
+
+
+def change(_id, entity="Recipe", entity_id=1, operation=Operation.UPDATE):
+    return Change(_id, entity, entity_id, operation,
+                  datetime.datetime(2016, 5, 1))
+
+
+def test_settled_prefix():
+    changes = [change(1), change(2), change(4), change(5)]
+    assert [c.id for c in settled_prefix(changes, 0)] == [1, 2]
+
+    # Gaps below settled are rolled back transactions
+    changes = [change(2), change(4), change(5), change(7)]
+    assert [c.id for c in settled_prefix(changes, 1, 5)] == [2, 4, 5]
+
+    assert settled_prefix([change(9)], 7) == []
+    assert settled_prefix([change(9)], 7, 9) == [change(9)]
+    assert settled_prefix([], 7) == []
+
+
+def test_read_gap(monkeypatch):
+    now = datetime.datetime(2016, 5, 1, 12)
+    # What each read of the outbox sees
+    snapshots = []
+    open_since = []
+
+    def fetch(self, position):
+        return ([c for c in snapshots.pop(0) if c.id > position], now)
+
+    def transactions_open_since(started):
+        assert started == now
+        return bool(open_since)
+
+    monkeypatch.setattr(ChangeFeed, '_fetch', fetch)
+    monkeypatch.setattr(kokbok.changes, 'transactions_open_since',
+                        transactions_open_since)
+    feed = ChangeFeed("test")
+    outbox = [change(2), change(3), change(5)]
+
+    # However old, a gap is kept while its transaction may be open
+    open_since.append(now)
+    snapshots.extend([outbox, outbox, outbox])
+    assert feed.read(0) == []
+    assert [c.id for c in feed.read(2)] == [3]
+    assert feed.read(3) == []
+
+    # It was a rollback
+    open_since.clear()
+    snapshots.extend([outbox, outbox])
+    assert [c.id for c in feed.read(0)] == [2, 3, 5]
+
+    # It was committed between the reads
+    snapshots.extend([outbox, [change(1)] + outbox])
+    assert [c.id for c in feed.read(0)] == [1, 2, 3, 5]
+    assert snapshots == []
+
+
+def test_latest():
+    changes = [change(1, "Recipe", 1, Operation.INSERT),
+               change(2, "Ingredient", 1, Operation.INSERT),
+               change(3, "Recipe", 1, Operation.UPDATE),
+               change(4, "Recipe", 2, Operation.DELETE)]
+
+    assert list(latest(changes).items()) == [
+        (("Ingredient", 1), Operation.INSERT),
+        (("Recipe", 1), Operation.UPDATE),
+        (("Recipe", 2), Operation.DELETE)]
+
+
+class Connection():
+    def __init__(self, log):
+        self.log = log
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, arglist=None):
+        self.log.append(query)
+
+    def commit(self):
+        self.log.append("COMMIT")
+
+    def rollback(self):
+        self.log.append("ROLLBACK")
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def log(monkeypatch):
+    log = []
+    monkeypatch.setattr(kokbok.model, 'connect', lambda: Connection(log))
+    return log
+
+
+def test_transaction(log):
+    with transaction() as cursor:
+        cursor.execute("INSERT 1")
+        after_commit(lambda: log.append("after"))
+        with transaction() as inner:
+            assert inner is cursor
+            inner.execute("INSERT 2")
+        assert "COMMIT" not in log
+
+    assert log == ["INSERT 1", "INSERT 2", "COMMIT", "after"]
+
+
+def test_transaction_rollback(log):
+    with pytest.raises(ValueError):
+        with transaction() as cursor:
+            cursor.execute("INSERT 1")
+            after_commit(lambda: log.append("after"))
+            raise ValueError
+
+    assert log == ["INSERT 1", "ROLLBACK"]
+
+    # Outside of a transaction callbacks run right away
+    after_commit(lambda: log.append("now"))
+    assert log[-1] == "now"
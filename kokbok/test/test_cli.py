@@ -0,0 +1,41 @@
+import os.path
+import subprocess
+import sys
+
+import pytest
+
+from kokbok import cli
+
+
+# Packages `kokbok --help` must not import, being slow to import or
+# only needed by some commands
+HEAVY_PACKAGES = ('MySQLdb', 'sqlite3', 'numpy', 'scipy', 'concurrent',
+                  'json', 'subprocess')
+
+
+def test_help_does_not_load_the_model():
+    code = ("import runpy, sys\n"
+            "sys.argv = ['kokbok', '--help']\n"
+            "try:\n"
+            "    runpy.run_path(%r, run_name='__main__')\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(sorted(m for m in sys.modules\n"
+            "             if m.split('.')[0] in %r or\n"
+            "             m.startswith('kokbok.') and m != 'kokbok.cli'))\n"
+            % (cli.SCRIPT, HEAVY_PACKAGES))
+
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.decode().splitlines()[-1] == "[]"
+
+
+def test_model_import_does_not_load_driver():
+    code = "import sys, kokbok.model; print('MySQLdb' in sys.modules)"
+    root = os.path.join(os.path.dirname(cli.SCRIPT), os.pardir)
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=root)
+    assert output.decode().strip() == "False"
+
+
+def test_no_command():
+    with pytest.raises(SystemExit):
+        cli.main([])
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+
+from kokbok import export
+from kokbok.export import Catalogue, build, merge, write_generation
+
+
+def recipes(rows):
+    return build('recipe', [(_id, title, 10, 20, 4, 1, kcal)
+                            for (_id, title, kcal) in rows])
+
+
+def edges(rows):
+    return build('edge', [(recipe_id, list_id, ingredient_id, 100, unit)
+                          for (recipe_id, list_id, ingredient_id, unit)
+                          in rows])
+
+
+def test_member():
+    assert list(export.member([1, 5, 9, 12], [9, 1, 3])) == \
+        [True, False, True, False]
+    assert list(export.member([1, 2], [])) == [False, False]
+
+
+def test_strings():
+    (data, offsets) = export.encode_strings(["bröd", "", "kola"])
+    column = export.StringColumn(data, offsets)
+    assert list(column) == ["bröd", "", "kola"]
+    assert column[-1] == "kola"
+    assert column[1:] == ["", "kola"]
+
+    taken = export.StringColumn(*export.take_strings(data, offsets, [2, 0]))
+    assert list(taken) == ["kola", "bröd"]
+
+
+def test_merge():
+    old = recipes([(1, "bröd", 300.0), (2, "kola", None), (3, "bullar", 250)])
+    new = recipes([(4, "frallor", 200), (2, "kola", 500)])
+
+    # Recipe 3 was deleted, 2 changed and 4 added
+    merged = merge('recipe', old, new, [2, 3, 4])
+
+    assert list(merged['id']) == [1, 2, 4]
+    assert list(export.StringColumn(*merged['title'])) == \
+        ["bröd", "kola", "frallor"]
+    assert list(merged['kcal_per_serving']) == [300, 500, 200]
+
+    assert np.isnan(recipes([(1, "bröd", None)])['kcal_per_serving'][0])
+
+
+def test_write_generation(tmpdir):
+    path = str(tmpdir)
+    tables = {'recipe': recipes([(1, "bröd", 300.0), (2, "kola", 500)]),
+              'ingredient': build('ingredient', []),
+              'edge': edges([(1, 10, 100, 'g'), (1, 10, 101, None),
+                             (2, 11, 102, 'pcs')])}
+    write_generation(path, tables, 17)
+
+    first = Catalogue(path)
+    assert first.position == 17
+    assert first.rows == {'recipe': 2, 'ingredient': 0, 'edge': 3}
+    assert first.row('recipe', 2) == 1
+    assert first.row('recipe', 3) is None
+    assert first.column('recipe', 'title')[first.row('recipe', 2)] == "kola"
+    assert list(first.column('edge', 'ingredient_id')[first.edges(1)]) == \
+        [100, 101]
+    assert list(first.column('edge', 'unit')) == [0, -1, 2]
+    assert len(first.column('ingredient', 'name')) == 0
+
+    tables['edge'] = merge('edge', first.table('edge'),
+                           edges([(1, 10, 103, 'ml')]), [1])
+    write_generation(path, tables, 18)
+    write_generation(path, tables, 19)
+
+    second = Catalogue(path)
+    assert list(second.column('edge', 'ingredient_id')) == [103, 102]
+    # Readers of an older generation are undisturbed
+    assert list(first.column('edge', 'ingredient_id')) == [100, 101, 102]
+    assert sorted(tmpdir.listdir(lambda p: p.basename.isdigit())) == \
+        [tmpdir.join('2'), tmpdir.join('3')]
+
+
+def test_write_generation_links(tmpdir):
+    path = str(tmpdir)
+    tables = {'recipe': recipes([(1, "bröd", None), (2, "kola", 500)]),
+              'ingredient': build('ingredient', []),
+              'edge': edges([(1, 10, 100, 'g')])}
+    write_generation(path, tables, 1)
+
+    first = Catalogue(path)
+    tables = {'recipe': recipes([(1, "bröd", None), (2, "kola", 400)]),
+              'ingredient': first.table('ingredient'),
+              'edge': first.table('edge')}
+    write_generation(path, tables, 2, previous=first)
+    second = Catalogue(path)
+
+    def inode(catalogue, filename):
+        return os.stat(os.path.join(catalogue.directory, filename)).st_ino
+
+    # NaN is the same as NaN
+    for filename in ['recipe.id.npy', 'recipe.title.strings',
+                     'recipe.title.offsets.npy', 'edge.unit.npy']:
+        assert inode(first, filename) == inode(second, filename)
+    assert inode(first, 'recipe.kcal_per_serving.npy') != \
+        inode(second, 'recipe.kcal_per_serving.npy')
+    assert list(second.column('recipe', 'kcal_per_serving'))[1] == 400
+    assert second.position == 2
@@ -0,0 +1,74 @@
+import pytest
+
+from kokbok.facets import FacetIndex, prep_time_bucket
+
+
+@pytest.fixture(scope="function")
+def index():
+    index = FacetIndex()
+    index.add(1, category=["dinner"], ingredient_category=["meat"],
+              prep_time=45)
+    index.add(2, category=["dinner", "vegetarian"],
+              ingredient_category=["vegetables", "dairy"], prep_time=10)
+    index.add(3, category=["snack"], ingredient_category=["dairy"],
+              prep_time=20)
+    index.add(4, category=["snack", "vegetarian"], prep_time=None)
+    return index
+
+
+def test_prep_time_bucket():
+    assert prep_time_bucket(None) is None
+    assert prep_time_bucket(0) == "0-15"
+    assert prep_time_bucket(15) == "15-30"
+    assert prep_time_bucket(59) == "30-60"
+    assert prep_time_bucket(240) == "60+"
+
+
+def test_filter(index):
+    assert index.filter() == [1, 2, 3, 4]
+    assert index.filter(category="dinner") == [1, 2]
+    assert index.filter(category=["dinner", "snack"]) == [1, 2, 3, 4]
+    assert index.filter(category="vegetarian",
+                        ingredient_category="dairy") == [2]
+    assert index.filter(prep_time=["0-15", "15-30"]) == [2, 3]
+    assert index.filter(category="dessert") == []
+
+
+def test_unknown_facet(index):
+    with pytest.raises(ValueError):
+        index.filter(colour="red")
+
+
+def test_counts(index):
+    ids, counts = index.browse(category="dinner")
+
+    assert ids == [1, 2]
+    # Selected facet counts ignore its own filter...
+    assert counts["category"] == {"dinner": 2, "vegetarian": 2, "snack": 2}
+    # ...but other facets are narrowed by it
+    assert counts["ingredient_category"] == {"meat": 1, "vegetables": 1,
+                                             "dairy": 1}
+    assert counts["prep_time"] == {"30-60": 1, "0-15": 1, "15-30": 0}
+
+
+def test_replace_and_remove(index):
+    index.add(1, category=["snack"], prep_time=5)
+    assert index.filter(category="dinner") == [2]
+    assert sorted(index.filter(category="snack")) == [1, 3, 4]
+
+    index.remove(3)
+    index.remove(3)
+    assert len(index) == 3
+    assert index.counts()["ingredient_category"]["dairy"] == 1
+
+
+def test_positions_are_reused(index):
+    for recipe_id in range(5, 105):
+        index.add(recipe_id, category=["dessert"], prep_time=5)
+        index.remove(recipe_id)
+
+    index.add(5, category=["dessert"], prep_time=5)
+    assert len(index._ids) == 5
+    assert index._all < 1 << 5
+    assert index.filter(category="dessert") == [5]
+    assert index.filter(prep_time="0-15") == [2, 5]
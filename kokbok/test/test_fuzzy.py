@@ -0,0 +1,68 @@
+import random
+
+import pytest
+
+from kokbok import fuzzy
+from kokbok.fuzzy import (IngredientMatcher, normalise, edit_distance,
+                          similarity, similarity_threshold)
+
+
+def test_normalise():
+    assert normalise("Vetemjöl") == "vetemjol"
+    assert normalise("  vetemjöl ") == "vetemjol"
+    assert normalise("Crème  fraiche") == "creme fraiche"
+
+
+def test_edit_distance():
+    assert edit_distance("", "") == 0
+    assert edit_distance("mjol", "") == 4
+    assert edit_distance("kitten", "sitting") == 3
+    assert similarity("abcd", "abce") == 0.75
+
+
+def test_match():
+    matcher = IngredientMatcher(threshold=0.85)
+    matcher.add("Vetemjöl", 1)
+    matcher.add("Vetemjöl special", 2)
+    matcher.add("Socker", 3)
+    matcher.add("vetemjol", 4)
+
+    assert len(matcher) == 3
+    assert matcher.match("vetemjöl ") == (1, 1.0)
+    assert matcher.match("VETEMJOL") == (1, 1.0)
+    assert matcher.match("vetemjööl")[0] == 1
+    assert matcher.match("sockker")[0] == 3
+    assert matcher.match("rågmjöl") is None
+    assert matcher.match("") is None
+
+
+def test_threshold():
+    assert similarity_threshold("1") == 1.0
+    for value in (0, -0.5, 1.5, "0"):
+        with pytest.raises(ValueError):
+            similarity_threshold(value)
+    with pytest.raises(ValueError):
+        IngredientMatcher(threshold=0)
+
+
+def test_match_candidates(monkeypatch):
+    # The timing is checked by `kokbok bench --matching`; here, that
+    # only a few names are compared by edit distance per query
+    rng = random.Random(4711)
+    names = fuzzy.synthetic_names(5000, rng)
+    matcher = IngredientMatcher()
+    for (n, name) in enumerate(names):
+        matcher.add(name, n)
+
+    compared = []
+
+    def counted(a, b, threshold=0.0):
+        compared.append(b)
+        return similarity(a, b, threshold)
+
+    monkeypatch.setattr(fuzzy, 'similarity', counted)
+    queries = [fuzzy.misspell(name, rng) for name in rng.sample(names, 1000)]
+    matched = [matcher.match(query) for query in queries]
+
+    assert sum(m is not None for m in matched) > 0.9 * len(queries)
+    assert len(compared) <= fuzzy.CANDIDATES * len(queries)
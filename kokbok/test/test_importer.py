@@ -0,0 +1,99 @@
+import pytest
+
+import kokbok.importer
+from kokbok.importer import parse_file, chunks, insert_rows, ImportFormatError
+
+
+def test_parse_file(tmpdir):
+    path = tmpdir.join("recipes.jsonl")
+    path.write_text(
+        '{"title": "bread", "servings": 4, "instructions": ["Baka"], '
+        '"ingredients": [{"ingredients": [{"name": " vetemjöl ", '
+        '"quantity": 500, "unit": "g"}]}]}\n'
+        '\n'
+        '{"title": "water"}\n', encoding='utf-8')
+
+    (bread, water) = parse_file(str(path))
+
+    assert bread['title'] == "bread"
+    assert bread['servings'] == 4
+    assert bread['version'] == 1
+    assert bread['ingredients'] == [{'title': '',
+                                     'ingredients': [{'name': "vetemjöl",
+                                                      'quantity': 500,
+                                                      'unit': "g",
+                                                      'prepnotes': None}]}]
+    assert water['instructions'] == []
+    assert water['ingredients'] == []
+    assert water['author'] is None
+
+
+def test_parse_file_errors(tmpdir):
+    path = tmpdir.join("broken.jsonl")
+
+    path.write_text('{"title": "ok"}\n{"title": \n', encoding='utf-8')
+    with pytest.raises(ImportFormatError) as e:
+        parse_file(str(path))
+    assert "broken.jsonl:2" in str(e.value)
+
+    path.write_text('{"servings": 2}\n', encoding='utf-8')
+    with pytest.raises(ImportFormatError):
+        parse_file(str(path))
+
+
+def test_chunks():
+    assert list(chunks(list(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunks([], 2)) == []
+
+
+class Cursor():
+    next_id = 11
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, args):
+        self.statements.append((query, args))
+        self.rowcount = query.count("(%s, %s)")
+        self.lastrowid = self.next_id
+        self.next_id += 2 * self.rowcount
+
+
+def test_insert_rows(monkeypatch):
+    monkeypatch.setattr(kokbok.importer, 'INSERT_CHUNK', 2)
+    cursor = Cursor()
+
+    ids = insert_rows(cursor, "T", ["A", "B"], [(1, 2), (3, 4), (5, 6)],
+                      increment=2)
+    assert ids == [11, 13, 15]
+    assert cursor.statements == [
+        ("INSERT INTO T (A, B) VALUES (%s, %s), (%s, %s)", [1, 2, 3, 4]),
+        ("INSERT INTO T (A, B) VALUES (%s, %s)", [5, 6])]
+    assert insert_rows(cursor, "T", ["A", "B"], []) == []
+
+
+def test_run_batches_all_files(tmpdir):
+    from kokbok.importer import Importer
+
+    paths = []
+    for n in range(3):
+        path = tmpdir.join("part%d.jsonl" % n)
+        path.write_text("".join('{"title": "recipe %d"}\n' % i
+                                for i in range(5)), encoding='utf-8')
+        paths.append(str(path))
+
+    written = []
+
+    class DryImporter(Importer):
+        def write_batch(self, batch):
+            written.extend(r['title'] for r in batch)
+            return len(batch)
+
+    progress = []
+    stats = DryImporter(workers=2, connections=2, batch_size=2,
+                        progress=progress.append).run(paths)
+
+    assert stats.files == 3
+    assert stats.recipes == 15
+    assert len(written) == 15
+    assert len(progress) == 9
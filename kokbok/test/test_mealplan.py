@@ -0,0 +1,116 @@
+import itertools
+
+import numpy as np
+
+from kokbok.export import Catalogue, build, write_generation
+from kokbok.mealplan import Planner, RecipeVectors, Target, plan_batch
+
+
+def catalogue(tmpdir, ingredients, recipes, edges):
+    path = str(tmpdir)
+    write_generation(path, {'ingredient': build('ingredient', ingredients),
+                            'recipe': build('recipe', recipes),
+                            'edge': build('edge', edges)}, 0)
+    return path
+
+
+def vectors(rows):
+    """
+    Return RecipeVectors for rows of (ID, cost, kcal, protein, prep).
+    """
+    return RecipeVectors([r[0] for r in rows], [r[1] for r in rows],
+                         [[r[2], r[3], 0, 0] for r in rows],
+                         [r[4] for r in rows])
+
+
+def test_recipe_vectors(tmpdir):
+    # Price and nutrients per 100 g, 2 g per ml and 50 g per piece
+    ingredients = [(1, "mjöl", 10, 350, 1, 10, 70, 2, None),
+                   (2, "ägg", 30, 150, 10, 13, 1, None, 50),
+                   (3, "salt", None, 0, 0, 0, 0, None, None)]
+    recipes = [(1, "bröd", 10, 30, 2, 1, None),
+               (2, "omelett", 5, 5, 1, 1, None),
+               (3, "saltat", 5, 0, 1, 1, None)]
+    edges = [(1, 1, 1, 200, 'g'), (1, 1, 2, 2, 'pcs'),
+             (2, 2, 1, 50, 'ml'), (2, 2, 2, 2, 'pcs'),
+             (3, 3, 2, 1, 'pcs'), (3, 3, 3, 5, 'g')]
+    result = RecipeVectors.from_catalogue(
+        Catalogue(catalogue(tmpdir, ingredients, recipes, edges)))
+
+    assert list(result.ids) == [1, 2, 3]
+    # (200 * 10 + 100 * 30) / 100 per 2 servings
+    assert result.cost[0] == 25
+    assert result.cost[1] == (100 * 10 + 100 * 30) / 100
+    # Salt has no price
+    assert np.isnan(result.cost[2])
+    assert list(result.nutrition[0]) == [(700 + 150) / 2, (20 + 13) / 2,
+                                         (2 + 10) / 2, (140 + 1) / 2]
+    assert list(result.prep_minutes) == [10, 5, 5]
+
+
+def test_plan():
+    planner = Planner(vectors([(1, 10, 500, 10, 10),
+                               (2, 2, 500, 5, 10),
+                               (3, 3, 600, 40, 90),
+                               (4, 1, 200, 1, 10),
+                               (5, float('nan'), 500, 50, 10)]))
+
+    plan = planner.plan(Target(kcal=(1400, 1600), meals=2, max_servings=2))
+    assert plan.feasible
+    assert (plan.recipe_ids, plan.servings) == ([2, 4], [2, 2])
+    assert plan.cost == 6
+    assert plan.nutrition['kcal'] == 1400
+    assert plan.nutrition['protein'] == 12
+
+    plan = planner.plan(Target(kcal=(1000, 1300), meals=2, max_servings=2,
+                               max_prep=30))
+    assert plan.feasible
+    assert (plan.recipe_ids, plan.servings) == ([2, 4], [2, 1])
+    assert plan.cost == 5
+
+    plan = planner.plan(Target(kcal=(1000, 1600), protein=(40, None),
+                               meals=2, max_servings=2, max_prep=30,
+                               exclude=[4]))
+    assert not plan.feasible
+    assert planner.plan(Target(kcal=(1000, None), meals=3, max_prep=30,
+                               exclude=[4])) is None
+
+
+def test_plan_is_cheapest():
+    rng = np.random.RandomState(1)
+    rows = [(i, rng.uniform(1, 20), rng.uniform(200, 900),
+             rng.uniform(5, 50), 10) for i in range(1, 13)]
+    planner = Planner(vectors(rows))
+    target = Target(kcal=(3000, 3600), protein=(120, None), meals=4,
+                    max_servings=2)
+
+    best = None
+    for chosen in itertools.combinations(rows, 4):
+        for servings in itertools.product([1, 2], repeat=4):
+            kcal = sum(r[2] * s for (r, s) in zip(chosen, servings))
+            protein = sum(r[3] * s for (r, s) in zip(chosen, servings))
+            if 3000 <= kcal <= 3600 and protein >= 120:
+                cost = sum(r[1] * s for (r, s) in zip(chosen, servings))
+                best = cost if best is None else min(best, cost)
+
+    plan = planner.plan(target)
+    assert plan.feasible
+    assert len(set(plan.recipe_ids)) == 4
+    assert 3000 <= plan.nutrition['kcal'] <= 3600
+    assert plan.nutrition['protein'] >= 120
+    # A local optimum, close to the best
+    assert plan.cost <= best * 1.1
+
+
+def test_plan_batch(tmpdir):
+    ingredients = [(i, "i%d" % i, i, 100 * i, i, i, i, None, None)
+                   for i in range(1, 5)]
+    recipes = [(r, "r%d" % r, 10 * r, 0, 1, 1, None) for r in range(1, 9)]
+    edges = [(r, r, 1 + r % 4, 100, 'g') for r in range(1, 9)]
+    path = catalogue(tmpdir, ingredients, recipes, edges)
+
+    targets = [Target(kcal=(low, None), meals=3, max_servings=1)
+               for low in range(0, 1000, 100)]
+    planner = Planner.from_export(path)
+    assert list(plan_batch(path, targets, workers=2, chunk_size=3)) == \
+        planner.plan_many(targets)
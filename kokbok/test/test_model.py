@@ -1,5 +1,11 @@
+import os
+import threading
+import time
+
 from kokbok.model import *
+from kokbok.routing import ReplicaRouter
 import kokbok.conf
+import kokbok.model
 
 import pytest
 
@@ -26,6 +32,35 @@ def test_db(request):
     request.addfinalizer(teardown_db)
 
 
+def new_ingredient(name="Vetemjöl", energy=2):
+    """
+    Return a new, saved ingredient with energy kcal per 100 g.
+    """
+    ingredient = Ingredient(name, 1, energy, 3, 4, 5, 6, 7)
+    ingredient.save()
+    return ingredient
+
+
+def new_recipe(ingredients, **fields):
+    """
+    Return a new recipe with one ingredient list of ingredients,
+    (ingredient, grams) or (ingredient, quantity, unit) tuples. fields
+    replace the defaults of the other arguments of Recipe.new().
+    """
+    values = {'title': "bröd", 'servings': 4, 'cook_time_prep': 30,
+              'cook_time_cook': 30, 'author': None,
+              'instructions': ["Baka"], 'description': "", 'version': 1}
+    values.update(fields)
+    return Recipe.new(
+        ingredients=[{'title': '',
+                      'ingredients': [{'unit': (entry + (Unit.G,))[2],
+                                       'quantity': entry[1],
+                                       'prepnotes': None,
+                                       'ingredient': entry[0]}
+                                      for entry in ingredients]}],
+        **values)
+
+
 def test_ingredient_save(test_db):
     name = "name"
     price = 1
@@ -108,3 +143,709 @@ def test_new_recipe(test_db):
     assert(recipe == same_recipe)
     
 
+
+
+def test_recipe_pictures(test_db, tmpdir):
+    import io
+    from kokbok.pictures import PictureStore
+
+    store = PictureStore(str(tmpdir))
+    picture = Picture.upload(io.BytesIO(b"bread.jpg"), store=store)
+    same_picture = Picture.upload(io.BytesIO(b"bread.jpg"), store=store)
+
+    assert picture._id == same_picture._id
+
+    recipe = new_recipe([(new_ingredient(), 500)], pictures=[
+        picture, Picture(store.put_bytes(b"crumb.jpg"))])
+
+    same_recipe = Recipe.by_id(recipe._id)
+    assert same_recipe.pictures == recipe.pictures
+    assert same_recipe.pictures[0].mmap(store)[:] == b"bread.jpg"
+
+
+def test_delete_reuploaded_picture(test_db, tmpdir):
+    import io
+    from kokbok.pictures import PictureStore
+
+    store = PictureStore(str(tmpdir))
+    picture = Picture.upload(io.BytesIO(b"bread.jpg"), store=store)
+    with connect() as cursor:
+        cursor.execute("DELETE FROM Picture WHERE ID = %s", [picture._id])
+
+    # Uploaded again before the file of the deleted row is removed
+    again = Picture.upload(io.BytesIO(b"bread.jpg"), store=store)
+    delete_pictures([picture.filename], store)
+    assert again.filename in store
+
+    again.delete(store)
+    assert again.filename not in store
+
+
+def test_comment_pages(test_db):
+    import datetime
+
+    recipe = new_recipe([(new_ingredient(), 500)])
+
+    day = datetime.date(2016, 6, 1)
+    added = [recipe.add_comment("Kommentar %d" % n, author="Albin Stjerna",
+                                date=day + datetime.timedelta(days=n // 3))
+             for n in range(7)]
+    newest_first = sorted(added, key=lambda c: c.cursor, reverse=True)
+
+    seen = []
+    page, after = recipe.comment_page(limit=3)
+    seen += page
+    while after is not None:
+        page, after = recipe.comment_page(after=after, limit=3)
+        seen += page
+
+    assert seen == newest_first
+    assert [c._id for c in seen] == [c._id for c in newest_first]
+    assert Comment.by_id(added[0]._id) == added[0]
+
+
+def test_categories(test_db):
+    from kokbok.facets import FacetIndex
+
+    ingredient = new_ingredient()
+    ingredient.add_categories(["mjöl", "torrvaror"])
+    assert ingredient.categories() == ["mjöl", "torrvaror"]
+
+    recipe = new_recipe([(ingredient, 500)], cook_time_prep=10,
+                        categories=["bröd"])
+
+    assert Recipe.by_id(recipe._id).categories == ["bröd"]
+
+    ids, counts = FacetIndex.from_db().browse(ingredient_category="mjöl")
+    assert ids == [recipe._id]
+    assert counts["category"] == {"bröd": 1}
+    assert counts["prep_time"] == {"0-15": 1}
+
+
+def test_similar_recipes(test_db):
+    from kokbok import similar
+
+    (flour, water, sugar) = (new_ingredient(name)
+                             for name in ("Vetemjöl", "Vatten", "Socker"))
+
+    bread = new_recipe([(flour, 500), (water, 300)])
+    rolls = new_recipe([(flour, 400), (water, 250)], title="frallor")
+    candy = new_recipe([(sugar, 300)], title="kola")
+
+    assert similar.update_pending() == 3
+    assert [r for (r, _) in bread.similar()] == [rolls._id]
+    assert candy.similar() == []
+
+    assert similar.rebuild() == 3
+    assert [r for (r, _) in bread.similar()] == [rolls._id]
+
+    # Queued again during an update: stays queued
+    with connect() as cursor:
+        queue_similar_update(cursor, [candy._id])
+        pending = similar.pending_versions(cursor)
+        queue_similar_update(cursor, [candy._id])
+        similar.dequeue(cursor, pending)
+        assert similar.pending_versions(cursor) == [(candy._id, 2)]
+
+
+def test_find_query():
+    query, arglist = Recipe.find_query(prep_max=15, servings_min=2,
+                                       order_by='kcal_per_serving',
+                                       limit=10, after=(450.0, 7))
+
+    assert query.startswith("SELECT ID, KcalPerServing FROM Recipe WHERE")
+    assert query.endswith("ORDER BY KcalPerServing, ID LIMIT %s")
+    assert arglist == [15, 2, 450.0, 450.0, 7, 11]
+
+    assert Recipe.find_query(limit=10) == \
+        ("SELECT ID FROM Recipe WHERE ID > %s ORDER BY ID LIMIT %s", [0, 11])
+
+    with pytest.raises(ValueError):
+        Recipe.find_query(order_by='title')
+
+
+def test_find(test_db):
+    flour = new_ingredient(energy=100)
+
+    def recipe_id(prep, grams, servings):
+        return new_recipe([(flour, grams)], cook_time_prep=prep,
+                          servings=servings)._id
+
+    quick_light = recipe_id(10, 400, 4)     # 100 kcal/serving
+    quick_heavy = recipe_id(10, 1600, 2)    # 800 kcal/serving
+    slow_light = recipe_id(90, 200, 2)      # 100 kcal/serving
+
+    ids, after = Recipe.find(prep_max=15)
+    assert ids == [quick_light, quick_heavy]
+    assert after is None
+
+    ids, after = Recipe.find(kcal_per_serving_between=(None, 200),
+                             order_by='kcal_per_serving', limit=1)
+    assert ids == [quick_light]
+    ids, after = Recipe.find(kcal_per_serving_between=(None, 200),
+                             order_by='kcal_per_serving', limit=1,
+                             after=after)
+    assert ids == [slow_light]
+    assert after is None
+
+
+def test_find_ties(test_db):
+    from kokbok.api import format_after, parse_after
+
+    flour = new_ingredient(energy=100)
+    # 100/3 kcal per serving, which a float can't hold exactly
+    ids = [new_recipe([(flour, 100)], servings=3)._id for _ in range(3)]
+
+    seen = []
+    after = None
+    while True:
+        (page, after) = Recipe.find(order_by='kcal_per_serving', limit=1,
+                                    after=after)
+        seen += page
+        if after is None:
+            break
+        # As sent to and back from an API client
+        after = parse_after(format_after(after))
+        assert len(seen) <= len(ids)
+    assert seen == ids
+
+
+def test_find_plans():
+    from kokbok import plans
+
+    # Plans on a handful of rows say nothing about the real ones
+    with plans.synthetic_database():
+        plans.populate(recipes=2000)
+        for filters in plans.FIND_WORKLOAD + [{'prep_max': 15, 'after': 7},
+                                              {'order_by': 'servings',
+                                               'after': (4, 7)}]:
+            plan = Recipe.explain_find(**filters)
+            assert all(row['type'] not in ('ALL', 'index')
+                       for row in plan), (filters, plan)
+
+
+def test_change_feed(test_db):
+    from kokbok.changes import ChangeFeed, latest
+
+    flour = new_ingredient()
+    bread = new_recipe([(flour, 500)])
+    bread.add_categories(["bröd"])
+
+    feed = ChangeFeed("test", batch_size=2)
+    batches = list(feed.batches())
+    assert [len(b) for b in batches] == [2, 2]
+
+    changes = latest(c for b in batches for c in b)
+    assert list(changes.items()) == [
+        (("Ingredient", flour._id), Operation.INSERT),
+        (("IngredientList", bread.ingredient_lists[0]._id), Operation.INSERT),
+        (("Recipe", bread._id), Operation.UPDATE)]
+
+    # Checkpointed: nothing new for the same consumer
+    assert feed.position() == batches[-1][-1].id
+    assert list(feed.batches()) == []
+    assert len(ChangeFeed("other").read()) == 4
+
+
+def test_change_feed_gap(test_db):
+    from kokbok.changes import ChangeFeed
+
+    feed = ChangeFeed("test")
+    held = connect()
+    try:
+        # An ID reserved by a transaction that is still open
+        cursor = held.cursor()
+        record_changes(cursor, "Recipe", [1], Operation.DELETE)
+        with transaction() as other:
+            record_changes(other, "Recipe", [2], Operation.DELETE)
+
+        assert feed.read() == []
+        held.rollback()
+    finally:
+        held.close()
+
+    assert [c.entity_id for c in feed.read()] == [2]
+
+
+def test_recipe_delete(test_db, tmpdir):
+    import io
+    from kokbok.pictures import PictureStore
+
+    store = PictureStore(str(tmpdir))
+    shared = Picture.upload(io.BytesIO(b"bread.jpg"), store=store)
+    own = Picture.upload(io.BytesIO(b"crumb.jpg"), store=store)
+
+    flour = new_ingredient()
+
+    def commented(pictures):
+        recipe = new_recipe([(flour, 500)], author="Albin Stjerna",
+                            instructions=["Blanda", "Baka"],
+                            pictures=pictures)
+        recipe.add_comment("Gott!")
+        return recipe
+
+    bread = commented([shared, own])
+    rolls = commented([shared])
+    buns = commented([])
+
+    bread.delete(store=store)
+
+    with pytest.raises(NotFoundException):
+        Recipe.by_id(bread._id)
+    assert Recipe.by_id(rolls._id).pictures == [shared]
+    assert own.filename not in store
+    assert shared.filename in store
+
+    with connect() as cursor:
+        for table in ("Instruction", "Comment", "IngredientList"):
+            cursor.execute("SELECT COUNT(*) FROM " + table)
+            assert cursor.fetchone()[0] == 2
+
+    Recipe.delete_many([rolls._id, buns._id], chunk_size=1, store=store)
+    assert list(Recipe.iter_ids()) == []
+    assert shared.filename not in store
+
+    # Ingredients are kept
+    assert Ingredient.by_id(flour._id) == flour
+
+
+def test_ingredient_list_delete(test_db):
+    bread = new_recipe([(new_ingredient(), 500)])
+
+    ingredient_list = bread.ingredient_lists[0]
+    ingredient_list.delete()
+
+    with pytest.raises(NotFoundException):
+        IngredientList.by_id(ingredient_list._id)
+
+
+def test_ingredient_list_save_existing(test_db):
+    flour = new_ingredient(energy=100)
+    sugar = new_ingredient("Socker", energy=400)
+    bread = new_recipe([(flour, 400)])
+
+    ingredient_list = IngredientList.by_id(bread.ingredient_lists[0]._id)
+    ingredient_list.title = "Deg"
+    ingredient_list.ingredients = [
+        {'ingredient': flour, 'quantity': 200, 'unit': Unit.G,
+         'prepnotes': "siktat"},
+        {'ingredient': sugar, 'quantity': 100, 'unit': Unit.G,
+         'prepnotes': None}]
+    ingredient_list.save()
+
+    assert ingredient_list._id == bread.ingredient_lists[0]._id
+    saved = IngredientList.by_id(ingredient_list._id)
+    assert saved.title == "Deg"
+    assert [(i['ingredient']._id, i['quantity'], i['prepnotes'])
+            for i in saved.ingredients] == [(flour._id, 200, "siktat"),
+                                            (sugar._id, 100, None)]
+    # (200 + 400) kcal for 4 servings
+    assert Recipe.find(kcal_per_serving_between=(150, 150),
+                       order_by='kcal_per_serving')[0] == [bread._id]
+    assert revision("Recipe", bread._id) == 1
+
+
+def test_merge_ingredients(test_db):
+    from kokbok.fuzzy import merge_ingredients
+
+    flour = new_ingredient()
+    typo = new_ingredient("Vetemjl")
+
+    moved = new_recipe([(typo, 100, Unit.G)])
+    summed = new_recipe([(flour, 200, Unit.G), (typo, 50, Unit.G)])
+    clashing = new_recipe([(flour, 2, Unit.PCS), (typo, 100, Unit.G)])
+    typo.add_categories(["mjöl"])
+    flour_revision = revision("Ingredient", flour._id)
+
+    dropped = merge_ingredients(flour._id, [typo._id], batch_size=1)
+    assert dropped == [(clashing._id, clashing.ingredient_lists[0]._id,
+                        100, 'g')]
+
+    def quantities(recipe):
+        loaded = Recipe.by_id_uncached(recipe._id)
+        return [(i['ingredient']._id, i['quantity'], i['unit'])
+                for i in loaded.ingredient_lists[0].ingredients]
+
+    assert quantities(moved) == [(flour._id, 100, Unit.G)]
+    assert quantities(summed) == [(flour._id, 250, Unit.G)]
+    assert quantities(clashing) == [(flour._id, 2, Unit.PCS)]
+    # Once for the entries and once for the categories merged
+    assert revision("Recipe", summed._id) == 2
+    assert flour.categories() == ["mjöl"]
+    assert revision("Ingredient", flour._id) == flour_revision + 1
+
+    with pytest.raises(NotFoundException):
+        Ingredient.by_id(typo._id)
+
+
+def test_export(test_db, tmpdir):
+    from kokbok import export
+    from kokbok.changes import ChangeFeed
+
+    flour = new_ingredient(energy=100)
+    bread = new_recipe([(flour, 400)])
+    export.export(str(tmpdir))
+    feed = ChangeFeed(export.CONSUMER)
+    assert feed.position() == export.Catalogue(str(tmpdir)).position
+
+    rolls = new_recipe([(flour, 400)], title="frallor")
+    bread.delete()
+    assert export.refresh_from_changes(str(tmpdir)) > 0
+
+    catalogue = export.Catalogue(str(tmpdir))
+    assert feed.position() == catalogue.position
+    assert export.refresh_from_changes(str(tmpdir)) == 0
+    assert list(catalogue.column('recipe', 'id')) == [rolls._id]
+    assert list(catalogue.column('recipe', 'title')) == ["frallor"]
+    assert list(catalogue.column('recipe', 'kcal_per_serving')) == [100]
+    assert list(catalogue.column('edge', 'ingredient_id')) == [flour._id]
+    assert list(catalogue.column('ingredient', 'name')) == ["Vetemjöl"]
+
+
+class FakeDriver():
+    """
+    Connections that take latency seconds per query, like a database
+    across the network.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.connections = 0
+        self.hosts = []
+        self._lock = threading.Lock()
+
+    def connect(self, **conf):
+        with self._lock:
+            self.connections += 1
+            self.hosts.append(conf.get('host'))
+        return FakeConnection(self.latency)
+
+
+class FakeConnection():
+    def __init__(self, latency):
+        self.latency = latency
+
+    def autocommit(self, on):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, arglist=None):
+        time.sleep(self.latency)
+
+    def fetchone(self):
+        return (1,)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+@pytest.fixture
+def fake_driver(monkeypatch):
+    fake = FakeDriver()
+    monkeypatch.setattr(kokbok.model, 'driver', lambda: fake)
+    monkeypatch.setattr(kokbok.model, '_replica_router',
+                        ReplicaRouter([]))
+    return fake
+
+
+def read_one(_id):
+    with connect_read() as cursor:
+        cursor.execute("SELECT ...", [_id])
+        return (_id, cursor.fetchone())
+
+
+def test_session(fake_driver):
+    with Session() as session:
+        for _id in range(5):
+            read_one(_id)
+        with transaction() as cursor:
+            cursor.execute("INSERT ...")
+        assert current_session() is session
+
+        errors = []
+
+        def use_elsewhere():
+            try:
+                session.connection({}, autocommit=True)
+            except RuntimeError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=use_elsewhere)
+        thread.start()
+        thread.join()
+        assert len(errors) == 1
+
+        with pytest.raises(RuntimeError):
+            with Session():
+                pass
+
+    # One connection for reads and one for the transaction
+    assert fake_driver.connections == 2
+    assert current_session() is None
+
+    read_one(1)
+    assert fake_driver.connections == 3
+
+
+def test_session_reads_from_one_replica(fake_driver, monkeypatch):
+    router = ReplicaRouter([{'host': "a"}, {'host': "b"}])
+    monkeypatch.setattr(kokbok.model, '_replica_router', router)
+
+    with Session():
+        for _id in range(4):
+            read_one(_id)
+    with Session():
+        read_one(1)
+    assert fake_driver.hosts == ["a", "b"]
+
+    # Without a session, every read picks a replica
+    for _id in range(2):
+        read_one(_id)
+    assert fake_driver.hosts == ["a", "b", "a", "b"]
+    assert router._in_flight == [0, 0]
+
+
+def test_session_keeps_to_the_primary(fake_driver, monkeypatch):
+    clock = [0]
+    router = ReplicaRouter([{'host': "a"}], max_lag=5,
+                           clock=lambda: clock[0])
+    monkeypatch.setattr(kokbok.model, '_replica_router', router)
+
+    router.note_write()
+    with Session():
+        read_one(1)
+        # Past the time to read own writes, a replica may still be
+        # behind what was read
+        clock[0] = 10
+        read_one(2)
+    with Session():
+        read_one(1)
+        router.note_write()
+        read_one(2)
+    primary = kokbok.model.get_dbconf()['host']
+    assert fake_driver.hosts == [primary, "a", primary]
+    assert router._in_flight == [0]
+
+
+@pytest.mark.skipif(not os.getenv('KOK_DB_REPLICAS'),
+                    reason="needs KOK_DB_REPLICAS: a second server "
+                           "replicating from the test server")
+def test_replica_reads(test_db, monkeypatch):
+    router = ReplicaRouter(kokbok.conf.get_replica_confs(),
+                           probe=probe_replica, lag_check_interval=0.1)
+    monkeypatch.setattr(kokbok.model, '_replica_router', router)
+
+    def server_id():
+        with connect_read() as cursor:
+            cursor.execute("SELECT @@server_id")
+            return cursor.fetchone()[0]
+
+    with connect() as cursor:
+        cursor.execute("SELECT @@server_id")
+        (primary,) = cursor.fetchone()
+
+    try:
+        deadline = time.time() + 10
+        while server_id() == primary:
+            assert time.time() < deadline, "the replica is never used"
+            time.sleep(0.1)
+
+        flour = Ingredient("Vetemjöl", 1, 2, 3, 4, 5, 6, 7)
+        with Session():
+            flour.save()
+            # Read your writes
+            assert server_id() == primary
+            assert Ingredient.by_id(flour._id).name == "Vetemjöl"
+
+        deadline = time.time() + 10
+        while True:
+            with driver().connect(**router.replicas[0]) as cursor:
+                cursor.execute("SELECT Name FROM Ingredient WHERE ID = %s",
+                               [flour._id])
+                if cursor.fetchone() == ("Vetemjöl",):
+                    break
+            assert time.time() < deadline, "the write never replicated"
+            time.sleep(0.1)
+    finally:
+        router.close()
+
+
+def test_load_many_concurrently(fake_driver, monkeypatch):
+    workers = 8
+    # Only passed once workers loads are in progress at the same time;
+    # the first ones are taken by different workers, which block here
+    barrier = threading.Barrier(workers, timeout=10)
+
+    def load(cls, _id):
+        if _id < workers:
+            barrier.wait()
+        return read_one(_id)
+
+    monkeypatch.setattr(Recipe, 'by_id', classmethod(load))
+    ids = list(range(64))
+
+    assert Recipe.load_many_concurrently(ids, workers=workers) == \
+        [(_id, (1,)) for _id in ids]
+    # Every worker keeps its connection for all its loads
+    assert fake_driver.connections == workers
+
+    assert Recipe.load_many_concurrently([]) == []
+
+
+def test_load_many_concurrently_failure(fake_driver, monkeypatch):
+    def load(cls, _id):
+        if _id == 3:
+            raise NotFoundException
+        return _id
+
+    monkeypatch.setattr(Recipe, 'by_id', classmethod(load))
+    with pytest.raises(NotFoundException):
+        Recipe.load_many_concurrently(range(100), workers=4)
+
+
+def test_load_many_concurrently_from_db(test_db):
+    flour = new_ingredient()
+    ids = [new_recipe([(flour, 500)], title="recept %d" % i)._id
+           for i in range(20)]
+
+    recipes = Recipe.load_many_concurrently(ids, workers=4)
+    assert [r._id for r in recipes] == ids
+    assert [r.title for r in recipes] == ["recept %d" % i for i in range(20)]
+
+
+def test_import_mixed_case_names(test_db):
+    from kokbok.changes import ChangeFeed
+    from kokbok.importer import Importer, normalise
+
+    new_ingredient()
+    feed = ChangeFeed("test")
+    feed.commit(feed.read()[-1].id)
+    recipes = [normalise({'title': title, 'author': author,
+                          'categories': [category],
+                          'ingredients': [{'ingredients': [
+                              {'name': name, 'quantity': 1, 'unit': 'g'}]}]})
+               for (title, author, category, name) in [
+                   ("bröd", "Anna", "bröd", "VETEMJÖL"),
+                   ("limpa", "anna", "Bröd", "socker"),
+                   ("kaka", "ANNA", "BRÖD", "Socker")]]
+
+    importer = Importer(connections=1, match_threshold=1.0)
+    try:
+        assert importer.write_batch(recipes) == 3
+    finally:
+        importer.close()
+
+    with connect() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM Author")
+        assert cursor.fetchone() == (1,)
+        cursor.execute("SELECT COUNT(*) FROM RecipeCategory")
+        assert cursor.fetchone() == (1,)
+        cursor.execute("SELECT COUNT(*) FROM Ingredient")
+        assert cursor.fetchone() == (2,)
+
+    loaded = [Recipe.by_id_uncached(_id) for _id in Recipe.iter_ids()]
+    assert [r.title for r in loaded] == ["bröd", "limpa", "kaka"]
+    assert len(set(r.author for r in loaded)) == 1
+    assert len(set(tuple(r.categories) for r in loaded)) == 1
+    ingredients = [r.ingredient_lists[0].ingredients[0]['ingredient'].name
+                   for r in loaded]
+    assert ingredients[0] == "Vetemjöl"
+    assert ingredients[1] == ingredients[2]
+
+    # Only the ingredient created is recorded as inserted
+    sugar_id = loaded[1].ingredient_lists[0].ingredients[0]['ingredient']._id
+    assert [(c.entity_id, c.operation) for c in feed.read()
+            if c.entity == "Ingredient"] == [(sugar_id, Operation.INSERT)]
+
+
+def test_recipe_cache_sync(test_db, tmpdir, monkeypatch):
+    from kokbok.cache import RecipeCache
+
+    cache = RecipeCache(str(tmpdir.join("cache.sqlite")), name="test")
+    monkeypatch.setattr(kokbok.model, '_recipe_cache', cache)
+
+    flour = new_ingredient()
+    bread = new_recipe([(flour, 500)])
+
+    sync_recipe_cache(force=True)
+    assert Recipe.by_id(bread._id).title == "bröd"
+    assert cache.get(bread._id) is not None
+
+    # Changed by another host, which invalidated its own cache only
+    with transaction() as cursor:
+        cursor.execute("UPDATE Ingredient SET Energy = 8 WHERE ID = %s",
+                       [flour._id])
+        record_changes(cursor, "Ingredient", [flour._id], Operation.UPDATE)
+
+    sync_recipe_cache(force=True)
+    assert cache.get(bread._id) is None
+    assert Recipe.by_id(bread._id).ingredient_lists[0].ingredients[0][
+        'ingredient'].energy == 8
+
+
+def test_revision(test_db):
+    flour = new_ingredient()
+    assert revision("Ingredient", flour._id) == 0
+
+    flour.add_categories(["mjöl"])
+    assert revision("Ingredient", flour._id) == 1
+
+    with pytest.raises(NotFoundException):
+        revision("Recipe", 1)
+
+
+def test_save_existing(test_db):
+    flour = new_ingredient(energy=100)
+    bread = new_recipe([(flour, 400)])
+
+    bread.title = "limpa"
+    bread.servings = 2
+    bread.save()
+    assert Recipe.by_id_uncached(bread._id).title == "limpa"
+    assert revision("Recipe", bread._id) == 1
+
+    flour.energy = 200
+    flour.save()
+    assert Ingredient.by_id(flour._id).energy == 200
+    assert revision("Ingredient", flour._id) == 1
+    assert revision("Recipe", bread._id) == 2
+    assert Recipe.find(kcal_per_serving_between=(400, 400),
+                       order_by='kcal_per_serving')[0] == [bread._id]
+
+    # The recipe shows the name, so it gets a new revision (and ETag)
+    flour.name = "Rågmjöl"
+    flour.save()
+    assert revision("Recipe", bread._id) == 3
+    assert Recipe.by_id_uncached(bread._id).ingredient_lists[0].ingredients[
+        0]['ingredient'].name == "Rågmjöl"
+
+    missing = Ingredient("Socker", 1, 2, 3, 4, 5, 6, 7)
+    missing._id = flour._id + 1
+    with pytest.raises(NotFoundException):
+        missing.save()
+
+
+def test_query_plans():
+    from kokbok import plans
+
+    report = plans.run(recipes=2000)
+    assert plans.check(report, {}) == []
+
+    instructions = [entry for (query, entry) in report.items()
+                    if "FROM Instruction join Recipe_Instruction" in query]
+    assert len(instructions) == 1
+    assert not any(step['filesort'] for step in instructions[0]['plan'])
@@ -0,0 +1,84 @@
+import io
+import os
+
+import pytest
+
+from kokbok.pictures import PictureStore, CHUNK_SIZE
+
+
+@pytest.fixture(scope="function")
+def store(tmpdir):
+    return PictureStore(str(tmpdir.join("pictures")))
+
+
+def test_put_and_read(store):
+    data = b"\x89PNG not really a picture"
+    digest = store.put(io.BytesIO(data))
+
+    assert digest in store
+    assert store.size(digest) == len(data)
+
+    with store.open(digest) as f:
+        assert f.read() == data
+
+    assert store.mmap(digest)[:] == data
+
+
+def test_identical_uploads_are_deduplicated(store):
+    first = store.put_bytes(b"same")
+    second = store.put_bytes(b"same")
+    other = store.put_bytes(b"different")
+
+    assert first == second
+    assert first != other
+
+    files = [name for (_, _, names) in os.walk(store.root) for name in names]
+    assert sorted(files) == sorted([first, other])
+
+
+def test_put_streams_in_chunks(store):
+    data = os.urandom(3 * CHUNK_SIZE + 17)
+    reads = []
+
+    class Reader(io.BytesIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super(Reader, self).read(size)
+
+    digest = store.put(Reader(data))
+
+    assert all(0 < size <= CHUNK_SIZE for size in reads)
+    assert store.mmap(digest)[:] == data
+
+
+def test_delete(store):
+    digest = store.put_bytes(b"gone soon")
+    store.delete(digest)
+    store.delete(digest)
+
+    assert digest not in store
+    with pytest.raises(FileNotFoundError):
+        store.open(digest)
+
+
+def test_stage(store):
+    digest = store.put_bytes(b"bread")
+
+    with store.stage(io.BytesIO(b"bread")) as staged:
+        assert staged == digest
+        # Deleted while a new reference to it is saved
+        store.delete(digest)
+    assert store.mmap(digest)[:] == b"bread"
+
+    with pytest.raises(RuntimeError):
+        with store.stage(io.BytesIO(b"crumb")) as staged:
+            raise RuntimeError
+    assert staged not in store
+
+    files = [name for (_, _, names) in os.walk(store.root) for name in names]
+    assert files == [digest]
+
+
+def test_invalid_digest(store):
+    with pytest.raises(ValueError):
+        store.path("../../etc/passwd")
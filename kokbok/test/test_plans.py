@@ -0,0 +1,106 @@
+from kokbok import plans
+from kokbok.plans import (QueryLog, normalise_query, problems, regressions,
+                          suggest_index, table_aliases)
+
+
+INSTRUCTIONS = ("SELECT Text FROM Instruction join Recipe_Instruction "
+                "ON Instruction.ID = Recipe_Instruction.InstructionID "
+                "WHERE Recipe_Instruction.RecipeID = %s ORDER BY Step ASC")
+
+PICTURES = ("SELECT P.ID, P.Filename FROM Picture AS P JOIN Recipe_Picture "
+            "AS RP ON P.ID = RP.PictureID WHERE RP.RecipeID = %s "
+            "ORDER BY RP.PictureID")
+
+
+def step(table, type, rows, key=None, filesort=False, temporary=False):
+    return {'table': table, 'type': type, 'key': key, 'rows': rows,
+            'filesort': filesort, 'temporary': temporary}
+
+
+def test_normalise_query():
+    assert normalise_query("SELECT ID\n        FROM Recipe WHERE ID IN "
+                           "(%s, %s, %s)") == \
+        "SELECT ID FROM Recipe WHERE ID IN (%s, ...)"
+
+    log = QueryLog()
+    log.add("SELECT ID FROM Recipe WHERE ID IN (%s, %s)", [1, 2])
+    log.add("SELECT ID FROM Recipe WHERE ID IN (%s)", [3])
+    log.add("SELECT ID  FROM Recipe WHERE ID IN (%s, %s, %s)", [1, 2, 3])
+    assert len(log) == 1
+    assert [args for (_, (_, args)) in log] == [[1, 2]]
+
+
+def test_table_aliases():
+    assert table_aliases(INSTRUCTIONS) == \
+        {'Instruction': 'Instruction',
+         'Recipe_Instruction': 'Recipe_Instruction'}
+    assert table_aliases(PICTURES) == \
+        {'Picture': 'Picture', 'P': 'Picture',
+         'Recipe_Picture': 'Recipe_Picture', 'RP': 'Recipe_Picture'}
+
+
+def test_problems():
+    query = "SELECT ID FROM Recipe WHERE Title = %s"
+    assert problems(query, [step('Recipe', 'ALL', 5000)]) == \
+        ["scans Recipe (5000 rows)"]
+    assert problems(query, [step('Recipe', 'ALL', 10)]) == []
+    assert problems(query, [step('Recipe', 'ref', 5000, filesort=True)]) == \
+        ["sorts Recipe (5000 rows)"]
+
+    # Cut short by the LIMIT
+    assert problems("SELECT ID FROM Recipe ORDER BY ID LIMIT %s",
+                    [step('Recipe', 'index', 5000, 'PRIMARY')]) == []
+    assert problems("SELECT ID, Name FROM Ingredient ORDER BY ID",
+                    [step('Ingredient', 'index', 5000, 'PRIMARY')]) == []
+
+
+def test_regressions():
+    baseline = [step('Recipe_Instruction', 'ref', 4, 'RecipeInstruction_Step'),
+                step('Instruction', 'eq_ref', 1, 'PRIMARY')]
+    assert regressions(baseline, baseline) == []
+    assert regressions([], baseline) == []
+
+    worse = [step('Recipe_Instruction', 'ref', 4, 'PRIMARY', filesort=True),
+             step('Instruction', 'ALL', 1)]
+    assert regressions(baseline, worse) == \
+        ["Recipe_Instruction: new filesort",
+         "Instruction: eq_ref (PRIMARY) -> ALL (None)"]
+
+
+def test_suggest_index():
+    assert suggest_index(INSTRUCTIONS, 'Recipe_Instruction') == \
+        ['RecipeID', 'Step']
+    assert suggest_index(INSTRUCTIONS, 'Recipe_Instruction',
+                         [['RecipeID', 'InstructionID'],
+                          ['RecipeID', 'Step']]) is None
+    assert suggest_index(INSTRUCTIONS, 'Instruction') == ['ID']
+
+    assert suggest_index(PICTURES, 'Recipe_Picture') == \
+        ['RecipeID', 'PictureID']
+    assert suggest_index("SELECT ID FROM IngredientList WHERE RecipeID = %s",
+                         'IngredientList', [['ID']]) == ['RecipeID']
+    assert suggest_index("SELECT ID, Servings FROM Recipe WHERE Servings "
+                         ">= %s ORDER BY Servings, ID LIMIT %s",
+                         'Recipe') == ['Servings', 'ID']
+    assert suggest_index("SELECT ID FROM Recipe WHERE Servings >= %s",
+                         'Recipe') == ['Servings']
+    assert suggest_index("SELECT COUNT(*) FROM Recipe", 'Recipe') is None
+
+
+def test_check():
+    report = {'SELECT 1': {'plan': [step('Recipe', 'ref', 1)],
+                           'problems': ["scans Recipe (5000 rows)"],
+                           'suggestions': []}}
+    assert plans.check(report, {}) == [('SELECT 1',
+                                        "scans Recipe (5000 rows)")]
+    assert plans.check(report, {'SELECT 1': [step('Recipe', 'const', 1)]}) \
+        == [('SELECT 1', "scans Recipe (5000 rows)"),
+            ('SELECT 1', "Recipe: const (None) -> ref (None)")]
+
+
+def test_baseline(tmpdir):
+    path = str(tmpdir.join("plans.json"))
+    plan = [step('Recipe', 'const', 1, 'PRIMARY')]
+    plans.save_baseline(path, {'SELECT 1': {'plan': plan, 'problems': [],
+                                            'suggestions': []}})
+    assert plans.load_baseline(path) == {'SELECT 1': plan}
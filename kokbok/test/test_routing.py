@@ -0,0 +1,131 @@
+import threading
+import time
+
+import pytest
+
+from kokbok.routing import (ReplicaRouter, ROUND_ROBIN, LEAST_LOADED,
+                            STALE_CHECKS)
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+REPLICAS = [{"host": "a"}, {"host": "b"}, {"host": "c"}]
+
+
+def test_round_robin():
+    router = ReplicaRouter(REPLICAS, strategy=ROUND_ROBIN)
+    picked = []
+    for _ in range(6):
+        index = router.acquire()
+        router.release(index)
+        picked.append(index)
+
+    assert picked == [0, 1, 2, 0, 1, 2]
+
+
+def test_least_loaded():
+    router = ReplicaRouter(REPLICAS, strategy=LEAST_LOADED)
+    assert [router.acquire() for _ in range(3)] == [0, 1, 2]
+
+    router.release(1)
+    assert router.acquire() == 1
+
+    # Ties go to the next replica in turn
+    router.release(0)
+    router.release(2)
+    assert router.acquire() == 2
+    assert router.acquire() == 0
+
+
+def test_no_replicas():
+    assert ReplicaRouter([]).acquire() is None
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        ReplicaRouter(REPLICAS, strategy="random")
+
+
+def test_lagging_replicas_are_skipped():
+    clock = Clock()
+    lags = {"a": 60, "b": None, "c": 1}
+    probes = []
+
+    def probe(conf):
+        probes.append(conf["host"])
+        return lags[conf["host"]]
+
+    router = ReplicaRouter(REPLICAS, max_lag=5, probe=probe, clock=clock,
+                           background=False)
+    # Not probed yet
+    assert router.acquire() is None
+
+    for index in range(3):
+        router.probe_once(index)
+    assert [router.acquire() for _ in range(3)] == [2, 2, 2]
+    # Picking a replica doesn't probe
+    assert probes == ["a", "b", "c"]
+
+    lags["c"] = 30
+    router.probe_once(2)
+    assert router.acquire() is None
+
+    # Old readings aren't trusted
+    lags["c"] = 1
+    router.probe_once(2)
+    clock.now += STALE_CHECKS * router.lag_check_interval + 1
+    assert router.acquire() is None
+
+
+def test_probing_in_the_background():
+    hung = threading.Event()
+
+    def probe(conf):
+        if conf["host"] == "a":
+            # A server that doesn't answer
+            hung.wait()
+        return 0
+
+    router = ReplicaRouter(REPLICAS[:2], probe=probe,
+                           lag_check_interval=0.01)
+    try:
+        # Replica a never answers, which holds up neither the reads nor
+        # the probes of replica b
+        for _ in range(500):
+            index = router.acquire()
+            router.release(index)
+            if index is not None:
+                break
+            time.sleep(0.01)
+        assert index == 1
+    finally:
+        router.close()
+        hung.set()
+
+
+def test_read_your_writes():
+    clock = Clock()
+    router = ReplicaRouter(REPLICAS, max_lag=5, clock=clock)
+
+    router.note_write()
+    assert router.acquire() is None
+
+    # Other threads are unaffected
+    other = []
+    thread = threading.Thread(target=lambda: other.append(router.acquire()))
+    thread.start()
+    thread.join()
+    assert other[0] is not None
+
+    clock.now += 5
+    assert router.acquire() is not None
+
+    with router.primary_reads():
+        assert router.acquire() is None
+    assert router.acquire() is not None
@@ -0,0 +1,84 @@
+import numpy as np
+
+from kokbok.model import Unit
+from kokbok.similar import build_matrix, grams, shadow_definition, top_k
+
+
+def test_grams():
+    assert grams(100, Unit.G, None, None) == 100
+    assert grams(10, Unit.ML, 2, None) == 20
+    assert grams(2, Unit.PCS, None, 60) == 120
+    assert grams(2, Unit.PCS, None, None) is None
+    assert grams(None, Unit.G, None, None) is None
+
+
+# Ingredients: 1 flour, 2 water, 3 yeast, 4 sugar, 5 egg, 6 salt
+ENTRIES = [(10, 1, 500), (10, 2, 300), (10, 3, 25), (10, 6, 5),
+           (11, 1, 450), (11, 2, 300), (11, 3, 20), (11, 6, 5),
+           (12, 1, 200), (12, 4, 200), (12, 5, 120), (12, 6, 2),
+           (13, 4, 150), (13, 5, 180), (13, 6, 1)]
+
+
+def test_build_matrix():
+    rids, matrix = build_matrix(ENTRIES, recipe_ids=[10, 14])
+
+    assert list(rids) == [10, 11, 12, 13, 14]
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    assert np.allclose(norms, [1, 1, 1, 1, 0])
+
+    # Salt is in every recipe with ingredients but not in 14
+    salt = matrix[:, 5].toarray().ravel()
+    assert salt[4] == 0
+
+
+def test_build_matrix_part():
+    rids, matrix = build_matrix(ENTRIES, recipe_ids=[14])
+
+    # The vectors of 10 and 12, weighted by the whole catalogue
+    counts = {1: 3, 2: 2, 3: 2, 4: 2, 5: 2, 6: 4}
+    part = [e for e in ENTRIES if e[0] in (10, 12)]
+    part_rids, part_matrix = build_matrix(part, frequencies=(5, counts))
+
+    assert list(part_rids) == [10, 12]
+    assert np.allclose(part_matrix.toarray(),
+                       matrix[[0, 2]].toarray()[:, [0, 1, 2, 3, 4, 5]])
+
+
+def test_top_k():
+    rids, matrix = build_matrix(ENTRIES, recipe_ids=[14])
+    neighbours = dict((rids[row], [(rids[other], score)
+                                   for (other, score) in similar])
+                      for (row, similar)
+                      in top_k(matrix, range(len(rids)), k=2, batch_size=2))
+
+    assert [r for (r, _) in neighbours[10]] == [11, 12]
+    assert neighbours[13][0][0] == 12
+    assert neighbours[14] == []
+    assert neighbours[10][0][1] > neighbours[10][1][1] > 0
+    assert neighbours[10][0][1] <= 1.0001
+
+
+def test_top_k_tiny_catalogue():
+    rids, matrix = build_matrix([(1, 1, 100)])
+    assert list(top_k(matrix, [0])) == [(0, [])]
+
+
+def test_shadow_definition():
+    ddl = ("CREATE TABLE `RecipeSimilar` (\n"
+           "  `RecipeID` int(11) NOT NULL,\n"
+           "  KEY `RecipeSimilar_Similar` (`SimilarRecipeID`),\n"
+           "  CONSTRAINT `RecipeSimilar_ibfk_1` FOREIGN KEY (`RecipeID`) "
+           "REFERENCES `Recipe` (`ID`) ON DELETE CASCADE,\n"
+           "  CONSTRAINT `RecipeSimilar_5f_2` FOREIGN KEY "
+           "(`SimilarRecipeID`) REFERENCES `Recipe` (`ID`)\n"
+           ") ENGINE=InnoDB")
+
+    assert shadow_definition(ddl, "60") == (
+        "CREATE TABLE `RecipeSimilarShadow` (\n"
+        "  `RecipeID` int(11) NOT NULL,\n"
+        "  KEY `RecipeSimilar_Similar` (`SimilarRecipeID`),\n"
+        "  CONSTRAINT `RecipeSimilar_60_1` FOREIGN KEY (`RecipeID`) "
+        "REFERENCES `Recipe` (`ID`) ON DELETE CASCADE,\n"
+        "  CONSTRAINT `RecipeSimilar_60_2` FOREIGN KEY "
+        "(`SimilarRecipeID`) REFERENCES `Recipe` (`ID`)\n"
+        ") ENGINE=InnoDB")